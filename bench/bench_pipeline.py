@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+"""Times every stage of the pipeline, from the db/ loaders to both models, on synthetic data
+
+Sources come from generate_data.py (written once to --data and reused, or to a
+throwaway directory). Each run then starts from a copy of the generated base
+SongPop.db:
+
+    ingest                   each db/add_*.py loader, add_training_set.py
+                             (the merge) and a full parallel build_db.py, each
+                             run as its own process like it would be by hand
+    song_popularity_model    reading training_set, reading the lyrics, grouping
+                             them into bags, featurize, fitting the pipeline
+                             with fixed parameters (or the full search with
+                             --search), batch predict and a one-track predict
+    simple_popularity_model  splitting the ratings into ranges, the scaler pass,
+                             reading and scaling every batch, one epoch of the
+                             network and predicting (the last two need
+                             TensorFlow and are skipped without it)
+
+Each stage is run --repeat times and its best time is kept. --json saves the
+results along with the commit, the data scale and library versions, and
+--compare prints them against an earlier --json file.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+DB_DIR = os.path.join(ROOT, "db")
+MODELS_DIR = os.path.join(ROOT, "models")
+sys.path.insert(0, MODELS_DIR)
+from generate_data import generate, source_env  # noqa: E402
+
+LOADERS = ["add_metadata", "add_chords", "add_ratings", "add_spotify"]
+# What generate_data.py writes into SongPop.db, before any loader runs
+BASE_FILES = ["SongPop.db"]
+SCALE_FILENAME = "scale.json"
+
+
+class Bench:
+    """Collects the timings of named stages"""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = []
+
+    def run(self, group, stage, fn, setup=None, rows=len):
+        """Will time fn (after an untimed setup) --repeat times and return its value
+
+        rows turns the value into the number of rows the stage handled.
+        """
+        runs = []
+        value = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            value = fn()
+            runs.append(time.perf_counter() - start)
+        self.record(group, stage, min(runs), runs, rows(value) if rows is not None else None)
+        return value
+
+    def record(self, group, stage, seconds, runs=None, rows=None, note=None):
+        result = {"group": group, "stage": stage, "seconds": round(seconds, 4)}
+        if runs is not None:
+            result["runs"] = [round(r, 4) for r in runs]
+        if rows is not None:
+            result["rows"] = int(rows)
+            if seconds > 0:
+                result["rows_per_second"] = round(rows / seconds, 1)
+        if note:
+            result["note"] = note
+        self.stages.append(result)
+        shown = f"{seconds:9.3f}s" if note is None else f"{'skipped':>10}"
+        print(f"  {group:<24} {stage:<20} {shown}" + (f"  {rows:>12,} rows" if rows is not None else "")
+              + (f"  ({note})" if note else ""))
+
+
+def count(db_path, table):
+    con = sqlite3.connect(db_path)
+    try:
+        return con.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    finally:
+        con.close()
+
+
+def fresh_copy(data, work):
+    """Will reset the work directory's SongPop.db to the generated base"""
+    for name in BASE_FILES:
+        shutil.copyfile(os.path.join(data, name), os.path.join(work, name))
+    shutil.rmtree(os.path.join(work, "feature_cache"), ignore_errors=True)
+
+
+def script(name, env, db_path, table):
+    """Will return a stage that runs a db/ script and counts the table it fills"""
+    def run():
+        subprocess.run([sys.executable, name], cwd=DB_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+        return count(db_path, table)
+    return run
+
+
+def reset_loader(db_path, loader):
+    """Will drop a loader's tables and manifest entry, so its next run is a full load"""
+    module = __import__(loader)
+    con = sqlite3.connect(db_path)
+    for table in [module.TABLE] + list(getattr(module, "LOOKUP_TABLES", {})):
+        con.execute(f"DROP TABLE IF EXISTS {table}")
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'ingest_manifest'").fetchone():
+        con.execute("DELETE FROM ingest_manifest WHERE source = ?", (loader,))
+    con.commit()
+    con.close()
+
+
+def bench_ingest(bench, data, work, timed=True):
+    """Will time each loader, the merge and a full build (or just build, untimed)"""
+    env = source_env(data)
+    env["DB_PATH"] = db_path = os.path.join(work, "SongPop.db")
+    env["STAGING_DIR"] = work
+
+    build = script("build_db.py", env, db_path, "training_set")
+    fresh_copy(data, work)
+    if not timed:
+        build()
+        return
+
+    for loader in LOADERS:
+        bench.run("ingest", loader, script(f"{loader}.py", env, db_path, __import__(loader).TABLE),
+                  setup=lambda: reset_loader(db_path, loader), rows=int)
+    bench.run("ingest", "add_training_set", script("add_training_set.py", env, db_path, "training_set"),
+              rows=int)
+    bench.run("ingest", "build_db", build, setup=lambda: fresh_copy(data, work), rows=int)
+
+
+def bench_song_model(bench, work, search):
+    """Will time the song popularity model's stages, in process"""
+    import song_popularity_model as spm
+    from sklearn.pipeline import Pipeline
+    from chord_features import load_chord_vocabulary
+    from lyrics_features import attach_bags, load_vocabulary, lyrics_bags
+    from tuning import make_regressor
+
+    group = "song_popularity_model"
+    database = os.path.join(work, "SongPop.db")
+    con = sqlite3.connect(database)
+    vocabulary = load_vocabulary(con)
+    chord_vocabulary = load_chord_vocabulary(con)
+
+    training = bench.run(group, "load", lambda: spm.read_training(con))
+    lyrics_raw = bench.run(group, "load_lyrics", lambda: spm.read_lyrics(con))
+    bags = bench.run(group, "lyric_grouping", lambda: attach_bags(training["track_id"], lyrics_bags(lyrics_raw)))
+    df = bench.run(group, "featurize", lambda: spm.featurize(training.assign(lyrics_bag=bags)))
+    con.close()
+
+    df_train, df_test = spm.split(df)
+    X_train, y_train = df_train[spm.feature_columns], df_train["synthetic_popularity"]
+    if search:
+        cwd = os.getcwd()
+        os.chdir(work)
+        try:
+            model = bench.run(group, "fit_search", lambda: spm.train(
+                df_train, vocabulary, chord_vocabulary, "bench", os.path.join(work, "model.pkl")),
+                rows=lambda _: len(df_train))
+        finally:
+            os.chdir(cwd)
+    else:
+        def fit():
+            model = Pipeline(steps=[("prep", spm.make_preprocess(vocabulary, chord_vocabulary))]
+                             + make_regressor(spm.REGRESSOR))
+            return model.fit(X_train, y_train)
+        model = bench.run(group, "fit", fit, rows=lambda _: len(df_train))
+
+    bench.run(group, "predict", lambda: model.predict(df_test[spm.feature_columns]))
+    one = [df_test.index[0]]
+    bench.run(group, "predict_one", lambda: spm.predict(model, one, database))
+
+
+def bench_simple_model(bench, work, epochs):
+    """Will time the simple popularity model's stages, in process"""
+    import numpy as np
+    import simple_popularity_model as simple
+
+    group = "simple_popularity_model"
+    database = os.path.join(work, "SongPop.db")
+    ratings = count(database, "ratings")
+    ranges = bench.run(group, "load", lambda: simple.load_ranges(database), rows=lambda _: ratings)
+    preprocessor = bench.run(group, "fit_scaler", lambda: simple.fit_preprocessor(ranges, database),
+                             rows=lambda _: ratings)
+
+    def read_all():
+        rows = 0
+        for validation in (False, True):
+            for first, last in ranges:
+                rows += sum(len(y) for _, y in simple.batches(preprocessor, first, last, validation, database))
+        return rows
+    bench.run(group, "featurize", read_all, rows=int)
+
+    try:
+        import tensorflow  # noqa: F401
+    except ImportError:
+        for stage in ("fit", "predict"):
+            bench.record(group, stage, 0.0, note="tensorflow not installed")
+        return
+
+    train_ds = simple.make_dataset(ranges, preprocessor, False, database)
+    val_ds = simple.make_dataset(ranges, preprocessor, True, database)
+
+    def fit():
+        model = simple.build_model()
+        simple.fit(model, train_ds, val_ds, epochs)
+        return model
+
+    # The checkpoint is written to the working directory
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        model = bench.run(group, "fit", fit, rows=lambda _: ratings)
+    finally:
+        os.chdir(cwd)
+    X_val = np.concatenate([X for X, _ in val_ds.as_numpy_iterator()])
+    bench.run(group, "predict", lambda: model.predict(X_val, verbose=0))
+
+
+def environment():
+    import numpy
+    import pandas
+    import sklearn
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain"], cwd=ROOT, capture_output=True,
+                                    text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": numpy.__version__,
+        "pandas": pandas.__version__,
+        "sklearn": sklearn.__version__,
+    }
+
+
+def prepare_data(data, args):
+    """Will generate the sources into data unless they are already there, returning the scale"""
+    scale_path = os.path.join(data, SCALE_FILENAME)
+    if os.path.exists(scale_path):
+        with open(scale_path) as f:
+            scale = json.load(f)
+        print(f"Reusing the data in {data}")
+        return scale
+    print(f"Generating {args.songs:,} songs into {data}")
+    scale = generate(data, args.songs, args.chords, args.ratings, seed=args.seed, build=False)
+    with open(scale_path, "w") as f:
+        json.dump(scale, f, indent=2)
+    return scale
+
+
+def compare(stages, baseline_path):
+    """Will print each stage's time next to the same stage in an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(s["group"], s["stage"]): s for s in baseline["stages"]}
+    print(f"\nAgainst {baseline_path} ({(baseline['environment'].get('commit') or '?')[:10]})")
+    print(f"{'stage':<46} | {'before':>9} | {'now':>9} | {'change':>7}")
+    print("-" * 80)
+    for s in stages:
+        old = before.get((s["group"], s["stage"]))
+        if old is None or "note" in s or "note" in old or not old["seconds"]:
+            continue
+        ratio = s["seconds"] / old["seconds"]
+        print(f"{s['group'] + ' ' + s['stage']:<46} | {old['seconds']:>8.3f}s | {s['seconds']:>8.3f}s | {ratio:>6.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", help="generated data directory to (create and) reuse")
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--chords", type=int)
+    parser.add_argument("--ratings", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best is kept")
+    parser.add_argument("--groups", default="ingest,song_popularity_model,simple_popularity_model")
+    parser.add_argument("--search", action="store_true",
+                        help="time the full hyperparameter search instead of one fixed fit")
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="an earlier --json file to compare against")
+    args = parser.parse_args()
+    groups = args.groups.split(",")
+    sys.path.insert(0, DB_DIR)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.abspath(args.data or os.path.join(tmp, "data"))
+        scale = prepare_data(data, args)
+        work = os.path.join(tmp, "work")
+        os.makedirs(work)
+        bench = Bench(args.repeat)
+
+        print(f"\nStage timings (best of {args.repeat}):")
+        # The model stages read the database the ingest stages build
+        bench_ingest(bench, data, work, timed="ingest" in groups)
+        if "song_popularity_model" in groups:
+            bench_song_model(bench, work, args.search)
+        if "simple_popularity_model" in groups:
+            bench_simple_model(bench, work, args.epochs)
+
+    stages = bench.stages
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "scale": scale,
+        "args": vars(args),
+        "stages": stages,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to '{args.json}'")
+    if args.compare:
+        compare(stages, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""Measures db/song_search.py's search and lookup latency under concurrent load
+
+Runs ranked searches, prefix searches and id lookups for titles and ids
+sampled from an existing SongPop.db (built with the song_search index, e.g.
+by generate_data.py), from several threads sharing one SongSearch, and
+prints queries/sec and latency percentiles of each, next to the LIKE scan
+a search used to be.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+from song_search import SongSearch  # noqa: E402
+
+
+def sample_queries(db_path, n, seed=0):
+    """Will return n (kind, argument) queries over titles and ids taken from the database"""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    titles = [r[0] for r in con.execute("SELECT title FROM songs WHERE title IS NOT NULL ORDER BY random() LIMIT ?", (n,))]
+    ids = [r[0] for r in con.execute(
+        "SELECT id FROM (SELECT track_id AS id FROM songs UNION ALL SELECT track_id FROM id_translations) "
+        "ORDER BY random() LIMIT ?", (n,))]
+    con.close()
+
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        kind = rng.choice(["search", "prefix", "lookup"])
+        if kind == "lookup":
+            queries.append((kind, rng.choice(ids)))
+            continue
+        words = rng.choice(titles).split()[:2]
+        if kind == "prefix":
+            # What has been typed so far: the last word cut short
+            words[-1] = words[-1][:max(2, len(words[-1]) // 2)]
+        queries.append((kind, " ".join(words)))
+    return queries
+
+
+def like_scan(db_path, titles):
+    """Will return the median seconds of the old LIKE search over songs"""
+    con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    times = []
+    for title in titles:
+        start = time.perf_counter()
+        con.execute("SELECT track_id, title, artist_name FROM songs WHERE title LIKE ? OR artist_name LIKE ?",
+                    (f"%{title}%", f"%{title}%")).fetchall()
+        times.append(time.perf_counter() - start)
+    con.close()
+    return float(np.median(times))
+
+
+def run(songs, queries, threads):
+    """Will run the queries on that many threads and return (elapsed seconds, {kind: latencies})"""
+    def timed(query):
+        kind, argument = query
+        start = time.perf_counter()
+        if kind == "lookup":
+            songs.lookup(argument)
+        else:
+            songs.search(argument, prefix=kind == "prefix")
+        return kind, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(timed, queries))
+    elapsed = time.perf_counter() - start
+    latencies = {}
+    for kind, seconds in results:
+        latencies.setdefault(kind, []).append(seconds)
+    return elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    queries = sample_queries(args.database, args.queries, args.seed)
+    like_s = like_scan(args.database, [q[1] for q in queries if q[0] == "search"][:20])
+    songs = SongSearch(args.database, args.pool_size)
+    results = []
+    for threads in args.threads:
+        elapsed, latencies = run(songs, queries, threads)
+        for kind, seconds in sorted(latencies.items()):
+            ms = np.array(seconds) * 1000
+            results.append({
+                "threads": threads,
+                "kind": kind,
+                "queries": len(ms),
+                "per_second": round(len(queries) / elapsed, 1),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            })
+    songs.close()
+
+    print()
+    print(f"LIKE scan over songs: {like_s * 1000:.1f} ms median")
+    print(f"{'threads':>7} | {'kind':<7} | {'queries/s':>9} | {'p50 ms':>7} | {'p95 ms':>7} | {'p99 ms':>7}")
+    print("-" * 60)
+    for r in results:
+        print(f"{r['threads']:>7} | {r['kind']:<7} | {r['per_second']:>9} | "
+              f"{r['p50_ms']:>7} | {r['p95_ms']:>7} | {r['p99_ms']:>7}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "like_scan_ms": like_s * 1000, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
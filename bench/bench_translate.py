@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""Measures db/spotify_id_translate.py against the local fake Spotify API
+
+Builds a throwaway SongPop.db with a chords table of synthetic Spotify ids,
+runs the translator's main() against bench/fake_spotify.py, and reports
+ids/sec, request counts, wasted sleep time and database write time.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+import spotify_id_translate  # noqa: E402
+from fake_spotify import FakeSpotify, Scenario  # noqa: E402
+
+ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+
+def make_database(path, n_ids, duplicate_rate, invalid_rate, seed=0):
+    """Will write a chords table holding n_ids distinct spotify ids, some repeated"""
+    rng = random.Random(seed)
+    ids = ["".join(rng.choice(ALPHABET) for _ in range(22)) for _ in range(n_ids)]
+    ids = [tid[:21] + "-" if rng.random() < invalid_rate else tid for tid in ids]
+    rows = ids + [rng.choice(ids) for _ in range(int(n_ids * duplicate_rate))]
+    rng.shuffle(rows)
+
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE chords (song_id INTEGER, spotify_song_id TEXT)")
+    con.executemany("INSERT INTO chords VALUES (?, ?)", enumerate(rows))
+    con.commit()
+    con.close()
+    return len(rows)
+
+
+def run(mode, args):
+    """Will run one translation against a fresh fake API and database, returning its metrics"""
+    scenario = Scenario(args.latency, burst_every=args.burst_every, burst_length=args.burst_length,
+                        retry_after=args.retry_after, token_ttl=args.token_ttl,
+                        error_rate=args.error_rate, null_rate=args.null_rate, seed=args.seed)
+    fake = FakeSpotify(scenario).start()
+    spotify_id_translate.TOKEN_URL = fake.token_url
+    spotify_id_translate.TRACKS_URL = fake.tracks_url
+    for key in spotify_id_translate.STATS:
+        spotify_id_translate.STATS[key] = type(spotify_id_translate.STATS[key])()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "SongPop.db")
+        chord_rows = make_database(db_path, args.ids, args.duplicate_rate, args.invalid_rate, args.seed)
+        os.environ.update({
+            "DB_PATH": db_path,
+            "CLIENT_ID": "bench",
+            "CLIENT_SECRET": "bench",
+            "ASYNC_BATCHES": str(args.in_flight if mode == "async" else 0),
+            "REQUESTS_PER_SECOND": str(args.rate),
+        })
+        os.environ.pop("ACCESS_TOKEN", None)
+
+        start = time.perf_counter()
+        spotify_id_translate.main()
+        elapsed = time.perf_counter() - start
+
+        con = sqlite3.connect(db_path)
+        translated = con.execute("SELECT count(*) FROM id_translations").fetchone()[0]
+        failed = con.execute("SELECT count(*) FROM id_failures").fetchone()[0]
+        con.close()
+    fake.stop()
+
+    stats = dict(spotify_id_translate.STATS)
+    return {
+        "mode": mode,
+        "chord_rows": chord_rows,
+        "distinct_ids": args.ids,
+        "translated": translated,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "ids_per_second": round((translated + failed) / elapsed, 1) if elapsed else None,
+        "client_requests": stats["requests"],
+        "server_responses": {str(k): v for k, v in sorted(fake.counts.items(), key=str)},
+        "sleep_seconds": round(stats["sleep_seconds"], 3),
+        "throttle_seconds": round(stats["throttle_seconds"], 3),
+        "write_seconds": round(stats["write_seconds"], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both")
+    parser.add_argument("--ids", type=int, default=5000, help="distinct spotify ids")
+    parser.add_argument("--duplicate-rate", type=float, default=0.3)
+    parser.add_argument("--invalid-rate", type=float, default=0.0)
+    parser.add_argument("--in-flight", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=50.0, help="client requests/sec limit")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--burst-every", type=int, default=0)
+    parser.add_argument("--burst-length", type=int, default=5)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--token-ttl", type=int, default=3600)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--null-rate", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    modes = ["sync", "async"] if args.mode == "both" else [args.mode]
+    results = [run(mode, args) for mode in modes]
+
+    print()
+    print(f"{'mode':<6} | {'ids/sec':>9} | {'seconds':>8} | {'requests':>8} | {'sleep s':>8} | {'write s':>8}")
+    print("-" * 62)
+    for r in results:
+        print(f"{r['mode']:<6} | {r['ids_per_second']:>9} | {r['seconds']:>8} | "
+              f"{r['client_requests']:>8} | {r['sleep_seconds']:>8} | {r['write_seconds']:>8}")
+        print(f"         responses: {r['server_responses']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+"""Local stand-in for the Spotify token and /v1/tracks endpoints
+
+Serves /api/token and /v1/tracks on one port, with configurable latency,
+429 bursts with Retry-After, token expiry, 5xx errors and null tracks, so
+db/spotify_id_translate.py can be measured without touching the real API.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Scenario:
+    """How the fake API misbehaves"""
+    def __init__(self, latency=0.05, jitter=0.02, burst_every=0, burst_length=5,
+                 retry_after=1, token_ttl=3600, error_rate=0.0, null_rate=0.05, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        # Every burst_every-th request starts a run of burst_length 429s
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.retry_after = retry_after
+        self.token_ttl = token_ttl
+        self.error_rate = error_rate
+        self.null_rate = null_rate
+        self.seed = seed
+
+
+class FakeSpotify:
+    """A threaded HTTP server playing the part of accounts.spotify.com and api.spotify.com"""
+    def __init__(self, scenario=None, host="127.0.0.1", port=0):
+        self.scenario = scenario or Scenario()
+        self.random = random.Random(self.scenario.seed)
+        self.lock = threading.Lock()
+        self.tokens = {}
+        self.counts = Counter()
+        self.track_requests = 0
+        self.burst_left = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def token_url(self):
+        return f"{self.base_url}/api/token"
+
+    @property
+    def tracks_url(self):
+        return f"{self.base_url}/v1/tracks"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.monotonic() + self.scenario.token_ttl
+        return {"access_token": token, "token_type": "Bearer", "expires_in": self.scenario.token_ttl}
+
+    def token_valid(self, header):
+        token = header[len("Bearer "):] if header and header.startswith("Bearer ") else None
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and time.monotonic() < expires
+
+    def next_outcome(self):
+        """Decides whether a /v1/tracks request is rate limited, fails or succeeds"""
+        scenario = self.scenario
+        with self.lock:
+            self.track_requests += 1
+            if scenario.burst_every and self.track_requests % scenario.burst_every == 0:
+                self.burst_left = scenario.burst_length
+            if self.burst_left:
+                self.burst_left -= 1
+                return 429
+            if self.random.random() < scenario.error_rate:
+                return self.random.choice([500, 502, 503])
+        return 200
+
+    def track(self, track_id):
+        with self.lock:
+            missing = self.random.random() < self.scenario.null_rate
+        if missing:
+            return None
+        return {
+            "id": track_id,
+            "name": f"Track {track_id}",
+            "artists": [{"id": f"artist_{track_id[-3:]}", "name": f"Artist {track_id[-3:]}"}],
+        }
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body=None, headers=None):
+                payload = json.dumps(body if body is not None else {}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+                with fake.lock:
+                    fake.counts[status] += 1
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                if urlparse(self.path).path != "/api/token":
+                    self.send_json(404)
+                    return
+                with fake.lock:
+                    fake.counts["token"] += 1
+                self.send_json(200, fake.issue_token())
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != "/v1/tracks":
+                    self.send_json(404)
+                    return
+                scenario = fake.scenario
+                time.sleep(max(0.0, scenario.latency + fake.random.uniform(-1, 1) * scenario.jitter))
+
+                if not fake.token_valid(self.headers.get("Authorization")):
+                    self.send_json(401, {"error": {"status": 401, "message": "The access token expired"}})
+                    return
+                outcome = fake.next_outcome()
+                if outcome == 429:
+                    self.send_json(429, headers={"Retry-After": str(scenario.retry_after)})
+                    return
+                if outcome != 200:
+                    self.send_json(outcome)
+                    return
+
+                ids = parse_qs(url.query).get("ids", [""])[0].split(",")
+                if len(ids) > 50:
+                    self.send_json(400, {"error": {"status": 400, "message": "Too many ids requested"}})
+                    return
+                if not all(track_id.isalnum() for track_id in ids):
+                    self.send_json(400, {"error": {"status": 400, "message": "Invalid base62 id"}})
+                    return
+                self.send_json(200, {"tracks": [fake.track(track_id) for track_id in ids]})
+
+        return Handler
+
+
+def main():
+    """Will run the fake API in the foreground"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--burst-every", type=int, default=0)
+    parser.add_argument("--burst-length", type=int, default=5)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--token-ttl", type=int, default=3600)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--null-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    scenario = Scenario(args.latency, burst_every=args.burst_every, burst_length=args.burst_length,
+                        retry_after=args.retry_after, token_ttl=args.token_ttl,
+                        error_rate=args.error_rate, null_rate=args.null_rate)
+    fake = FakeSpotify(scenario, port=args.port)
+    print(f"Fake Spotify API on {fake.base_url}")
+    print(f"  SPOTIFY_TOKEN_URL={fake.token_url}")
+    print(f"  SPOTIFY_TRACKS_URL={fake.tracks_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
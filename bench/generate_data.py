@@ -0,0 +1,447 @@
+#!/usr/bin/python3
+"""Generates a synthetic data directory laid out like the private source files
+
+Writes, under --out:
+
+    track_metadata.db                   the MSD songs table
+    Chordonomicon/chordonomicon_v2.csv  chord progressions with section tags
+    song_ratings_data.csv               ratings with audio features
+    MSDandSPT/Music Info.csv            MSD track ids with their Spotify ids
+    SongPop.db                          the mxm words and lyrics tables, plus
+                                        id_translations and id_failures as
+                                        spotify_id_translate.py would have
+                                        filled them
+
+and then runs db/build_db.py on it (unless --no-build), so SongPop.db ends up
+with every table the real build makes. Point DATA_DIR at --out to use it.
+
+The joins overlap the way the real ones do: some chords rows have no Spotify
+id, some Spotify ids never translate, translated names differ from the MSD
+titles by case, " - Remastered" suffixes, "(feat. ...)" credits and the odd
+typo, and only some songs have lyrics or ratings. Chords follow diatonic
+progressions with repeated sections, and lyric words are Zipf-distributed
+over a frequency-ordered vocabulary, like mxm's.
+"""
+import argparse
+import csv
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import numpy as np
+
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db")
+sys.path.insert(0, DB_DIR)
+import add_metadata  # noqa: E402
+
+# Rows generated and written at a time
+CHUNK_SIZE = 100000
+
+# Share of MSD songs listed in Music Info.csv
+SPOTIFY_SHARE = 0.6
+# Share of chords rows whose Spotify id is one of those songs', and with no Spotify id at all
+CHORDS_LINKED = 0.5
+CHORDS_WITHOUT_ID = 0.1
+# Share of Spotify ids the API answers (the rest are written to id_failures)
+TRANSLATED = 0.9
+# Share of ratings rows named after an MSD song
+RATINGS_LINKED = 0.7
+# Share of MSD songs in mxm, and of those in its test split
+LYRICS_SHARE = 0.25
+LYRICS_TEST_SHARE = 0.1
+# Zipf exponent of lyric word frequencies
+ZIPF = 1.05
+
+ALNUM = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
+BASE62 = np.array(list("0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+
+ID_TRANSLATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_translations (
+    track_id TEXT PRIMARY KEY,
+    artist_id TEXT NOT NULL,
+    track_name TEXT NOT NULL,
+    artist_name TEXT NOT NULL,
+    title_norm TEXT GENERATED ALWAYS AS (lower(trim(track_name, ' ' || char(9, 10, 13)))) VIRTUAL,
+    artist_norm TEXT GENERATED ALWAYS AS (lower(trim(artist_name, ' ' || char(9, 10, 13)))) VIRTUAL
+);"""
+ID_FAILURES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_failures (
+    track_id TEXT PRIMARY KEY,
+    reason TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_seen TEXT NOT NULL
+);"""
+MXM_SCHEMA = (
+    "CREATE TABLE words (word TEXT PRIMARY KEY)",
+    "CREATE TABLE lyrics (track_id, mxm_tid INT, word TEXT, count INT, is_test INT, "
+    "FOREIGN KEY(word) REFERENCES words(word))",
+)
+
+TITLE_WORDS = """love night heart fire dance baby girl boy time world dream rain sun road home
+light blue dark river summer winter city star moon sky gold heaven angel devil money soul
+ghost wild young free lonely broken sweet crazy little good bad last first never forever
+tonight yesterday tomorrow morning midnight highway train ocean sea mountain rose wine whiskey
+blood stone thunder shadow diamond silver paper glass mirror window door song radio memory
+""".split()
+FIRST_NAMES = """john paul mary james anna david sarah michael lisa chris kate peter laura mark
+emma tom julia frank nina bob alice sam grace leo ruby jack ivy max ella""".split()
+LAST_NAMES = """smith jones brown taylor wilson davis clark lewis walker young king wright
+hill green baker adams nelson carter mitchell turner parker evans""".split()
+GENRES = ["pop", "rock", "country", "alternative", "punk", "metal", "soul", "jazz",
+          "reggae", "electronic", "hip hop", "pop rock", "folk"]
+ROCK_GENRES = ["hard rock", "soft rock", "classic rock", "indie rock", "punk rock"]
+SECTION_PLANS = [
+    ["verse", "chorus", "verse", "chorus", "bridge", "chorus"],
+    ["intro", "verse", "chorus", "verse", "chorus", "outro"],
+    ["verse", "verse", "chorus", "verse", "chorus"],
+    ["intro", "verse", "pre-chorus", "chorus", "verse", "pre-chorus", "chorus", "bridge", "chorus"],
+]
+
+ROOTS = ["C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab", "A", "Bb", "B"]
+# Major scale degrees: (semitones above the key, triad quality, how often it's used)
+DEGREES = [(0, "", 0.25), (2, "m", 0.08), (4, "m", 0.05), (5, "", 0.22),
+           (7, "", 0.22), (9, "m", 0.15), (11, "dim", 0.03)]
+# Borrowed chords: bVII, iv and the major III that leads back to the relative minor
+BORROWED = [(10, ""), (5, "m"), (4, "")]
+EXTENSIONS = {"": ["7", "maj7", "sus4", "sus2", "add9", "6"], "m": ["7", "9"], "dim": ["7"]}
+DEGREE_WEIGHTS = [w for _, _, w in DEGREES]
+# Songs in the relative minor lean on vi, ii and iii instead
+MINOR_WEIGHTS = [0.15, 0.12, 0.08, 0.15, 0.12, 0.35, 0.03]
+
+COMMON_WORDS = """i the you to and a me it not in my is of your that do on are we am will
+all be for no so love can know but up what just with now get go oh like don't down out
+got this time she one baby yeah see come let make when he way want never there take they
+heart feel say need night see away back life right only give how tell if""".split()
+SYLLABLES = """ba be bi bo bu da de di do du ka ke ki ko ku la le li lo lu ma me mi mo mu
+na ne ni no nu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo wa we wi""".split()
+
+
+def random_ids(rng, n, prefix="", length=16, alphabet=ALNUM):
+    """Will return n random ids of alphabet characters, vectorized"""
+    chars = alphabet[rng.integers(0, len(alphabet), (n, length))]
+    return [prefix + s for s in chars.view(f"<U{length}").ravel()]
+
+
+def title(r):
+    return " ".join(r.choice(TITLE_WORDS) for _ in range(r.choice((1, 1, 2, 2, 2, 3, 4)))).title()
+
+
+def artist_name(r):
+    if r.random() < 0.4:
+        return "The " + r.choice(TITLE_WORDS).title() + r.choice(("s", " Band", " Brothers", "s"))
+    return f"{r.choice(FIRST_NAMES).title()} {r.choice(LAST_NAMES).title()}"
+
+
+def spotify_name(r, name, artists):
+    """Will return how the Spotify API might spell an MSD title"""
+    roll = r.random()
+    if roll < 0.70:
+        return name
+    if roll < 0.80:
+        return name.lower() + r.choice(("", " "))
+    if roll < 0.88:
+        return f"{name} - Remastered {r.randint(1995, 2015)}"
+    if roll < 0.93:
+        return f"{name} (Live)"
+    if roll < 0.97:
+        return f"{name} (feat. {r.choice(artists)})"
+    i = r.randrange(len(name))
+    return name[:i] + name[i + 1:] if len(name) > 4 else name
+
+
+def chord(r, key, minor):
+    """Will draw one chord of a key, mostly diatonic"""
+    if r.random() < 0.05:
+        interval, quality = r.choice(BORROWED)
+    else:
+        interval, quality, _ = r.choices(DEGREES, MINOR_WEIGHTS if minor else DEGREE_WEIGHTS)[0]
+    name = ROOTS[(key + interval) % 12] + quality
+    if r.random() < 0.12:
+        name += r.choice(EXTENSIONS[quality])
+    if r.random() < 0.03:
+        name += "/" + ROOTS[(key + r.choice((4, 7))) % 12]
+    return name
+
+
+def progression(r):
+    """Will return a chordonomicon-style progression: sections of repeated chord loops"""
+    key, minor = r.randrange(12), r.random() < 0.3
+    loops = {}
+    counts = {}
+    parts = []
+    for section in r.choice(SECTION_PLANS):
+        if section not in loops:
+            loops[section] = [chord(r, key, minor) for _ in range(r.choice((2, 3, 4, 4, 4)))]
+        counts[section] = counts.get(section, 0) + 1
+        parts.append(f"<{section}_{counts[section]}>")
+        parts.extend(loops[section] * r.choice((1, 2, 2, 4)))
+    return " ".join(parts)
+
+
+def make_vocabulary(n_words):
+    """Will return n_words distinct words, most frequent first, like mxm's"""
+    words = list(dict.fromkeys(COMMON_WORDS))
+    r = random.Random(1)
+    seen = set(words)
+    while len(words) < n_words:
+        word = "".join(r.choice(SYLLABLES) for _ in range(r.choice((1, 2, 2, 3))))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words[:n_words]
+
+
+def write_songs(out, rng, r, n_songs):
+    """Will write track_metadata.db and return (track ids, titles, artists)"""
+    n_artists = max(n_songs // 8, 1)
+    weights = rng.lognormal(0, 1.2, n_artists)
+    artist_of = rng.choice(n_artists, n_songs, p=weights / weights.sum())
+    artist_ids = random_ids(rng, n_artists, "AR")
+    names = [artist_name(r) for _ in range(n_artists)]
+    familiarity = rng.beta(4, 3, n_artists)
+    hotttnesss = np.clip(0.6 * familiarity + rng.normal(0, 0.08, n_artists), 0, 1)
+
+    track_ids = random_ids(rng, n_songs, "TR")
+    song_ids = random_ids(rng, n_songs, "SO")
+    titles = [title(r) for _ in range(n_songs)]
+    durations = rng.lognormal(np.log(240), 0.35, n_songs)
+    years = np.where(rng.random(n_songs) < 0.48, 0,
+                     np.clip(2011 - rng.gamma(2, 8, n_songs).astype(int), 1922, 2011))
+
+    path = os.path.join(out, "track_metadata.db")
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    con.execute(add_metadata.SCHEMA)
+    rows = (
+        (track_ids[i], titles[i], song_ids[i], title(r), artist_ids[a], "", names[a],
+         float(durations[i]), float(familiarity[a]), float(hotttnesss[a]), int(years[i]),
+         int(rng_id), -1, 0)
+        for i, (a, rng_id) in enumerate(zip(artist_of.tolist(), rng.integers(1, 10 ** 7, n_songs).tolist()))
+    )
+    con.executemany("INSERT INTO songs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    con.commit()
+    con.close()
+    return track_ids, titles, [names[a] for a in artist_of.tolist()]
+
+
+def write_spotify(out, rng, track_ids, titles, artists):
+    """Will write Music Info.csv and return the indexes of the listed songs and their Spotify ids"""
+    listed = np.flatnonzero(rng.random(len(track_ids)) < SPOTIFY_SHARE)
+    spotify_ids = random_ids(rng, len(listed), length=22, alphabet=BASE62)
+    os.makedirs(os.path.join(out, "MSDandSPT"), exist_ok=True)
+    with open(os.path.join(out, "MSDandSPT", "Music Info.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["track_id", "name", "artist", "spotify_preview_url", "spotify_id"])
+        writer.writerows(
+            (track_ids[i], titles[i], artists[i], f"https://p.scdn.co/mp3-preview/{s}", s)
+            for i, s in zip(listed.tolist(), spotify_ids)
+        )
+    return listed, spotify_ids
+
+
+def write_chords(out, rng, r, n_chords, titles, artists, listed, spotify_ids):
+    """Will write the Chordonomicon CSV and return (id_translations rows, failed ids) as the API would give"""
+    artist_spotify = {}
+    artist_numbers = {}
+    translations = {}
+    failures = set()
+    all_artists = sorted(set(artists))
+    roll = rng.random(n_chords)
+    linked = rng.integers(0, max(len(listed), 1), n_chords)
+    other_ids = iter(random_ids(rng, n_chords, length=22, alphabet=BASE62))
+    os.makedirs(os.path.join(out, "Chordonomicon"), exist_ok=True)
+    with open(os.path.join(out, "Chordonomicon", "chordonomicon_v2.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "chords", "release_date", "genres", "decade", "rock_genre",
+                         "artist_id", "main_genre", "spotify_song_id", "spotify_artist_id"])
+        for i in range(n_chords):
+            if roll[i] < CHORDS_LINKED and len(listed):
+                song = int(listed[linked[i]])
+                spotify_id = spotify_ids[linked[i]]
+                name, artist = titles[song], artists[song]
+                track_name = spotify_name(r, name, all_artists)
+            else:
+                spotify_id = next(other_ids) if roll[i] < 1 - CHORDS_WITHOUT_ID else ""
+                artist = artist_name(r)
+                track_name = title(r)
+            if artist not in artist_spotify:
+                artist_spotify[artist] = random_ids(rng, 1, length=22, alphabet=BASE62)[0]
+                artist_numbers[artist] = len(artist_numbers)
+            if spotify_id and spotify_id not in translations:
+                if r.random() < TRANSLATED:
+                    translations[spotify_id] = (spotify_id, artist_spotify[artist], track_name, artist)
+                    failures.discard(spotify_id)
+                else:
+                    failures.add(spotify_id)
+
+            year = r.randint(1950, 2023)
+            genres = r.sample(GENRES, r.choice((1, 1, 2, 3)))
+            main_genre = genres[0]
+            writer.writerow([
+                i, progression(r),
+                f"{year}-{r.randint(1, 12):02d}-{r.randint(1, 28):02d}" if r.random() < 0.7 else "",
+                " ".join(genres), year // 10 * 10,
+                r.choice(ROCK_GENRES) if "rock" in main_genre else "",
+                f"artist_{artist_numbers[artist]}", main_genre,
+                spotify_id, artist_spotify[artist] if spotify_id else "",
+            ])
+    return list(translations.values()), sorted(failures)
+
+
+def write_ratings(out, rng, r, n_ratings, titles):
+    """Will write song_ratings_data.csv, with loosely realistic audio features"""
+    n = n_ratings
+    danceability = rng.beta(5, 3, n)
+    energy = rng.beta(4, 2.5, n)
+    loudness = -np.abs(rng.normal(7, 4, n)) * (1.3 - energy)
+    acousticness = rng.beta(0.5, 1.5, n) * (1.2 - energy)
+    popularity = np.clip(
+        30 + 25 * danceability + 15 * energy + 1.5 * loudness + rng.normal(0, 18, n), 0, 100
+    ).astype(int)
+    columns = [
+        popularity,
+        rng.lognormal(np.log(215000), 0.3, n).astype(int),
+        np.clip(acousticness, 0, 1),
+        danceability,
+        energy,
+        np.where(rng.random(n) < 0.7, rng.random(n) * 1e-4, rng.beta(0.5, 2, n)),
+        rng.integers(0, 12, n),
+        rng.beta(1.5, 8, n),
+        loudness,
+        (rng.random(n) < 0.63).astype(int),
+        rng.beta(1, 12, n),
+        np.clip(rng.normal(120, 28, n), 40, 220),
+        np.where(rng.random(n) < 0.92, 4, rng.choice([3, 5, 1], n)),
+        rng.beta(2, 2, n),
+    ]
+    named = rng.random(n) < RATINGS_LINKED
+    song = rng.integers(0, len(titles), n)
+    with open(os.path.join(out, "song_ratings_data.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["song_name", "song_popularity", "song_duration_ms", "acousticness",
+                         "danceability", "energy", "instrumentalness", "key", "liveness", "loudness",
+                         "audio_mode", "speechiness", "tempo", "time_signature", "audio_valence"])
+        for start in range(0, n, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, n)
+            names = [titles[s] if k else title(r) for s, k in
+                     zip(song[start:stop].tolist(), named[start:stop].tolist())]
+            writer.writerows(zip(names, *(c[start:stop].tolist() for c in columns)))
+
+
+def write_mxm(out, rng, track_ids, translations, failures, n_words, words_per_song, lyrics_share=LYRICS_SHARE):
+    """Will write SongPop.db's words, lyrics, id_translations and id_failures tables, returning the lyrics row count"""
+    path = os.path.join(out, "SongPop.db")
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode = MEMORY")
+    con.execute("PRAGMA synchronous = OFF")
+    for statement in MXM_SCHEMA:
+        con.execute(statement)
+    vocabulary = make_vocabulary(n_words)
+    con.executemany("INSERT INTO words VALUES (?)", ((w,) for w in vocabulary))
+
+    con.execute(ID_TRANSLATIONS_SCHEMA)
+    con.executemany("INSERT INTO id_translations (track_id, artist_id, track_name, artist_name) "
+                    "VALUES (?, ?, ?, ?)", translations)
+    con.execute(ID_FAILURES_SCHEMA)
+    now = datetime.now(timezone.utc).isoformat()
+    con.executemany("INSERT INTO id_failures VALUES (?, 'not_found', 1, ?)",
+                    ((track_id, now) for track_id in failures))
+    con.commit()
+
+    cdf = np.cumsum(1 / np.arange(1, n_words + 1) ** ZIPF)
+    cdf /= cdf[-1]
+    with_lyrics = np.flatnonzero(rng.random(len(track_ids)) < lyrics_share)
+    mxm_tids = rng.choice(10 ** 7, len(with_lyrics), replace=False)
+    is_test = (rng.random(len(with_lyrics)) < LYRICS_TEST_SHARE).astype(int)
+    total = 0
+    for start in range(0, len(with_lyrics), CHUNK_SIZE // 100):
+        tracks = np.arange(start, min(start + CHUNK_SIZE // 100, len(with_lyrics)))
+        lengths = np.maximum(rng.lognormal(np.log(words_per_song), 0.5, len(tracks)).astype(int), 10)
+        ranks = np.searchsorted(cdf, rng.random(lengths.sum()))
+        keys = np.repeat(tracks, lengths) * n_words + ranks
+        keys, counts = np.unique(keys, return_counts=True)
+        owners, word_ids = keys // n_words, keys % n_words
+        con.executemany("INSERT INTO lyrics VALUES (?, ?, ?, ?, ?)", (
+            (track_ids[with_lyrics[t]], int(mxm_tids[t]), vocabulary[w], c, int(is_test[t]))
+            for t, w, c in zip(owners.tolist(), word_ids.tolist(), counts.tolist())
+        ))
+        con.commit()
+        total += len(keys)
+    con.close()
+    return total
+
+
+def source_env(out):
+    """Will return an environment pointing db/config.py at a generated data directory"""
+    out = os.path.abspath(out)
+    return dict(
+        os.environ,
+        DATA_DIR=out,
+        STAGING_DIR=out,
+        DB_PATH=os.path.join(out, "SongPop.db"),
+        METADATA_DB=os.path.join(out, "track_metadata.db"),
+        CHORDS_CSV=os.path.join(out, "Chordonomicon", "chordonomicon_v2.csv"),
+        RATINGS_CSV=os.path.join(out, "song_ratings_data.csv"),
+        SPOTIFY_CSV=os.path.join(out, "MSDandSPT", "Music Info.csv"),
+    )
+
+
+def generate(out, songs, chords=None, ratings=None, words=5000, words_per_song=200,
+             lyrics_share=LYRICS_SHARE, seed=0, build=True):
+    """Will write the synthetic sources to out (and build SongPop.db from them), returning row counts"""
+    os.makedirs(out, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    r = random.Random(seed)
+    chords = songs if chords is None else chords
+    ratings = songs // 2 if ratings is None else ratings
+    timings = {}
+
+    start = time.perf_counter()
+    track_ids, titles, artists = write_songs(out, rng, r, songs)
+    listed, spotify_ids = write_spotify(out, rng, track_ids, titles, artists)
+    translations, failures = write_chords(out, rng, r, chords, titles, artists, listed, spotify_ids)
+    write_ratings(out, rng, r, ratings, titles)
+    lyrics = write_mxm(out, rng, track_ids, translations, failures, words, words_per_song, lyrics_share)
+    timings["generate"] = time.perf_counter() - start
+
+    if build:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "build_db.py"], cwd=DB_DIR, check=True,
+                       env=source_env(out), stdout=subprocess.DEVNULL)
+        timings["build"] = time.perf_counter() - start
+
+    return {"songs": songs, "spotify": len(listed), "chords": chords, "id_translations": len(translations),
+            "id_failures": len(failures),
+            "ratings": ratings, "words": words, "lyrics": lyrics, "seconds": timings}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", required=True, help="directory to write the data to")
+    parser.add_argument("--songs", type=int, default=10000, help="MSD songs")
+    parser.add_argument("--chords", type=int, help="Chordonomicon rows (default: as many as songs)")
+    parser.add_argument("--ratings", type=int, help="ratings rows (default: half the songs)")
+    parser.add_argument("--words", type=int, default=5000, help="mxm vocabulary size")
+    parser.add_argument("--words-per-song", type=int, default=200,
+                        help="typical lyric length in words, before repeats are counted up")
+    parser.add_argument("--lyrics-share", type=float, default=LYRICS_SHARE,
+                        help="share of songs with lyrics (mxm covers about a quarter of the MSD)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-build", action="store_true", help="only write the sources")
+    args = parser.parse_args()
+
+    counts = generate(args.out, args.songs, args.chords, args.ratings, args.words,
+                      args.words_per_song, args.lyrics_share, args.seed, build=not args.no_build)
+    seconds = counts.pop("seconds")
+    print(", ".join(f"{value:,} {name}" for name, value in counts.items()))
+    print(", ".join(f"{name} {value:.1f}s" for name, value in seconds.items()))
+
+
+if __name__ == "__main__":
+    main()
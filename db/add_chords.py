@@ -1,16 +1,21 @@
-import csv
+import os
+import re
 import sqlite3
+import numpy as np
+import config
+import instrument
+from manifest import refresh
+from ingest import CHUNK_SIZE, insert_chunked, read_csv_rows, tune_for_bulk_load
 
-con = sqlite3.connect("/home/heinz/Documents/School/SUU/School/Machine Learning/MusicRatings/SongPop.db")
-cur = con.cursor()
-
-print("Removing previous table")
-cur.execute("DROP TABLE IF EXISTS chords")
-con.commit()
-print("Creating new table")
-cur.execute('''CREATE TABLE "chords" (
+TABLE = "chords"
+KEY = "song_id"
+# Each progression is parsed once here: "tokens" holds its chords as ids into
+# chord_vocab and "sections" its <verse_1>-style tags as (first token, id into
+# chord_sections) pairs, both packed as little-endian uint16 arrays
+SCHEMA = '''CREATE TABLE IF NOT EXISTS "chords" (
 	"song_id"	INTEGER,
-	"chords"	TEXT,
+	"tokens"	BLOB,
+	"sections"	BLOB,
 	"release_date"	TEXT,
 	"genres"	TEXT,
 	"decade"	INTEGER,
@@ -19,44 +24,118 @@ cur.execute('''CREATE TABLE "chords" (
 	"main_genre"	TEXT,
 	"spotify_song_id"	TEXT,
 	"spotify_artist_id"	TEXT
-);''')
-con.commit()
-
-print("Retrieving data")
-data = []
-file_name = "/home/heinz/Documents/School/SUU/School/Machine Learning/MusicRatings/Chordonomicon/chordonomicon_v2.csv"
-with open(file_name, newline='') as csvfile:
-    spamreader = csv.reader(csvfile)
-    # i = 0
-    for row in spamreader:
-        # print()
-        # for egg in row:
-        #     print(repr(egg))
-        # if i > 3:
-        #     break;
-        # print('\t'.join(row))
-        # insert into the rows database the records
-        # Blank values should be NULL in the database - that's what all the expressions are for
-        data.append({"song_id":             (row[0] if row[0] != '' else None),
-                    "chords":               (row[1] if row[1] != '' else None),
-                    "release_date":         (row[2] if row[2] != '' else None),
-                    "genres":               (row[3] if row[3] != '' else None),
-                    "decade":               (row[4] if row[4] != '' else None),
-                    "rock_genre":           (row[5] if row[5] != '' else None),
-                    "artist_id":            (row[6] if row[6] != '' else None),
-                    "main_genre":           (row[7] if row[7] != '' else None),
-                    "spotify_song_id":      (row[8] if row[8] != '' else None),
-                    "spotify_artist_id":    (row[9] if row[9] != '' else None)})
-        # print(data[i])
-        # i += 1
-
-data.pop(0)  # remove the first line
-# print(data[0:5])
-# exit()
-
-data = tuple(data)
-print("Adding values into the database")
-cur.executemany('''INSERT INTO chords VALUES (:song_id, :chords, :release_date, :genres, :decade, :rock_genre, :artist_id, :main_genre, :spotify_song_id, :spotify_artist_id)''', data)
-con.commit()
-
-con.close()
+);'''
+
+# Lookup tables replaced wholesale alongside the chords table
+LOOKUP_TABLES = {
+    "chord_vocab": '''CREATE TABLE IF NOT EXISTS "chord_vocab" (
+	"id"	INTEGER PRIMARY KEY,
+	"chord"	TEXT NOT NULL
+);''',
+    "chord_sections": '''CREATE TABLE IF NOT EXISTS "chord_sections" (
+	"id"	INTEGER PRIMARY KEY,
+	"section"	TEXT NOT NULL
+);''',
+}
+
+TOKEN_DTYPE = np.dtype("<u2")
+SECTION_TAG = re.compile(r"<([^>]+)>")
+
+
+class Tokenizer:
+    """Will turn chord strings into packed id arrays, growing both vocabularies as it goes
+
+    New ids are handed out in order of first appearance in the CSV, after the
+    ones already in use, so a chord keeps its id (and saved models keep
+    reading the blobs the same way) when the CSV changes.
+    """
+
+    def __init__(self, chords=None, sections=None):
+        self.chords = dict(chords or {})
+        self.sections = dict(sections or {})
+
+    @classmethod
+    def from_database(cls, db_path):
+        """Will start from the vocabularies of an existing database, if it has them"""
+        if not os.path.exists(db_path):
+            return cls()
+        # Other sources may be merging into it meanwhile, so wait out their locks
+        con = instrument.connect(f"file:{db_path}?mode=ro", uri=True, timeout=60)
+        try:
+            return cls(dict(con.execute("SELECT chord, id FROM chord_vocab")),
+                       dict(con.execute("SELECT section, id FROM chord_sections")))
+        except sqlite3.OperationalError:
+            # Built before chords were tokenized
+            return cls()
+        finally:
+            con.close()
+
+    @staticmethod
+    def _id(vocabulary, name):
+        if name not in vocabulary:
+            if len(vocabulary) > np.iinfo(TOKEN_DTYPE).max:
+                raise ValueError(f"More than {np.iinfo(TOKEN_DTYPE).max + 1:,} distinct values, can't pack as {TOKEN_DTYPE}")
+            vocabulary[name] = len(vocabulary)
+        return vocabulary[name]
+
+    def encode(self, text):
+        """Will return the (tokens, sections) blobs of one progression, or (None, None)"""
+        if text is None:
+            return None, None
+        # split() with a capturing group alternates text between tags and the tag names
+        parts = SECTION_TAG.split(text)
+        tokens = []
+        sections = []
+        for i, part in enumerate(parts):
+            if i % 2:
+                sections += [len(tokens), self._id(self.sections, part)]
+            else:
+                tokens += [self._id(self.chords, chord) for chord in part.split()]
+        return (np.array(tokens, dtype=TOKEN_DTYPE).tobytes(),
+                np.array(sections, dtype=TOKEN_DTYPE).tobytes())
+
+    def rows(self, rows):
+        """Will yield CSV rows with the chords column replaced by its two blobs"""
+        for row in rows:
+            yield row[:1] + self.encode(row[1]) + row[2:]
+
+
+def load(db_path, file_name, base_path=config.DB_PATH):
+    """Will (re)build the chords table and its vocabularies in db_path from the Chordonomicon CSV
+
+    Ids already used by base_path's vocabularies are kept.
+    """
+    con = instrument.connect(db_path)
+    tune_for_bulk_load(con)
+    cur = con.cursor()
+
+    print("Removing previous tables")
+    for table in [TABLE] + list(LOOKUP_TABLES):
+        cur.execute(f"DROP TABLE IF EXISTS {table}")
+    con.commit()
+    print("Creating new tables")
+    cur.execute(SCHEMA)
+    for schema in LOOKUP_TABLES.values():
+        cur.execute(schema)
+    con.commit()
+
+    # Rows are streamed straight from the CSV into the table in fixed-size
+    # chunks, so memory use doesn't grow with the size of the file; only the
+    # vocabularies are kept until the end
+    print("Adding values into the database")
+    tokenizer = Tokenizer.from_database(base_path)
+    rows = tokenizer.rows(read_csv_rows(file_name, 10))
+    insert_chunked(con, '''INSERT INTO chords VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows, CHUNK_SIZE, "chords")
+
+    with instrument.stage("vocabularies") as s:
+        cur.executemany("INSERT INTO chord_vocab VALUES (?, ?)", ((i, c) for c, i in tokenizer.chords.items()))
+        cur.executemany("INSERT INTO chord_sections VALUES (?, ?)", ((i, tag) for tag, i in tokenizer.sections.items()))
+        con.commit()
+        s.rows_out = len(tokenizer.chords) + len(tokenizer.sections)
+    print(f"{len(tokenizer.chords):,} distinct chords, {len(tokenizer.sections):,} distinct section tags")
+
+    con.close()
+
+
+if __name__ == "__main__":
+    refresh("add_chords", config.CHORDS_CSV)
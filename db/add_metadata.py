@@ -1,15 +1,12 @@
-import sqlite3
+import config
+import instrument
+from manifest import refresh
 
-songpop = "/home/heinz/Documents/School/SUU/School/Machine Learning/MusicRatings/SongPop.db"
-metadata = "/home/heinz/Documents/School/SUU/School/Machine Learning/MusicRatings/track_metadata.db"
-
-con3 = sqlite3.connect(songpop)
-
-print("Removing previous table")
-con3.execute("DROP TABLE IF EXISTS songs")
-con3.commit()
-print("Creating new table")
-con3.execute('''CREATE TABLE "songs" (
+TABLE = "songs"
+KEY = "track_id"
+# track_metadata.db already has a songs table, so it can be synced from without staging
+ATTACH_SOURCE = True
+SCHEMA = '''CREATE TABLE IF NOT EXISTS "songs" (
 	"track_id"	text,
 	"title"	text,
 	"song_id"	text,
@@ -25,12 +22,28 @@ con3.execute('''CREATE TABLE "songs" (
 	"shs_perf"	int,
 	"shs_work"	int,
 	PRIMARY KEY("track_id")
-);''')
-con3.commit()
+);'''
+
+
+def load(songpop, metadata):
+    """Will (re)build the songs table in songpop by copying track_metadata.db"""
+    con3 = instrument.connect(songpop)
+
+    print("Removing previous table")
+    con3.execute("DROP TABLE IF EXISTS songs")
+    con3.commit()
+    print("Creating new table")
+    con3.execute(SCHEMA)
+    con3.commit()
+
+    print("Copying data")
+    con3.execute("ATTACH ? as dba", (metadata,))
+    with instrument.stage("copy:songs") as s:
+        s.rows_out = con3.execute("INSERT or IGNORE INTO songs SELECT * FROM dba.songs").rowcount
+        con3.commit()
+    con3.execute("detach database dba")
+    con3.close()
+
 
-print("Copying data")
-con3.execute("ATTACH '" + metadata +  "' as dba")
-con3.execute("INSERT or IGNORE INTO songs SELECT * FROM dba.songs")
-con3.commit()
-con3.execute("detach database dba")
-con3.close()
+if __name__ == "__main__":
+    refresh("add_metadata", config.METADATA_DB)
@@ -0,0 +1,125 @@
+import config
+import instrument
+import match_songs
+
+# Same normalization the model used to apply in pandas, kept as generated
+# columns so they never go stale when the source tables are upserted
+NORMALIZED_COLUMNS = {
+    "songs": {"title_norm": "title", "artist_norm": "artist_name"},
+    "id_translations": {"title_norm": "track_name", "artist_norm": "artist_name"},
+}
+
+INDEXES = {
+    "chords_spotify_ids": "chords(spotify_song_id, spotify_artist_id)",
+    "id_translations_ids": "id_translations(track_id, artist_id)",
+    "songs_norm": "songs(title_norm, artist_norm)",
+    "lyrics_track": "lyrics(track_id, is_test)",
+}
+
+# Exact join on the normalized columns, used when fuzzy matching is off
+TRAINING_SET = '''CREATE TABLE "training_set" AS
+SELECT
+	s.track_id,
+	s.title,
+	s.artist_name,
+	s.duration,
+	s.year,
+	s.artist_hotttnesss,
+	s.artist_familiarity,
+	c.tokens AS chord_tokens
+FROM chords c
+JOIN id_translations t
+	ON t.track_id = c.spotify_song_id AND t.artist_id = c.spotify_artist_id
+JOIN songs s
+	ON s.title_norm = t.title_norm AND s.artist_norm = t.artist_norm
+WHERE c.spotify_song_id IS NOT NULL
+AND s.title IS NOT NULL
+ORDER BY c.rowid, s.rowid;'''
+
+# Join through the fuzzy links built by match_songs.py
+TRAINING_SET_LINKED = '''CREATE TABLE "training_set" AS
+SELECT
+	s.track_id,
+	s.title,
+	s.artist_name,
+	s.duration,
+	s.year,
+	s.artist_hotttnesss,
+	s.artist_familiarity,
+	c.tokens AS chord_tokens
+FROM chords c
+JOIN id_translations t
+	ON t.track_id = c.spotify_song_id AND t.artist_id = c.spotify_artist_id
+JOIN song_links k
+	ON k.spotify_id = t.track_id
+JOIN songs s
+	ON s.track_id = k.track_id
+WHERE c.spotify_song_id IS NOT NULL
+AND s.title IS NOT NULL
+ORDER BY c.rowid, s.rowid;'''
+
+
+def norm_expression(column):
+    """Will return the SQL that lowercases and strips a text column"""
+    return f"lower(trim(\"{column}\", ' ' || char(9, 10, 13)))"
+
+
+def add_normalized_columns(con):
+    """Will add the generated title_norm/artist_norm columns where they are missing"""
+    for table, columns in NORMALIZED_COLUMNS.items():
+        existing = {c[1] for c in con.execute(f"PRAGMA table_xinfo({table})").fetchall()}
+        for name, source in columns.items():
+            if name not in existing:
+                print(f"Adding {table}.{name}")
+                con.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {name} TEXT "
+                    f"GENERATED ALWAYS AS ({norm_expression(source)}) VIRTUAL"
+                )
+    con.commit()
+
+
+def exists(con):
+    """Will check whether training_set has been materialized"""
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'training_set'"
+    ).fetchone() is not None
+
+
+def build(con, fuzzy=config.FUZZY_MATCH):
+    """Will index the join keys and materialize the joined training_set table
+
+    With fuzzy, songs are linked by match_songs.py first and joined through
+    song_links; otherwise the join is exact on the normalized columns.
+    """
+    tables = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    missing = {"songs", "chords", "id_translations", "lyrics"} - tables
+    if missing:
+        print(f"Skipping training_set, missing tables: {', '.join(sorted(missing))}")
+        return
+
+    add_normalized_columns(con)
+
+    print("Creating join indexes")
+    with instrument.stage("join_indexes"):
+        for name, target in INDEXES.items():
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        con.commit()
+
+    if fuzzy:
+        print("Linking songs")
+        match_songs.build(con)
+
+    print("Materializing training_set")
+    with instrument.stage("training_set") as s:
+        con.execute("DROP TABLE IF EXISTS training_set")
+        con.execute(TRAINING_SET_LINKED if fuzzy else TRAINING_SET)
+        con.execute("CREATE INDEX training_set_track ON training_set(track_id)")
+        con.commit()
+        count = s.rows_out = con.execute("SELECT count(*) FROM training_set").fetchone()[0]
+    print(f"training_set has {count:,} rows")
+
+
+if __name__ == "__main__":
+    con = instrument.connect(config.DB_PATH)
+    build(con)
+    con.close()
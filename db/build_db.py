@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""Builds every SongPop.db table at once, staging each source in its own database"""
+import importlib
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import add_training_set
+import config
+import instrument
+import song_search
+from ingest import tune_for_merge
+from manifest import check_source, sync_from
+
+# (loader module, source path) - each module exposes TABLE, KEY, SCHEMA and load()
+SOURCES = [
+    ("add_metadata", config.METADATA_DB),
+    ("add_chords", config.CHORDS_CSV),
+    ("add_ratings", config.RATINGS_CSV),
+    ("add_spotify", config.SPOTIFY_CSV),
+]
+
+
+def stage(loader, source, staging_dir):
+    """Will run one loader against its own staging database and return that path"""
+    start = time.perf_counter()
+    staging_path = os.path.join(staging_dir, f"{loader}.db")
+    # Runs in a worker process, so it is recorded there with its own pid
+    with instrument.stage(f"load:{loader}"):
+        importlib.import_module(loader).load(staging_path, source)
+    return staging_path, time.perf_counter() - start
+
+
+def main():
+    """Will parse all changed sources in parallel, then merge them into SongPop.db as they finish"""
+    start = time.perf_counter()
+    # The staging databases are bulk loaded; SongPop.db keeps its journal and syncs
+    con = instrument.connect(config.DB_PATH)
+    tune_for_merge(con)
+
+    pending = {}
+    with instrument.stage("check_sources"):
+        for loader, source in SOURCES:
+            unchanged, fingerprint = check_source(con, loader, source)
+            if unchanged:
+                print(f"{source} is unchanged, skipping {loader}")
+            else:
+                pending[loader] = (source, fingerprint)
+
+    # Sources that are already databases don't need parsing, so they are
+    # synced straight from the file while the others are being staged
+    attached = [
+        loader for loader in pending
+        if getattr(importlib.import_module(loader), "ATTACH_SOURCE", False)
+    ]
+    with tempfile.TemporaryDirectory(dir=config.STAGING_DIR) as staging_dir:
+        with ProcessPoolExecutor(max_workers=max(len(pending) - len(attached), 1)) as pool:
+            futures = {
+                pool.submit(stage, loader, source, staging_dir): loader
+                for loader, (source, _) in pending.items() if loader not in attached
+            }
+            for loader in attached:
+                source, fingerprint = pending[loader]
+                sync_from(con, importlib.import_module(loader), source, loader, fingerprint)
+
+            # Merges run one at a time on this connection while the
+            # slower sources are still being parsed
+            for future in as_completed(futures):
+                loader = futures[future]
+                staging_path, elapsed = future.result()
+                print(f"Staged {loader} in {elapsed:.1f}s, merging")
+                sync_from(con, importlib.import_module(loader), staging_path, loader, pending[loader][1])
+
+    if pending or not add_training_set.exists(con):
+        add_training_set.build(con)
+    if pending or not song_search.exists(con):
+        song_search.build(con)
+
+    con.close()
+    print(f"Build complete in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,21 @@
+"""Paths to SongPop.db and its source files, read from the environment or a .env file"""
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Everything defaults to living in one data directory, but each path can be
+# overridden on its own
+DATA_DIR = os.getenv("DATA_DIR", "/home/heinz/Documents/School/SUU/School/Machine Learning/MusicRatings")
+
+DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "SongPop.db"))
+METADATA_DB = os.getenv("METADATA_DB", os.path.join(DATA_DIR, "track_metadata.db"))
+CHORDS_CSV = os.getenv("CHORDS_CSV", os.path.join(DATA_DIR, "Chordonomicon", "chordonomicon_v2.csv"))
+RATINGS_CSV = os.getenv("RATINGS_CSV", os.path.join(DATA_DIR, "song_ratings_data.csv"))
+SPOTIFY_CSV = os.getenv("SPOTIFY_CSV", os.path.join(DATA_DIR, "MSDandSPT", "Music Info.csv"))
+
+# Where the parallel build keeps its per-source staging databases
+STAGING_DIR = os.getenv("STAGING_DIR", DATA_DIR)
+
+# Link chords to songs with match_songs.py's fuzzy matching (0 for the exact join)
+FUZZY_MATCH = os.getenv("FUZZY_MATCH", "1") != "0"
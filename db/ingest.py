@@ -0,0 +1,86 @@
+"""Streaming helpers shared by the db/add_*.py loaders"""
+import csv
+import os
+import time
+from itertools import islice
+import config
+import instrument
+
+CHUNK_SIZE = 50000
+
+# Only for the loaders' staging databases: those are rebuilt from the source
+# files if anything goes wrong, so durability can be traded for speed while
+# they load. SongPop.db also holds lyrics, words and id_translations, which
+# can't be rebuilt, so it always keeps the default journal and sync settings
+BULK_PRAGMAS = (
+    "PRAGMA journal_mode = MEMORY",
+    "PRAGMA synchronous = OFF",
+)
+# Safe on any database - they only size the page cache and keep temporary b-trees in memory
+CACHE_PRAGMAS = (
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -200000",
+)
+
+
+def database_path(con):
+    """Will return the file a connection's main database is in ("" for an in-memory one)"""
+    return con.execute("PRAGMA database_list").fetchone()[2]
+
+
+def tune_for_bulk_load(con):
+    """Will apply the bulk-load pragmas to a connection on a throwaway staging database
+
+    Raises ValueError for a connection on SongPop.db itself.
+    """
+    path = database_path(con)
+    if path and os.path.exists(config.DB_PATH) and os.path.samefile(path, config.DB_PATH):
+        raise ValueError(f"Refusing to turn off journaling and syncing on {config.DB_PATH}")
+    for pragma in BULK_PRAGMAS + CACHE_PRAGMAS:
+        con.execute(pragma)
+
+
+def tune_for_merge(con):
+    """Will size the page cache of a connection on SongPop.db, keeping it durable"""
+    for pragma in CACHE_PRAGMAS:
+        con.execute(pragma)
+
+
+def read_csv_rows(file_name, width, blank_as_null=True):
+    """Will yield each data row of a CSV file as a tuple, skipping the header"""
+    with open(file_name, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)  # skip the header
+        for row in reader:
+            row = row[:width]
+            if len(row) < width:
+                row += [''] * (width - len(row))
+            if blank_as_null:
+                # Blank values should be NULL in the database
+                yield tuple(value if value != '' else None for value in row)
+            else:
+                yield tuple(row)
+
+
+def insert_chunked(con, sql, rows, chunk_size=CHUNK_SIZE, label="rows"):
+    """Will insert rows from an iterator in fixed-size transactions, reporting rows/sec"""
+    cur = con.cursor()
+    total = 0
+    start = time.perf_counter()
+    rows = iter(rows)
+    with instrument.stage(f"insert:{label}") as s:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            # executemany opens the transaction, commit closes it
+            cur.executemany(sql, chunk)
+            con.commit()
+            total += len(chunk)
+            elapsed = time.perf_counter() - start
+            print(f"  {total:,} {label} ({total / elapsed:,.0f} rows/sec)")
+        s.rows_in = s.rows_out = total
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else 0.0
+    print(f"Inserted {total:,} {label} in {elapsed:.1f}s ({rate:,.0f} rows/sec)")
+    return total
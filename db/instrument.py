@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+"""Per-stage wall time, CPU time, peak RSS, rows and SQLite time for the loaders and models
+
+Tracing is off unless STAGE_TRACE names a trace file. Then every stage
+
+    with instrument.stage("featurize", rows_in=len(df)) as s:
+        ...
+        s.rows_out = len(features)
+
+appends one JSON line to that file when it ends, and a summary table of the
+process's stages is printed to stderr at exit. Stages nest, and are recorded
+by their path ("train/search"). Connections opened with instrument.connect()
+count the time spent in their statements (and fetching their rows) towards
+every stage open at the time, on any thread.
+
+STAGE_PROFILE=name,... also profiles the stages with those names, writing a
+report next to the trace file - with pyinstrument's sampling profiler when it
+is installed (STAGE_PROFILER=cprofile for cProfile's .prof files instead).
+
+    instrument.py TRACE_FILE    summarize a trace file, across all its processes
+"""
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+TRACE_PATH = os.getenv("STAGE_TRACE")
+PROFILE_STAGES = set(filter(None, os.getenv("STAGE_PROFILE", "").split(",")))
+PROFILER = os.getenv("STAGE_PROFILER", "pyinstrument")
+ENABLED = bool(TRACE_PATH)
+
+# ru_maxrss is in kilobytes on Linux but bytes on macOS
+RSS_SCALE = 1 << 20 if sys.platform == "darwin" else 1 << 10
+
+COLUMNS = ["wall_s", "cpu_s", "sqlite_s", "statements", "rows_in", "rows_out", "peak_rss_mb"]
+
+_active = []
+_lock = threading.Lock()
+_totals = {}
+
+
+def peak_rss_mb():
+    """Will return the process's peak resident set size so far, in MB"""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / RSS_SCALE
+
+
+class NullStage:
+    """What stage() hands out when tracing is off - row counts set on it are ignored"""
+    rows_in = rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """One timed run of a named stage"""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.sqlite_seconds = 0.0
+        self.statements = 0
+        self.profiler = None
+
+    def __enter__(self):
+        with _lock:
+            self.path = "/".join([s.name for s in _active] + [self.name])
+            _active.append(self)
+        if self.name in PROFILE_STAGES:
+            self.profiler = start_profiler()
+        self.started = time.time()
+        self.peak_before = peak_rss_mb()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        peak = peak_rss_mb()
+        with _lock:
+            _active.remove(self)
+        record = {
+            "stage": self.path,
+            "script": os.path.basename(sys.argv[0]),
+            "pid": os.getpid(),
+            "started": self.started,
+            "wall_s": wall,
+            # Summed over all of the process's threads, so it can exceed wall_s
+            "cpu_s": cpu,
+            "sqlite_s": self.sqlite_seconds,
+            "statements": self.statements,
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "peak_rss_mb": peak,
+            # How far this stage pushed the peak up
+            "rss_growth_mb": None if peak is None else peak - self.peak_before,
+            "error": exc_type.__name__ if exc_type else None,
+        }
+        if self.profiler is not None:
+            record["profile"] = stop_profiler(self.profiler, self.path)
+        write(record)
+        return False
+
+
+def stage(name, rows_in=None):
+    """Will return a context manager timing one stage (a shared no-op when tracing is off)"""
+    if not ENABLED:
+        return NULL_STAGE
+    return Stage(name, rows_in)
+
+
+def write(record):
+    """Will append a record to the trace file and add it to this process's totals"""
+    # Worker processes append to the same file; one short write per line keeps lines whole
+    with open(TRACE_PATH, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    with _lock:
+        if not _totals:
+            atexit.register(print_summary, _totals)
+        add_to(_totals, record)
+
+
+def add_to(totals, record):
+    """Will fold one stage record into {path: totals}"""
+    entry = totals.setdefault(record["stage"], dict.fromkeys(["calls"] + COLUMNS))
+    entry["calls"] = (entry["calls"] or 0) + 1
+    for column in COLUMNS:
+        value = record.get(column)
+        if value is None:
+            continue
+        if column == "peak_rss_mb":
+            entry[column] = max(entry[column] or 0, value)
+        else:
+            entry[column] = (entry[column] or 0) + value
+
+
+def print_summary(totals, file=None):
+    """Will print one line per stage path, in the order the stages first ended"""
+    file = file or sys.stderr
+    width = max([len(path) for path in totals] + [5])
+    print(f"\n{'stage':<{width}}  {'calls':>5}  {'wall s':>8}  {'cpu s':>8}  {'sqlite s':>8}  "
+          f"{'stmts':>7}  {'rows in':>10}  {'rows out':>10}  {'peak MB':>8}", file=file)
+    print("-" * (width + 85), file=file)
+    for path, entry in totals.items():
+        cells = [
+            f"{entry['calls']:>5}",
+            *(f"{entry[c]:>8.2f}" if entry[c] is not None else f"{'':>8}" for c in ("wall_s", "cpu_s", "sqlite_s")),
+            f"{entry['statements'] or 0:>7,}",
+            *(f"{entry[c]:>10,}" if entry[c] is not None else f"{'':>10}" for c in ("rows_in", "rows_out")),
+            f"{entry['peak_rss_mb']:>8.0f}" if entry["peak_rss_mb"] is not None else f"{'':>8}",
+        ]
+        print(f"{path:<{width}}  " + "  ".join(cells), file=file)
+
+
+def add_sqlite_time(seconds, statements=0):
+    """Will count statement time towards every open stage"""
+    with _lock:
+        for s in _active:
+            s.sqlite_seconds += seconds
+            s.statements += statements
+
+
+def timed(method, statements=0):
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            add_sqlite_time(time.perf_counter() - start, statements)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class TimedCursor(sqlite3.Cursor):
+    """A cursor whose statements and fetches count towards the open stages"""
+    execute = timed(sqlite3.Cursor.execute, 1)
+    executemany = timed(sqlite3.Cursor.executemany, 1)
+    executescript = timed(sqlite3.Cursor.executescript, 1)
+    fetchone = timed(sqlite3.Cursor.fetchone)
+    fetchmany = timed(sqlite3.Cursor.fetchmany)
+    fetchall = timed(sqlite3.Cursor.fetchall)
+    __next__ = timed(sqlite3.Cursor.__next__)
+
+
+class TimedConnection(sqlite3.Connection):
+    """A connection that hands out TimedCursors, including for its execute shortcuts"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+    # commit is where a bulk load's writes reach the file
+    commit = timed(sqlite3.Connection.commit)
+
+
+def connect(database, **kwargs):
+    """Will open a sqlite3 connection, with its statements timed while tracing"""
+    if ENABLED:
+        kwargs.setdefault("factory", TimedConnection)
+    return sqlite3.connect(database, **kwargs)
+
+
+def start_profiler():
+    """Will start a profiler for one stage: pyinstrument if it's available, cProfile otherwise"""
+    if PROFILER == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            pass
+        else:
+            # Samples only the thread that opened the stage
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profiler(profiler, path):
+    """Will stop a stage's profiler and return where its report was written"""
+    base = f"{TRACE_PATH}.{path.replace('/', '.')}.{os.getpid()}.{time.time_ns()}"
+    if hasattr(profiler, "output_text"):
+        profiler.stop()
+        report = base + ".txt"
+        with open(report, "w") as f:
+            f.write(profiler.output_text(unicode=False, color=False))
+    else:
+        profiler.disable()
+        # Read with `python -m pstats` or snakeviz
+        report = base + ".prof"
+        profiler.dump_stats(report)
+    return report
+
+
+def summarize(path, file=None):
+    """Will print the summary table of every stage in a trace file"""
+    totals = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                add_to(totals, json.loads(line))
+    print_summary(totals, file or sys.stdout)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit(__doc__.splitlines()[-1].strip())
+    summarize(sys.argv[1])
@@ -0,0 +1,190 @@
+"""Tracks which source files SongPop.db was built from, and applies only what changed"""
+import hashlib
+import importlib
+import os
+import sqlite3
+import tempfile
+import time
+from types import SimpleNamespace
+from datetime import datetime, timezone
+import config
+import instrument
+from ingest import tune_for_merge
+
+MANIFEST_SCHEMA = '''CREATE TABLE IF NOT EXISTS "ingest_manifest" (
+	"source"	TEXT,
+	"path"	TEXT,
+	"size"	INTEGER,
+	"mtime"	REAL,
+	"sha256"	TEXT,
+	"ingested_at"	TEXT,
+	PRIMARY KEY("source")
+);'''
+
+
+def file_hash(path, block_size=1 << 20):
+    """Will return the sha256 of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_source(con, source, path):
+    """Will return (unchanged, fingerprint) for a source file against the manifest"""
+    con.execute(MANIFEST_SCHEMA)
+    stat = os.stat(path)
+    row = con.execute(
+        "SELECT size, mtime, sha256 FROM ingest_manifest WHERE source = ?", (source,)
+    ).fetchone()
+    fingerprint = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime}
+
+    # Same size and mtime is trusted without reading the file again
+    if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        fingerprint["sha256"] = row[2]
+        return True, fingerprint
+
+    fingerprint["sha256"] = file_hash(path)
+    unchanged = row is not None and row[0] == stat.st_size and row[2] == fingerprint["sha256"]
+    if unchanged:
+        # Touched but not changed - remember the new mtime so it isn't hashed again next time
+        con.execute(
+            "UPDATE ingest_manifest SET path = ?, mtime = ? WHERE source = ?",
+            (path, stat.st_mtime, source),
+        )
+        con.commit()
+    return unchanged, fingerprint
+
+
+def record_source(con, source, fingerprint):
+    """Will store a source's fingerprint in the manifest, in the open transaction if there is one"""
+    con.execute(MANIFEST_SCHEMA)
+    con.execute(
+        "INSERT OR REPLACE INTO ingest_manifest VALUES (?, ?, ?, ?, ?, ?)",
+        (source, fingerprint["path"], fingerprint["size"], fingerprint["mtime"],
+         fingerprint["sha256"], datetime.now(timezone.utc).isoformat()),
+    )
+
+
+def has_unique_key(con, table, key):
+    """Will check whether a table already has a unique index on exactly one key column"""
+    for index in con.execute(f"PRAGMA index_list({table})").fetchall():
+        if not index[2]:
+            continue
+        columns = [c[2] for c in con.execute(f"PRAGMA index_info({index[1]})").fetchall()]
+        if columns == [key]:
+            return True
+    return False
+
+
+def ensure_table(con, module):
+    """Will create a loader's table if needed, with a unique index on its natural key"""
+    con.execute(module.SCHEMA)
+    if module.KEY is None or has_unique_key(con, module.TABLE, module.KEY):
+        return
+    try:
+        con.execute(
+            f"CREATE UNIQUE INDEX {module.TABLE}_{module.KEY} ON {module.TABLE}({module.KEY})"
+        )
+    except sqlite3.IntegrityError:
+        # Tables from the old full reloads can hold duplicate keys - start over
+        print(f"Duplicate {module.KEY} values in {module.TABLE}, recreating table")
+        con.execute(f"DROP TABLE {module.TABLE}")
+        con.execute(module.SCHEMA)
+        con.execute(
+            f"CREATE UNIQUE INDEX {module.TABLE}_{module.KEY} ON {module.TABLE}({module.KEY})"
+        )
+
+
+def columns_of(con, table, schema="main"):
+    """Will return a table's column names, in order"""
+    return [c[1] for c in con.execute(f"PRAGMA {schema}.table_info({table})").fetchall()]
+
+
+def sync_table(con, module, schema):
+    """Will upsert a table from an attached schema, deleting rows that disappeared
+
+    Doesn't commit, so the caller decides what the transaction covers.
+    """
+    table, key = module.TABLE, module.KEY
+    if columns_of(con, table) not in ([], columns_of(con, table, schema)):
+        # The loader's schema changed since the table was built - start over
+        print(f"Columns of {table} changed, recreating table")
+        con.execute(f"DROP TABLE {table}")
+    ensure_table(con, module)
+    before = con.total_changes
+
+    with instrument.stage(f"sync:{table}") as s:
+        if key is None:
+            # No natural key to match rows on, so the table is replaced wholesale
+            con.execute(f"DELETE FROM {table}")
+            con.execute(f"INSERT INTO {table} SELECT * FROM {schema}.{table}")
+        else:
+            columns = columns_of(con, table)
+            others = [c for c in columns if c != key]
+            updates = ", ".join(f'"{c}" = excluded."{c}"' for c in others)
+            changed = " OR ".join(f'"{c}" IS NOT excluded."{c}"' for c in others)
+            # Unchanged rows match the conflict but skip the update, so they aren't rewritten
+            con.execute(f"""
+                INSERT INTO {table} SELECT * FROM {schema}.{table} WHERE {key} IS NOT NULL
+                ON CONFLICT({key}) DO UPDATE SET {updates} WHERE {changed}
+            """)
+            con.execute(f"""
+                DELETE FROM {table}
+                WHERE {key} IS NULL
+                OR {key} NOT IN (SELECT {key} FROM {schema}.{table} WHERE {key} IS NOT NULL)
+            """)
+        s.rows_out = con.total_changes - before
+    print(f"Applied {con.total_changes - before:,} row changes to {table}")
+
+
+def sync_from(con, module, db_path, loader, fingerprint):
+    """Will sync a loader's table, and any lookup tables it has, from another database file
+
+    Everything - the tables and the loader's manifest entry - is written in
+    one transaction, so a crash part way leaves SongPop.db as it was.
+    """
+    con.execute("ATTACH ? as staging", (db_path,))
+    con.execute("BEGIN")
+    try:
+        # Lookup tables have no natural key to upsert on, so they are replaced wholesale
+        for table, table_schema in getattr(module, "LOOKUP_TABLES", {}).items():
+            sync_table(con, SimpleNamespace(TABLE=table, KEY=None, SCHEMA=table_schema), "staging")
+        sync_table(con, module, "staging")
+        record_source(con, loader, fingerprint)
+        con.commit()
+    except BaseException:
+        con.rollback()
+        raise
+    finally:
+        con.execute("detach database staging")
+
+
+def refresh(loader, source, db_path=None):
+    """Will bring one table up to date with its source, skipping it if unchanged"""
+    db_path = db_path or config.DB_PATH
+    start = time.perf_counter()
+    module = importlib.import_module(loader)
+    con = instrument.connect(db_path)
+    tune_for_merge(con)
+
+    with instrument.stage("check_source"):
+        unchanged, fingerprint = check_source(con, loader, source)
+    if unchanged:
+        print(f"{source} is unchanged, skipping {module.TABLE}")
+        con.close()
+        return
+
+    if getattr(module, "ATTACH_SOURCE", False):
+        # The source is already a database with the same table, so sync from it directly
+        sync_from(con, module, source, loader, fingerprint)
+    else:
+        with tempfile.TemporaryDirectory(dir=config.STAGING_DIR) as staging_dir:
+            staging_path = os.path.join(staging_dir, f"{loader}.db")
+            with instrument.stage(f"load:{loader}"):
+                module.load(staging_path, source)
+            sync_from(con, module, staging_path, loader, fingerprint)
+
+    con.close()
+    print(f"Refreshed {module.TABLE} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+"""Fuzzy-links Spotify tracks (id_translations) to MSD songs (songs)
+
+Names are normalized aggressively (accents, bracketed and " - Remastered"
+style suffixes, "feat." credits, punctuation, a leading "The" on artists),
+then blocked with MinHash LSH over character trigrams of "artist title":
+each side is bucketed by bands of its MinHash signature, and only pairs
+sharing a bucket are compared. Candidates are scored with a string
+similarity of title and artist, and the best MSD song per Spotify track is
+written to the song_links table when its score clears MIN_SCORE.
+"""
+import re
+import time
+import unicodedata
+from difflib import SequenceMatcher
+import numpy as np
+import config
+import instrument
+try:
+    from rapidfuzz.fuzz import ratio as _rapidfuzz_ratio
+except ImportError:
+    _rapidfuzz_ratio = None
+
+NUM_PERM = 32
+BANDS = 8
+# Buckets bigger than this are too common to say anything and are skipped
+MAX_BUCKET = 200
+# Pairs whose signatures agree on fewer hashes than this (an estimate of
+# trigram Jaccard similarity) aren't worth a string comparison
+MIN_JACCARD = 0.4
+MIN_SCORE = 0.85
+TITLE_WEIGHT = 0.6
+
+LINKS_SCHEMA = '''CREATE TABLE "song_links" (
+	"spotify_id"	TEXT PRIMARY KEY,
+	"track_id"	TEXT NOT NULL,
+	"score"	REAL NOT NULL,
+	"exact"	INTEGER NOT NULL
+)'''
+
+BRACKETS = re.compile(r"\s*[(\[{][^)\]}]*[)\]}]")
+DASH_SUFFIX = re.compile(
+    r"\s+-\s+.*\b(remaster(ed)?|version|edit|mix|remix|live|mono|stereo|demo|single|radio|acoustic|instrumental)\b.*$"
+)
+FEATURING = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s.*$")
+NOT_WORD = re.compile(r"[^\w\s]")
+SPACES = re.compile(r"\s+")
+
+_rng = np.random.default_rng(20240501)
+_MULTIPLIERS = _rng.integers(1, 2 ** 32, NUM_PERM, dtype=np.uint64) | np.uint64(1)
+_OFFSETS = _rng.integers(0, 2 ** 32, NUM_PERM, dtype=np.uint64)
+_MASK = np.uint64(0xFFFFFFFF)
+
+
+def normalize_name(text, artist=False):
+    """Will reduce a title or artist name to a comparable form"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = BRACKETS.sub(" ", text)
+    text = DASH_SUFFIX.sub("", text)
+    text = FEATURING.sub("", text)
+    text = text.replace("&", " and ")
+    text = SPACES.sub(" ", NOT_WORD.sub("", text)).strip()
+    if artist and text.startswith("the "):
+        text = text[4:]
+    return text
+
+
+def minhash(texts):
+    """Will return a (len(texts), NUM_PERM) uint32 MinHash signature of each text's trigrams"""
+    if not texts:
+        return np.empty((0, NUM_PERM), dtype=np.uint32)
+    padded = [f"  {t} ".encode("utf-8") for t in texts]
+    lengths = np.fromiter((len(p) for p in padded), dtype=np.int64, count=len(padded))
+    buffer = np.frombuffer(b"".join(padded), dtype=np.uint8).astype(np.uint64)
+    codes = (buffer[:-2] << np.uint64(16)) | (buffer[1:-1] << np.uint64(8)) | buffer[2:]
+
+    # Only trigrams that start and end inside the same text
+    counts = lengths - 2
+    firsts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    positions = np.arange(counts.sum()) - np.repeat(offsets - firsts, counts)
+    codes = codes[positions]
+    codes = (codes * np.uint64(0x9E3779B1)) & _MASK
+    codes ^= codes >> np.uint64(15)
+
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    for k in range(NUM_PERM):
+        hashed = (codes * _MULTIPLIERS[k] + _OFFSETS[k]) & _MASK
+        signatures[:, k] = np.minimum.reduceat(hashed, offsets)
+    return signatures
+
+
+def band_keys(signatures):
+    """Will fold each band of a signature into one uint64 bucket key, (n, BANDS)"""
+    rows = NUM_PERM // BANDS
+    keys = np.zeros((len(signatures), BANDS), dtype=np.uint64)
+    for band in range(BANDS):
+        for j in range(rows):
+            keys[:, band] = (keys[:, band] * np.uint64(0x100000001B3)) ^ signatures[:, band * rows + j]
+    return keys
+
+
+def candidate_pairs(query_keys, index_keys):
+    """Will return the distinct (query row, index row) pairs that share an LSH bucket"""
+    import pandas as pd
+    index = pd.DataFrame({
+        "band": np.repeat(np.arange(BANDS), len(index_keys)),
+        "key": index_keys.T.ravel(),
+        "i": np.tile(np.arange(len(index_keys)), BANDS),
+    })
+    sizes = index.groupby(["band", "key"])["i"].transform("size")
+    index = index[sizes <= MAX_BUCKET]
+    query = pd.DataFrame({
+        "band": np.repeat(np.arange(BANDS), len(query_keys)),
+        "key": query_keys.T.ravel(),
+        "q": np.tile(np.arange(len(query_keys)), BANDS),
+    })
+    pairs = query.merge(index, on=["band", "key"])[["q", "i"]].drop_duplicates()
+    return pairs["q"].to_numpy(), pairs["i"].to_numpy()
+
+
+def similarity(a, b):
+    """Will return a 0-1 similarity of two normalized names"""
+    if a == b:
+        return 1.0
+    if _rapidfuzz_ratio is not None:
+        return _rapidfuzz_ratio(a, b) / 100
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+def match(con):
+    """Will return (spotify_id, track_id, score, exact) links for id_translations"""
+    songs = con.execute("SELECT track_id, title, artist_name FROM songs WHERE title IS NOT NULL").fetchall()
+    tracks = con.execute("SELECT track_id, track_name, artist_name FROM id_translations").fetchall()
+
+    song_names = [(normalize_name(t), normalize_name(a, artist=True)) for _, t, a in songs]
+    track_names = [(normalize_name(t), normalize_name(a, artist=True)) for _, t, a in tracks]
+
+    # Identical normalized names always match, however crowded their buckets are
+    best = {}
+    by_name = {}
+    for i, names in enumerate(song_names):
+        by_name.setdefault(names, i)
+    for q, names in enumerate(track_names):
+        if names in by_name:
+            best[q] = (by_name[names], 1.0)
+
+    start = time.perf_counter()
+    with instrument.stage("candidates", rows_in=len(tracks)) as s:
+        song_signatures = minhash([f"{a} {t}" for t, a in song_names])
+        track_signatures = minhash([f"{a} {t}" for t, a in track_names])
+        queries, candidates = candidate_pairs(band_keys(track_signatures), band_keys(song_signatures))
+        unmatched = np.array([q not in best for q in queries.tolist()], dtype=bool)
+        queries, candidates = queries[unmatched], candidates[unmatched]
+        agreement = (track_signatures[queries] == song_signatures[candidates]).mean(axis=1)
+        queries, candidates = queries[agreement >= MIN_JACCARD], candidates[agreement >= MIN_JACCARD]
+        s.rows_out = len(queries)
+    print(f"{len(queries):,} candidate pairs for {len(tracks):,} tracks and {len(songs):,} songs "
+          f"({time.perf_counter() - start:.1f}s)")
+
+    with instrument.stage("score", rows_in=len(queries)):
+        for q, i in zip(queries.tolist(), candidates.tolist()):
+            (track_title, track_artist), (song_title, song_artist) = track_names[q], song_names[i]
+            score = (TITLE_WEIGHT * similarity(track_title, song_title)
+                     + (1 - TITLE_WEIGHT) * similarity(track_artist, song_artist))
+            if score >= MIN_SCORE and score > best.get(q, (None, -1.0))[1]:
+                best[q] = (i, score)
+
+    return [
+        (tracks[q][0], songs[i][0], score, int(track_names[q] == song_names[i]))
+        for q, (i, score) in best.items()
+    ]
+
+
+def build(con):
+    """Will (re)build the song_links table"""
+    start = time.perf_counter()
+    with instrument.stage("match_songs") as s:
+        links = match(con)
+        s.rows_out = len(links)
+    con.execute("DROP TABLE IF EXISTS song_links")
+    con.execute(LINKS_SCHEMA)
+    con.executemany("INSERT INTO song_links VALUES (?, ?, ?, ?)", links)
+    con.execute("CREATE INDEX song_links_track ON song_links(track_id)")
+    con.commit()
+    exact = sum(link[3] for link in links)
+    print(f"Linked {len(links):,} tracks ({exact:,} exact, {len(links) - exact:,} fuzzy) "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+def exists(con):
+    """Will check whether song_links has been built"""
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'song_links'"
+    ).fetchone() is not None
+
+
+if __name__ == "__main__":
+    con = instrument.connect(config.DB_PATH)
+    build(con)
+    con.close()
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+"""Full-text search over song titles and artists, and lookups of everything known about a song
+
+build() indexes the titles and artist names of songs (MSD), spotify and
+id_translations into one FTS5 table, song_search, where each row keeps the
+table it came from and that table's id. build_db.py rebuilds it whenever a
+source changed. It also adds the indexes the lookups need, so that none of
+them scans a table.
+
+SongSearch serves ranked and prefix searches over the index, and lookups
+of a song by MSD or Spotify id joined with its chords, ratings and lyrics.
+It keeps a small pool of read-only connections that threads share, and
+every query is one of the fixed parameterized statements below, so each
+connection prepares it once and then reuses it from its statement cache.
+
+    song_search.py build                 (re)build the index in SongPop.db
+    song_search.py search WORDS...       ranked search
+    song_search.py prefix WORDS...       search as you type ("bea boy" finds the Beach Boys)
+    song_search.py lookup ID...          everything about an MSD or Spotify track id
+"""
+import argparse
+import json
+import queue
+import re
+import sqlite3
+import time
+from contextlib import contextmanager
+import numpy as np
+import config
+import instrument
+
+POOL_SIZE = 4
+# Prepared statements kept per connection - more than SongSearch uses
+STATEMENT_CACHE = 64
+SEARCH_LIMIT = 20
+# Ratings are matched by song name alone, so common names match many rows
+RATINGS_LIMIT = 10
+
+# Titles count twice as much as artist names in the ranking
+SEARCH_SCHEMA = '''CREATE VIRTUAL TABLE "song_search" USING fts5(
+	"title",
+	"artist",
+	"source" UNINDEXED,
+	"id" UNINDEXED,
+	tokenize = 'unicode61 remove_diacritics 2',
+	prefix = '2 3'
+);'''
+SEARCH_RANK = "bm25(2.0, 1.0)"
+
+# (title, artist, id) of each indexed table. spotify's track ids are MSD
+# ids, so only the tracks missing from songs are indexed from it
+SEARCH_SOURCES = {
+    "songs": "SELECT title, artist_name, track_id FROM songs WHERE title IS NOT NULL",
+    "spotify": '''SELECT name, artist, track_id FROM spotify
+        WHERE name IS NOT NULL AND track_id NOT IN (SELECT track_id FROM songs)''',
+    "id_translations": "SELECT track_name, artist_name, track_id FROM id_translations",
+}
+
+# Indexes the lookups depend on, by the table they are on
+LOOKUP_INDEXES = {
+    "spotify_spotify_id": ("spotify", "spotify(spotify_id)"),
+    "ratings_song_name": ("ratings", "ratings(song_name)"),
+    "chords_spotify_ids": ("chords", "chords(spotify_song_id, spotify_artist_id)"),
+    "lyrics_track": ("lyrics", "lyrics(track_id, is_test)"),
+}
+
+SEARCH = '''SELECT source, id, title, artist, -rank AS score FROM song_search
+WHERE song_search MATCH ? ORDER BY rank LIMIT ?'''
+SEARCH_SOURCE = '''SELECT source, id, title, artist, -rank AS score FROM song_search
+WHERE song_search MATCH ? AND source = ? ORDER BY rank LIMIT ?'''
+
+SONG = "SELECT * FROM songs WHERE track_id = ?"
+SPOTIFY = "SELECT * FROM spotify WHERE track_id = ?"
+TRANSLATION = "SELECT track_id, artist_id, track_name, artist_name FROM id_translations WHERE track_id = ?"
+# MSD id of a Spotify id, and Spotify ids of an MSD id, from the spotify
+# table and (when match_songs.py has run) the fuzzy links
+MSD_ID = "SELECT track_id FROM spotify WHERE spotify_id = ?"
+MSD_ID_LINKED = MSD_ID + " UNION ALL SELECT track_id FROM song_links WHERE spotify_id = ?"
+SPOTIFY_IDS = "SELECT spotify_id FROM spotify WHERE track_id = ? AND spotify_id IS NOT NULL"
+SPOTIFY_IDS_LINKED = SPOTIFY_IDS + " UNION SELECT spotify_id FROM song_links WHERE track_id = ?"
+LINK = "SELECT score, exact FROM song_links WHERE spotify_id = ? AND track_id = ?"
+CHORDS = '''SELECT song_id, tokens, release_date, genres, decade, rock_genre, main_genre, spotify_artist_id
+FROM chords WHERE spotify_song_id = ?'''
+RATINGS_COUNT = "SELECT count(*) FROM ratings WHERE song_name = ?"
+# Closest durations first, when the song has one
+RATINGS = '''SELECT * FROM ratings WHERE song_name = ?
+ORDER BY abs(song_duration_ms - coalesce(?, song_duration_ms)) LIMIT ?'''
+LYRICS = '''SELECT count(*) AS words, coalesce(sum(count), 0) AS total_count, max(is_test) AS is_test
+FROM lyrics WHERE track_id = ?'''
+IN_TRAINING_SET = "SELECT 1 FROM training_set WHERE track_id = ? LIMIT 1"
+PREDICTIONS = "SELECT model_version, prediction, scored_at FROM predictions WHERE track_id = ?"
+
+WORD = re.compile(r"\w+")
+
+
+def table_names(con):
+    """Will return the names of a database's tables"""
+    return {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def exists(con):
+    """Will check whether the song_search index has been built"""
+    return "song_search" in table_names(con)
+
+
+def build(con):
+    """Will (re)build the song_search index and the indexes the lookups use"""
+    tables = table_names(con)
+    if "songs" not in tables:
+        print("Skipping song_search, missing table: songs")
+        return
+
+    print("Creating lookup indexes")
+    with instrument.stage("lookup_indexes"):
+        for name, (table, target) in LOOKUP_INDEXES.items():
+            if table in tables:
+                con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        con.commit()
+
+    print("Indexing song titles and artists")
+    with instrument.stage("song_search") as s:
+        # Rebuilt wholesale, like training_set, so it never holds rows the upserts removed
+        con.execute("DROP TABLE IF EXISTS song_search")
+        con.execute(SEARCH_SCHEMA)
+        con.execute("INSERT INTO song_search(song_search, rank) VALUES ('rank', ?)", (SEARCH_RANK,))
+        for source, query in SEARCH_SOURCES.items():
+            if source in tables:
+                con.execute(f"INSERT INTO song_search(title, artist, id, source) SELECT *, '{source}' FROM ({query})")
+        # Merges the index into one b-tree per term, which is what queries read fastest
+        con.execute("INSERT INTO song_search(song_search) VALUES ('optimize')")
+        con.commit()
+        count = s.rows_out = con.execute("SELECT count(*) FROM song_search").fetchone()[0]
+    print(f"song_search has {count:,} rows")
+
+
+def match_expression(text, prefix=False):
+    """Will turn free text into an FTS5 query for all of its words (each a prefix, with prefix)
+
+    Every word is quoted, so user input can't be read as FTS5 syntax.
+    """
+    return " ".join(f'"{word}"' + ("*" if prefix else "") for word in WORD.findall(text.lower()))
+
+
+class ConnectionPool:
+    """A fixed set of read-only connections, handed to one thread at a time"""
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.idle = queue.LifoQueue()
+        self.connections = []
+        for _ in range(size):
+            con = instrument.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False,
+                                     cached_statements=STATEMENT_CACHE)
+            con.row_factory = sqlite3.Row
+            self.connections.append(con)
+            self.idle.put(con)
+
+    @contextmanager
+    def connection(self):
+        """Will lend out an idle connection, waiting for one if all are in use"""
+        con = self.idle.get()
+        try:
+            yield con
+        finally:
+            self.idle.put(con)
+
+    def close(self):
+        for con in self.connections:
+            con.close()
+
+
+class SongSearch:
+    """Ranked and prefix search over song_search, and joined lookups by id"""
+
+    def __init__(self, db_path=None, pool_size=POOL_SIZE):
+        self.pool = ConnectionPool(db_path or config.DB_PATH, pool_size)
+        with self.pool.connection() as con:
+            self.tables = table_names(con)
+            if "song_search" not in self.tables:
+                self.pool.close()
+                raise LookupError("SongPop.db has no song_search index, run song_search.py build")
+            # Decoded once, so lookups can show progressions as chord names
+            self.chords = dict(con.execute("SELECT id, chord FROM chord_vocab")) if "chord_vocab" in self.tables else {}
+        linked = "song_links" in self.tables
+        self.msd_id = MSD_ID_LINKED if linked else MSD_ID
+        self.spotify_ids = SPOTIFY_IDS_LINKED if linked else SPOTIFY_IDS
+
+    def close(self):
+        self.pool.close()
+
+    def search(self, text, limit=SEARCH_LIMIT, prefix=False, source=None):
+        """Will return the best matches for text as dicts, highest score first
+
+        With prefix, each word also matches longer words it starts, for
+        search as you type. source limits matches to one indexed table.
+        """
+        query = match_expression(text, prefix)
+        if not query:
+            return []
+        with self.pool.connection() as con:
+            if source is None:
+                rows = con.execute(SEARCH, (query, limit)).fetchall()
+            else:
+                rows = con.execute(SEARCH_SOURCE, (query, source, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def prefix(self, text, limit=SEARCH_LIMIT, source=None):
+        return self.search(text, limit, prefix=True, source=source)
+
+    def lookup(self, track_id):
+        """Will return everything known about an MSD or Spotify track id as a dict, or None
+
+        That is its songs and spotify rows, the Spotify tracks linked to it
+        with their chords, its ratings (matched by Spotify name, closest
+        duration first), whether it has lyrics and is in training_set, and
+        any stored predictions.
+        """
+        with self.pool.connection() as con:
+            song = con.execute(SONG, (track_id,)).fetchone()
+            msd_id = track_id if song is not None else self._msd_id(con, track_id)
+            if song is None and msd_id is not None:
+                song = con.execute(SONG, (msd_id,)).fetchone()
+            has_spotify = msd_id is not None and "spotify" in self.tables
+            spotify = con.execute(SPOTIFY, (msd_id,)).fetchone() if has_spotify else None
+
+            spotify_ids = [r[0] for r in con.execute(self.spotify_ids, self._twice(msd_id))] if has_spotify else []
+            if track_id not in spotify_ids and "id_translations" in self.tables \
+                    and con.execute(TRANSLATION, (track_id,)).fetchone():
+                spotify_ids.insert(0, track_id)
+            tracks = [self._track(con, spotify_id, msd_id) for spotify_id in spotify_ids]
+
+            if song is None and spotify is None and not tracks:
+                return None
+            name = spotify["name"] if spotify is not None else song["title"] if song is not None else None
+            duration = song["duration"] if song is not None else None
+            return {
+                "track_id": msd_id,
+                "song": dict(song) if song is not None else None,
+                "spotify": dict(spotify) if spotify is not None else None,
+                "spotify_tracks": tracks,
+                "ratings": self._ratings(con, name, duration),
+                "lyrics": self._lyrics(con, msd_id),
+                "in_training_set": self._in_training_set(con, msd_id),
+                "predictions": [dict(r) for r in con.execute(PREDICTIONS, (msd_id,))]
+                if msd_id and "predictions" in self.tables else [],
+            }
+
+    def _twice(self, value):
+        """Will return the parameters of a statement that may use its one value in two branches"""
+        return (value, value) if "song_links" in self.tables else (value,)
+
+    def _msd_id(self, con, spotify_id):
+        if "spotify" not in self.tables:
+            return None
+        row = con.execute(self.msd_id, self._twice(spotify_id)).fetchone()
+        return row[0] if row else None
+
+    def _track(self, con, spotify_id, msd_id):
+        translation = con.execute(TRANSLATION, (spotify_id,)).fetchone() if "id_translations" in self.tables else None
+        link = con.execute(LINK, (spotify_id, msd_id)).fetchone() if "song_links" in self.tables else None
+        chords = []
+        if "chords" in self.tables:
+            for row in con.execute(CHORDS, (spotify_id,)):
+                row = dict(row)
+                tokens = np.frombuffer(row.pop("tokens") or b"", dtype="<u2")
+                row["progression"] = " ".join(self.chords.get(int(t), "?") for t in tokens)
+                chords.append(row)
+        return {
+            "spotify_id": spotify_id,
+            "translation": dict(translation) if translation is not None else None,
+            "link": dict(link) if link is not None else None,
+            "chords": chords,
+        }
+
+    def _ratings(self, con, name, duration):
+        if name is None or "ratings" not in self.tables:
+            return {"matches": 0, "rows": []}
+        duration_ms = duration * 1000 if duration is not None else None
+        return {
+            "matches": con.execute(RATINGS_COUNT, (name,)).fetchone()[0],
+            "rows": [dict(r) for r in con.execute(RATINGS, (name, duration_ms, RATINGS_LIMIT))],
+        }
+
+    def _lyrics(self, con, msd_id):
+        if msd_id is None or "lyrics" not in self.tables:
+            return None
+        row = con.execute(LYRICS, (msd_id,)).fetchone()
+        if not row["words"]:
+            return None
+        return {"words": row["words"], "total_count": row["total_count"], "split": "test" if row["is_test"] else "train"}
+
+    def _in_training_set(self, con, msd_id):
+        if msd_id is None or "training_set" not in self.tables:
+            return False
+        return con.execute(IN_TRAINING_SET, (msd_id,)).fetchone() is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=config.DB_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="(re)build the search index and lookup indexes")
+    for name, help in [("search", "ranked search"), ("prefix", "search as you type")]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument("words", nargs="+")
+        command.add_argument("--limit", type=int, default=SEARCH_LIMIT)
+        command.add_argument("--source", choices=list(SEARCH_SOURCES))
+    lookup_parser = commands.add_parser("lookup", help="everything about MSD or Spotify track ids")
+    lookup_parser.add_argument("track_ids", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        con = instrument.connect(args.database)
+        build(con)
+        con.close()
+        return
+
+    try:
+        songs = SongSearch(args.database, pool_size=1)
+    except LookupError as e:
+        parser.error(str(e))
+    start = time.perf_counter()
+    if args.command == "lookup":
+        found = {track_id: songs.lookup(track_id) for track_id in args.track_ids}
+        print(json.dumps(found, indent=1))
+    else:
+        results = songs.search(" ".join(args.words), args.limit, args.command == "prefix", args.source)
+        for r in results:
+            print(f"{r['score']:>7.2f}  {r['source']:<15}  {r['id']:<22}  {r['title']} - {r['artist']}")
+        print(f"{len(results)} results")
+    print(f"{(time.perf_counter() - start) * 1000:.1f} ms")
+    songs.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,51 @@
 #!/usr/bin/python3
 """Translates URIs from a database into human-readable names"""
 import os
+import time
 import base64
+import random
+import queue
+import asyncio
 import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timezone
 from time import sleep
 import requests
 from dotenv import load_dotenv
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+import instrument
 
-def get_access_token(cid, secret):
-    """Will get an access token, based on Client Credential Flow"""
-    url = "https://accounts.spotify.com/api/token"
+# Can be pointed at a stand-in such as bench/fake_spotify.py
+TOKEN_URL = os.getenv("SPOTIFY_TOKEN_URL", "https://accounts.spotify.com/api/token")
+TRACKS_URL = os.getenv("SPOTIFY_TRACKS_URL", "https://api.spotify.com/v1/tracks")
+
+# Running totals for the current process, read by bench/bench_translate.py.
+# Sleep time is summed over all workers, so it can exceed the wall time.
+STATS = {
+    "requests": 0,
+    "sleep_seconds": 0.0,
+    "throttle_seconds": 0.0,
+    "write_seconds": 0.0,
+    "rows_written": 0,
+    "ids_failed": 0,
+}
+
+def wait(seconds):
+    """Will sleep, counting the time as wasted waiting on the API"""
+    STATS["sleep_seconds"] += seconds
+    sleep(seconds)
+
+async def wait_async(seconds, key="sleep_seconds"):
+    """Will sleep without blocking the event loop, counting the time under key"""
+    STATS[key] += seconds
+    await asyncio.sleep(seconds)
+
+def token_request(cid, secret):
+    """Will build the headers and form data for a Client Credential Flow token request"""
     auth_string = f"{cid}:{secret}"
     auth_bytes = auth_string.encode("utf-8")
     auth_base64 = base64.b64encode(auth_bytes).decode("utf-8")
@@ -20,71 +56,313 @@ def get_access_token(cid, secret):
     data = {
         "grant_type": "client_credentials"
     }
+    return headers, data
+
+def get_access_token(cid, secret):
+    """Will get an access token, based on Client Credential Flow"""
+    headers, data = token_request(cid, secret)
     try:
-        token = requests.post(url, headers=headers, data=data, timeout=30)
+        token = requests.post(TOKEN_URL, headers=headers, data=data, timeout=30)
         return token.json()["access_token"]
     except requests.RequestException:
         print("Could not create access token")
         return None
 
+class BatchWriter:
+    """Writes fetched batches to the database on its own thread, one executemany per batch
+
+    Tracks the API returned as null (or rejected as invalid) are recorded in
+    id_failures, so they are never requested again. If a write fails, the
+    thread stops and the error is raised again from the next put() or from
+    close(), so translation stops instead of fetching batches nobody writes.
+    """
+    def __init__(self, con):
+        self.con = con
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, rows, failed=(), reason="not_found"):
+        """Will hand a batch of id_translations rows and failed ids to the writer thread"""
+        self.raise_error()
+        self.queue.put((rows, list(failed), reason))
+
+    def raise_error(self):
+        """Will re-raise the exception that stopped the writer thread, if there was one"""
+        if self.error is not None:
+            raise RuntimeError("Writing translated ids failed, stopping") from self.error
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except Exception as e:
+                self.error = e
+                try:
+                    self.con.rollback()
+                except sqlite3.Error:
+                    pass
+                return
+
+    def write(self, rows, failed, reason):
+        """Will store one batch in a single transaction"""
+        start = time.perf_counter()
+        cur = self.con.cursor()
+        cur.executemany("""
+            INSERT OR REPLACE INTO id_translations (
+                track_id,
+                artist_id,
+                track_name,
+                artist_name
+            )
+            VALUES (?, ?, ?, ?);
+        """, rows)
+        now = datetime.now(timezone.utc).isoformat()
+        cur.executemany("""
+            INSERT INTO id_failures (track_id, reason, attempts, last_seen)
+            VALUES (?, ?, 1, ?)
+            ON CONFLICT(track_id) DO UPDATE SET
+                reason = excluded.reason,
+                attempts = attempts + 1,
+                last_seen = excluded.last_seen;
+        """, [(track_id, reason, now) for track_id in failed])
+        self.con.commit()
+        STATS["write_seconds"] += time.perf_counter() - start
+        STATS["rows_written"] += len(rows)
+        STATS["ids_failed"] += len(failed)
+
+    def close(self):
+        """Will wait for every queued batch to be written, raising if any write failed"""
+        self.queue.put(None)
+        self.thread.join()
+        self.raise_error()
+
+def split_tracks(batch, data):
+    """Will split an API response into id_translations rows and the ids that came back null"""
+    rows = []
+    missing = []
+    for track_id, track in zip(batch, data):
+        if track is None:
+            missing.append(track_id)
+        else:
+            rows.append(track_row(track))
+    return rows, missing
+
 def get_tracks(cid, secret, token, track_uris, con, cur):
     """Will translate URIs into readable tracknames"""
-    endpoint = "https://api.spotify.com/v1/tracks"
+    endpoint = TRACKS_URL
     total_batches = (len(track_uris) + 49) // 50
     batch_counter = 0
+    writer = BatchWriter(con)
+
+    batches = deque(track_uris[i:i+50] for i in range(0, len(track_uris), 50))
+
+    try:
+        while batches:
+            batch = batches.popleft()
+            params = {"ids": ",".join(batch)}
+
+            while True:
+                headers = {"Authorization": f"Bearer {token}"}
+                STATS["requests"] += 1
+                response = requests.get(endpoint, headers=headers, params=params, timeout=30)
+
+                if response.status_code == 200:
+                    data = response.json()["tracks"]
+                    writer.put(*split_tracks(batch, data))
+                    batch_counter += 1
+                    print(f"Completed batch {batch_counter}/{total_batches}")
+                    break
+
+                elif response.status_code == 429:
+                    retry_after = int(response.headers.get("Retry-After", 30))
+                    print(f"Rate limited, retrying after {retry_after} seconds...")
+                    wait(retry_after)
+                    continue
+
+                elif response.status_code == 401:
+                    print("Access token expired, attempting to get a new one...")
+                    wait(10)
+                    token = get_access_token(cid, secret)
+                    if not token:
+                        print("Token refresh failed...")
+                    continue
+
+                elif response.status_code == 400:
+                    # At least one id in the batch is malformed - split the
+                    # batch to find it, and record it once it is on its own
+                    if len(batch) > 1:
+                        half = len(batch) // 2
+                        batches.appendleft(batch[half:])
+                        batches.appendleft(batch[:half])
+                        total_batches += 1
+                    else:
+                        writer.put([], batch, "invalid")
+                    break
+
+                else:
+                    print("Unknown error, trying again in 30 seconds...")
+                    wait(30)
+                    continue
+    finally:
+        writer.close()
 
-    for i in range(0, len(track_uris), 50):
-        batch = track_uris[i:i+50]
-        params = {"ids": ",".join(batch)}
+class TokenBucket:
+    """Shared request rate limiter for every async worker, which also honors Retry-After"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
 
+    def pause(self, seconds):
+        """Will stop every worker from sending requests for the given time"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Will wait until a request is allowed, then use up one token"""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await wait_async(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await wait_async((1 - self.tokens) / self.rate, "throttle_seconds")
+
+class AccessToken:
+    """Keeps a valid access token, refreshing it shortly before it expires"""
+    def __init__(self, cid, secret, token=None, expires_in=None, margin=60):
+        self.cid = cid
+        self.secret = secret
+        self.token = token
+        self.margin = margin
+        # A token passed in from the environment has an unknown age, so it is
+        # trusted until the API rejects it
+        self.refresh_at = self.refresh_time(expires_in) if expires_in else float("inf")
+        self.lock = asyncio.Lock()
+
+    def refresh_time(self, expires_in):
+        """Will pick when to refresh a token, leaving a margin that fits short lifetimes too"""
+        return time.monotonic() + expires_in - min(self.margin, expires_in / 2)
+
+    def invalidate(self, rejected):
+        """Will force a refresh if the rejected token is still the current one"""
+        if self.token == rejected:
+            self.token = None
+
+    async def get(self, session):
+        """Will return the current token, fetching a new one if it is missing or about to expire"""
+        async with self.lock:
+            if self.token is not None and time.monotonic() < self.refresh_at:
+                return self.token
+            while True:
+                headers, data = token_request(self.cid, self.secret)
+                try:
+                    async with session.post(TOKEN_URL, headers=headers, data=data) as response:
+                        body = await response.json()
+                    self.token = body["access_token"]
+                    self.refresh_at = self.refresh_time(body.get("expires_in", 3600))
+                    return self.token
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+                    print("Token refresh failed, retrying in 5 seconds...")
+                    await wait_async(5)
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Will return a jittered exponential backoff delay for a retry attempt"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+async def fetch_batch(session, batch, access, limiter):
+    """Will request one batch of tracks, retrying until the API answers, or None if it is invalid"""
+    params = {"ids": ",".join(batch)}
+    attempt = 0
+    while True:
+        token = await access.get(session)
+        await limiter.acquire()
+        headers = {"Authorization": f"Bearer {token}"}
+        STATS["requests"] += 1
+        try:
+            async with session.get(TRACKS_URL, headers=headers, params=params) as response:
+                if response.status == 200:
+                    return (await response.json())["tracks"]
+                if response.status == 429:
+                    retry_after = int(response.headers.get("Retry-After", 30))
+                    print(f"Rate limited, pausing all workers for {retry_after} seconds...")
+                    limiter.pause(retry_after)
+                    continue
+                if response.status == 401:
+                    print("Access token rejected, getting a new one...")
+                    access.invalidate(token)
+                    continue
+                if response.status == 400:
+                    # At least one id in the batch is malformed
+                    return None
+                print(f"Error {response.status}, retrying batch...")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            print("Request failed, retrying batch...")
+        await wait_async(backoff_delay(attempt))
+        attempt += 1
+
+async def get_tracks_async(cid, secret, token, track_uris, con, cur, in_flight=8, rate=10.0,
+                           expires_in=None):
+    """Will translate URIs into readable tracknames with several batches in flight at once"""
+    if aiohttp is None:
+        raise RuntimeError("Async mode needs the aiohttp package")
+    batches = [track_uris[i:i+50] for i in range(0, len(track_uris), 50)]
+    total_batches = len(batches)
+    batch_counter = 0
+    queue = asyncio.Queue()
+    for batch in batches:
+        queue.put_nowait(batch)
+
+    limiter = TokenBucket(rate)
+    access = AccessToken(cid, secret, token, expires_in)
+    timeout = aiohttp.ClientTimeout(total=30)
+    connector = aiohttp.TCPConnector(limit=in_flight)
+
+    async def worker(session):
+        nonlocal batch_counter, total_batches
         while True:
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(endpoint, headers=headers, params=params, timeout=30)
-
-            if response.status_code == 200:
-                data = response.json()["tracks"]
-
-                for track in data:
-                    if track is None:
-                        continue
-                    track_id = track["id"]
-                    artist_id = track["artists"][0]["id"]
-                    track_name = track["name"]
-                    artist_name = track["artists"][0]["name"]
-
-                    cur.execute("""
-                        INSERT OR REPLACE INTO id_translations (
-                            track_id,
-                            artist_id,
-                            track_name,
-                            artist_name
-                        )
-                        VALUES (?, ?, ?, ?);
-                    """, (track_id, artist_id, track_name, artist_name))
-
-                con.commit()
-                batch_counter += 1
-                print(f"Completed batch {batch_counter}/{total_batches}")
-                break
-
-            elif response.status_code == 429:
-                retry_after = int(response.headers.get("Retry-After", 30))
-                print(f"Rate limited, retrying after {retry_after} seconds...")
-                sleep(retry_after)
+            try:
+                batch = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            data = await fetch_batch(session, batch, access, limiter)
+            if data is None and len(batch) > 1:
+                # Split the batch to find the malformed ids
+                half = len(batch) // 2
+                queue.put_nowait(batch[:half])
+                queue.put_nowait(batch[half:])
+                total_batches += 1
                 continue
+            if data is None:
+                writer.put([], batch, "invalid")
+            else:
+                writer.put(*split_tracks(batch, data))
+            batch_counter += 1
+            print(f"Completed batch {batch_counter}/{total_batches}")
 
-            elif response.status_code == 401:
-                print("Access token expired, attempting to get a new one...")
-                sleep(10)
-                token = get_access_token(cid, secret)
-                if not token:
-                    print("Token refresh failed...")
-                continue
+    # Writes happen on the writer's thread, so the event loop never waits on SQLite
+    writer = BatchWriter(con)
+    try:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*(worker(session) for _ in range(in_flight)))
+    finally:
+        writer.close()
 
-            else:
-                print("Unknown error, trying again in 30 seconds...")
-                sleep(30)
-                continue
+def track_row(track):
+    """Will turn a track object from the API into an id_translations row"""
+    return (track["id"], track["artists"][0]["id"], track["name"], track["artists"][0]["name"])
 
 def main():
     """Will load environment variables to use the API, and retrieve track names"""
@@ -92,46 +370,67 @@ def main():
         load_dotenv()
         client_id = os.getenv("CLIENT_ID")
         client_secret = os.getenv("CLIENT_SECRET")
-        if "ACCESS_TOKEN" not in os.environ:
-            access_token = get_access_token(client_id, client_secret)
-        else:
+        # ASYNC_BATCHES > 0 switches to the asyncio client with that many batches in flight
+        in_flight = int(os.getenv("ASYNC_BATCHES", "0"))
+        rate = float(os.getenv("REQUESTS_PER_SECOND", "10"))
+        if "ACCESS_TOKEN" in os.environ:
             access_token = os.getenv("ACCESS_TOKEN")
-        if not access_token:
+        elif in_flight:
+            # The async client fetches its own token so it knows when it expires
+            access_token = None
+        else:
+            access_token = get_access_token(client_id, client_secret)
+        if not access_token and not in_flight:
             print("Access token creation failed.")
             return
         db_path = os.getenv("DB_PATH")
-    except OSError:
+    except (OSError, ValueError):
         print("Could not properly parse .env file")
         return
 
     try:
-        con = sqlite3.connect(db_path)
+        # The connection is handed to the BatchWriter's thread for all writes
+        con = instrument.connect(db_path, check_same_thread=False)
         cur = con.cursor()
     except sqlite3.Error:
         print("Could not connect to database")
         return
 
     try:
-        cur.execute("""
-            SELECT spotify_song_id
-            FROM chords
-            WHERE spotify_song_id IS NOT NULL;
-        """)
-        rows = cur.fetchall()
-        track_ids = [r[0] for r in rows]
         cur.execute("""
         CREATE TABLE IF NOT EXISTS id_translations (
             track_id TEXT PRIMARY KEY,
             artist_id TEXT NOT NULL,
             track_name TEXT NOT NULL,
-            artist_name TEXT NOT NULL
+            artist_name TEXT NOT NULL,
+            title_norm TEXT GENERATED ALWAYS AS (lower(trim(track_name, ' ' || char(9, 10, 13)))) VIRTUAL,
+            artist_norm TEXT GENERATED ALWAYS AS (lower(trim(artist_name, ' ' || char(9, 10, 13)))) VIRTUAL
+        );
+        """)
+        # Ids the API has already answered with null (or rejected) - delete a
+        # row here to have that id requested again
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS id_failures (
+            track_id TEXT PRIMARY KEY,
+            reason TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_seen TEXT NOT NULL
         );
         """)
         con.commit()
 
-        cur.execute("SELECT track_id FROM id_translations;")
-        existing = {r[0] for r in cur.fetchall()}
-        track_ids = [tid for tid in track_ids if tid not in existing]
+        # The same spotify id can appear on many chords rows, so pending ids
+        # are deduplicated here instead of being requested over and over
+        with instrument.stage("pending_ids") as s:
+            cur.execute("""
+                SELECT DISTINCT c.spotify_song_id
+                FROM chords c
+                WHERE c.spotify_song_id IS NOT NULL
+                AND NOT EXISTS (SELECT 1 FROM id_translations t WHERE t.track_id = c.spotify_song_id)
+                AND NOT EXISTS (SELECT 1 FROM id_failures f WHERE f.track_id = c.spotify_song_id);
+            """)
+            track_ids = [r[0] for r in cur.fetchall()]
+            s.rows_out = len(track_ids)
         if not track_ids:
             print("No new tracks to process.")
             con.close()
@@ -140,7 +439,14 @@ def main():
         print("Could not utilize database")
         return
     try:
-        get_tracks(client_id, client_secret, access_token, track_ids, con, cur)
+        # The writer thread's statements count towards this stage too
+        with instrument.stage("translate", rows_in=len(track_ids)) as s:
+            if in_flight:
+                asyncio.run(get_tracks_async(client_id, client_secret, access_token, track_ids,
+                                             con, cur, in_flight, rate))
+            else:
+                get_tracks(client_id, client_secret, access_token, track_ids, con, cur)
+            s.rows_out = STATS["rows_written"]
         con.close()
     except KeyboardInterrupt:
         con.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Scores every song in training_set and writes the results to a predictions table
+
+training_set is split into rowid ranges that worker processes load,
+featurize with the fitted prep step and predict with the fitted reg step.
+At most a few chunks are in flight at once, so memory stays bounded however
+large the catalog is, and the main process bulk-writes each finished chunk.
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import song_popularity_model as spm
+
+
+# training_set has a row per (song, chord progression) match, so a track
+# can be scored several times; its prediction is the mean over its rows
+PREDICTIONS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS predictions (
+        track_id TEXT NOT NULL,
+        model_version TEXT NOT NULL,
+        prediction REAL NOT NULL,
+        scored_at TEXT NOT NULL,
+        matches INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (track_id, model_version)
+    )
+"""
+# Row-level predictions of the current run, aggregated into predictions at the end
+SCORED_SCHEMA = "CREATE TEMP TABLE scored (track_id TEXT NOT NULL, prediction REAL NOT NULL)"
+
+# Set in each worker by init_worker
+_model = None
+_database = None
+
+
+def model_version(model_path):
+    """Identifies a saved model by the hash of its file"""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def init_worker(model_path, database):
+    global _model, _database
+    _model = spm.load_model(model_path)
+    _database = database
+
+
+def score_chunk(rowids):
+    """Returns [(track_id, prediction)] for one rowid range"""
+    con = sqlite3.connect(f"file:{_database}?mode=ro", uri=True)
+    try:
+        rows = spm.featurize(spm.load(con, rowids=rowids))
+    finally:
+        con.close()
+    if not len(rows):
+        return []
+    features = _model[:-1].transform(rows[spm.feature_columns])
+    predictions = _model[-1].predict(features)
+    return list(zip(rows.index, predictions.tolist()))
+
+
+def score(database=spm.DATABASE_FILENAME, model_path=None,
+          chunk_size=spm.CHUNK_SIZE, workers=None, registry_dir=spm.REGISTRY_DIR, version=None):
+    """Scores all of training_set with a saved model; returns the number of predictions written
+
+    Without model_path, the registry picks the model (see spm.resolve_model).
+    """
+    if model_path is None:
+        _, model_path = spm.resolve_model(spm.ModelRegistry(registry_dir), database, version)
+    workers = workers or os.cpu_count()
+    version = model_version(model_path)
+    scored_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    con = sqlite3.connect(database)
+    create_tables(con)
+    ranges = list(spm.rowid_ranges(con, chunk_size))
+    print(f"Scoring {len(ranges)} chunks with model {version} on {workers} workers")
+
+    total = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_path, database)) as pool:
+        # Only a couple of chunks per worker are queued, so finished
+        # predictions never pile up in memory
+        pending = deque()
+        for rowids in ranges:
+            pending.append(pool.submit(score_chunk, rowids))
+            if len(pending) >= 2 * workers:
+                total += write(con, pending.popleft().result())
+                report(total, start)
+        while pending:
+            total += write(con, pending.popleft().result())
+            report(total, start)
+    written = store(con, version, scored_at)
+    con.close()
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed else float("inf")
+    print(f"Scored {total:,} training_set rows in {elapsed:.1f}s ({rate:,.0f} rows/sec), "
+          f"wrote predictions for {written:,} tracks")
+    return written
+
+
+def create_tables(con):
+    """Creates predictions (adding matches to one made before it existed) and the run's scored table"""
+    con.execute(PREDICTIONS_SCHEMA)
+    if "matches" not in [c[1] for c in con.execute("PRAGMA table_info(predictions)")]:
+        con.execute("ALTER TABLE predictions ADD COLUMN matches INTEGER NOT NULL DEFAULT 1")
+    con.execute(SCORED_SCHEMA)
+    con.commit()
+
+
+def write(con, scored):
+    """Stages one chunk's row-level predictions; returns how many there were"""
+    con.executemany("INSERT INTO scored (track_id, prediction) VALUES (?, ?)", scored)
+    con.commit()
+    return len(scored)
+
+
+def store(con, version, scored_at):
+    """Replaces the version's predictions with the mean per track of this run's; returns how many"""
+    with con:
+        con.execute("DELETE FROM predictions WHERE model_version = ?", (version,))
+        written = con.execute(
+            """INSERT INTO predictions (track_id, model_version, prediction, scored_at, matches)
+            SELECT track_id, ?, avg(prediction), ?, count(*) FROM scored GROUP BY track_id""",
+            (version, scored_at),
+        ).rowcount
+    con.execute("DROP TABLE scored")
+    return written
+
+
+def report(total, start):
+    elapsed = time.perf_counter() - start
+    print(f"  {total:,} rows ({total / elapsed:,.0f} rows/sec)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=spm.DATABASE_FILENAME)
+    parser.add_argument("--registry", default=spm.REGISTRY_DIR)
+    parser.add_argument("--version", type=int, default=None, help="score with this registered version")
+    parser.add_argument("--model", default=None, help="score with this pipeline file instead of the registry")
+    parser.add_argument("--chunk-size", type=int, default=spm.CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    try:
+        score(args.database, args.model, args.chunk_size, args.workers, args.registry, args.version)
+    except LookupError as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
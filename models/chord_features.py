@@ -0,0 +1,137 @@
+"""TF-IDF chord n-gram features built straight from the packed chord id arrays
+
+db/add_chords.py parses every progression once at ingest: training_set's
+chord_tokens column holds each song's chords as little-endian uint16 ids into
+chord_vocab, with the section tags already removed. The n-grams here are
+integer codes computed over all rows at once, so featurizing never touches a
+regex or splits a string.
+"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from lyrics_features import select_columns, smooth_idf, tfidf_weight
+
+TOKEN_DTYPE = np.dtype("<u2")
+NGRAM_RANGE = (1, 3)
+
+
+def load_chord_vocabulary(con):
+    """Returns the chord names in id order"""
+    return [r[0] for r in con.execute("SELECT chord FROM chord_vocab ORDER BY id")]
+
+
+def decode_tokens(blobs):
+    """Returns (ids, lengths): every blob's chord ids back to back, and how many each has"""
+    blobs = [blob or b"" for blob in blobs]
+    lengths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+    return np.frombuffer(b"".join(blobs), dtype=TOKEN_DTYPE), lengths // TOKEN_DTYPE.itemsize
+
+
+class ChordTerms:
+    """Maps chord ids to the lowercased terms TfidfVectorizer would have seen
+
+    Chords that only differ in case share a term. An n-gram is coded as its
+    term ids (plus one) in base len(terms) + 2, so codes of different lengths
+    never collide, and the top digit is left for ids newer than the vocabulary.
+    """
+
+    def __init__(self, vocabulary):
+        self.terms, self.term_ids = np.unique(np.char.lower(np.asarray(vocabulary, dtype=str)),
+                                              return_inverse=True)
+        self.base = len(self.terms) + 2
+
+    def ngram_codes(self, ids, lengths, ngram_range=NGRAM_RANGE):
+        """Returns (rows, codes) of every n-gram in the decoded sequences"""
+        lookup = np.append(self.term_ids + 1, self.base - 1).astype(np.int64)
+        digits = lookup[np.minimum(ids, len(self.term_ids))]
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        all_rows, all_codes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for n in range(ngram_range[0], ngram_range[1] + 1):
+            starts = len(digits) - n + 1
+            if starts <= 0:
+                continue
+            codes = np.zeros(starts, dtype=np.int64)
+            for k in range(n):
+                codes = codes * self.base + digits[k:k + starts]
+            # n-grams don't run from one song into the next
+            inside = rows[:starts] == rows[n - 1:]
+            all_rows.append(rows[:starts][inside])
+            all_codes.append(codes[inside])
+        return np.concatenate(all_rows), np.concatenate(all_codes)
+
+    def names(self, codes):
+        """Returns the space-separated terms of n-gram codes"""
+        digits = []
+        codes = np.asarray(codes, dtype=np.int64)
+        while codes.any():
+            digits.append(codes % self.base)
+            codes = codes // self.base
+        terms = np.concatenate([[""], self.terms, ["<unknown>"]])
+        return np.array([
+            " ".join(terms[d] for d in reversed(column) if d)
+            for column in np.array(digits).T
+        ], dtype=str) if digits else np.zeros(0, dtype=str)
+
+
+def count_matrix(rows, columns, shape):
+    """Counts (row, column) pairs into a CSR matrix, with one sort and no duplicates to merge"""
+    n_rows, n_columns = shape
+    keys, counts = np.unique(rows * n_columns + columns, return_counts=True)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // n_columns, minlength=n_rows))])
+    return sp.csr_matrix((counts.astype(np.float64), keys % n_columns, indptr), shape=shape)
+
+
+def chord_counts(blobs, terms, ngram_range=NGRAM_RANGE):
+    """Returns (counts, names, codes) for every n-gram present in a column of blobs
+
+    terms is a ChordTerms; names and codes describe the columns of counts.
+    """
+    ids, lengths = decode_tokens(blobs)
+    rows, codes = terms.ngram_codes(ids, lengths, ngram_range)
+    columns, found = np.unique(codes, return_inverse=True)
+    counts = count_matrix(rows, found.ravel(), (len(lengths), len(columns)))
+    return counts, terms.names(columns), columns
+
+
+class ChordNgramTfidf(TransformerMixin, BaseEstimator):
+    """TfidfVectorizer(token_pattern=r"\\S+", ngram_range=...) for packed chord ids
+
+    Takes a column of chord_tokens blobs and produces the same output as that
+    TfidfVectorizer over the cleaned chord strings.
+    """
+
+    def __init__(self, vocabulary=(), ngram_range=NGRAM_RANGE, max_features=None):
+        self.vocabulary = vocabulary
+        self.ngram_range = ngram_range
+        self.max_features = max_features
+
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
+
+    def fit_transform(self, X, y=None):
+        self.terms_ = ChordTerms(self.vocabulary)
+        counts, names, codes = chord_counts(X, self.terms_, self.ngram_range)
+        columns = select_columns(counts, names, None, self.max_features)
+        self.feature_names_ = names[columns]
+        # Feature i is n-gram code codes_[i]; code_order_ sorts them for lookups
+        self.codes_ = codes[columns]
+        self.code_order_ = np.argsort(self.codes_)
+
+        selected = counts[:, columns]
+        self.idf_ = smooth_idf(selected)
+        return tfidf_weight(selected, self.idf_)
+
+    def transform(self, X):
+        ids, lengths = decode_tokens(X)
+        rows, codes = self.terms_.ngram_codes(ids, lengths, self.ngram_range)
+        sorted_codes = self.codes_[self.code_order_]
+        position = np.minimum(np.searchsorted(sorted_codes, codes), max(len(sorted_codes) - 1, 0))
+        found = sorted_codes[position] == codes if len(sorted_codes) else np.zeros(len(codes), dtype=bool)
+        counts = count_matrix(rows[found], self.code_order_[position[found]],
+                              (len(lengths), len(self.codes_)))
+        return tfidf_weight(counts, self.idf_)
+
+    def get_feature_names_out(self, input_features=None):
+        return self.feature_names_.copy()
@@ -0,0 +1,162 @@
+"""On-disk cache for fitted text preprocessing and the sparse matrices it produces"""
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import joblib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin, clone
+
+# Tables whose contents the cached features are derived from
+SOURCE_TABLES = ["training_set", "lyrics", "words", "chord_vocab"]
+
+
+def source_fingerprint(con, tables=SOURCE_TABLES):
+    """Returns a short hash describing the current state of the source tables
+
+    Uses the build manifest (the sha256 of every ingested source) plus each
+    table's definition and highest rowid, so it costs a few b-tree lookups
+    rather than a scan of the data. A row count would need a scan of every
+    table, and a rebuild from changed sources already changes the manifest.
+    """
+    parts = []
+    if con.execute("SELECT 1 FROM sqlite_master WHERE name = 'ingest_manifest'").fetchone():
+        parts.append(con.execute(
+            "SELECT source, sha256 FROM ingest_manifest ORDER BY source"
+        ).fetchall())
+    for table in tables:
+        definition = con.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()
+        parts.append((table, definition, con.execute(f"SELECT max(rowid) FROM {table}").fetchone()))
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()[:16]
+
+
+class FeatureCache:
+    """A directory of cache entries, each holding .npy arrays plus meta.json
+
+    Arrays are loaded memory-mapped, so a hit costs a few file opens no matter
+    how large the matrices are.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @staticmethod
+    def key(*parts):
+        return joblib.hash(parts)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def load(self, key):
+        """Returns (meta, {name: array or CSR matrix}), or None if the key is missing"""
+        entry = self.path(key)
+        try:
+            with open(os.path.join(entry, "meta.json")) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        arrays = {}
+        for name, info in meta["arrays"].items():
+            if info["kind"] == "csr":
+                parts = [
+                    np.load(os.path.join(entry, f"{name}.{part}.npy"), mmap_mode="r")
+                    for part in ("data", "indices", "indptr")
+                ]
+                arrays[name] = sp.csr_matrix(tuple(parts), shape=tuple(info["shape"]), copy=False)
+            else:
+                arrays[name] = np.load(os.path.join(entry, f"{name}.npy"), mmap_mode="r")
+        return meta, arrays
+
+    def load_object(self, key, name):
+        return joblib.load(os.path.join(self.path(key), f"{name}.joblib"))
+
+    def save(self, key, arrays, objects=None, meta=None):
+        """Writes an entry atomically, so concurrent workers never see half of one"""
+        os.makedirs(self.root, exist_ok=True)
+        meta = dict(meta or {})
+        meta["arrays"] = {}
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            for name, value in arrays.items():
+                if sp.issparse(value):
+                    value = value.tocsr()
+                    for part in ("data", "indices", "indptr"):
+                        np.save(os.path.join(staging, f"{name}.{part}.npy"), getattr(value, part))
+                    meta["arrays"][name] = {"kind": "csr", "shape": list(value.shape)}
+                else:
+                    np.save(os.path.join(staging, f"{name}.npy"), np.asarray(value))
+                    meta["arrays"][name] = {"kind": "dense"}
+            for name, value in (objects or {}).items():
+                joblib.dump(value, os.path.join(staging, f"{name}.joblib"))
+            with open(os.path.join(staging, "meta.json"), "w") as f:
+                json.dump(meta, f)
+            os.replace(staging, self.path(key))
+        except OSError as e:
+            shutil.rmtree(staging, ignore_errors=True)
+            # Another worker finished the same entry first; anything else
+            # (a full disk, a permission) is a real failure
+            lost_race = e.errno in (errno.ENOTEMPTY, errno.EEXIST)
+            if not (lost_race and os.path.exists(os.path.join(self.path(key), "meta.json"))):
+                raise
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+
+def rows_key(X):
+    """Identifies which rows of the source frame X holds"""
+    return joblib.hash(np.asarray(X.index))
+
+
+class CachedPreprocessor(TransformerMixin, BaseEstimator):
+    """Wraps a preprocessing step so its fit and outputs are reused from disk
+
+    Entries are keyed by data_key (a source_fingerprint), the wrapped step's
+    parameters, and the rows being transformed, so every CV fold and every
+    max_features setting gets its own entry. With cache_dir=None it behaves
+    exactly like the wrapped step.
+    """
+
+    def __init__(self, prep, cache_dir=None, data_key=""):
+        self.prep = prep
+        self.cache_dir = cache_dir
+        self.data_key = data_key
+
+    def fit(self, X, y=None):
+        self.fit_transform(X, y)
+        return self
+
+    def fit_transform(self, X, y=None):
+        if self.cache_dir is None:
+            self.prep_ = clone(self.prep)
+            return self.prep_.fit_transform(X, y)
+
+        cache = FeatureCache(self.cache_dir)
+        self.fit_key_ = cache.key(self.data_key, joblib.hash(self.prep), rows_key(X))
+        hit = cache.load(self.fit_key_)
+        if hit is not None:
+            self.prep_ = cache.load_object(self.fit_key_, "prep")
+            return hit[1]["features"]
+
+        self.prep_ = clone(self.prep)
+        features = self.prep_.fit_transform(X, y)
+        cache.save(self.fit_key_, {"features": features}, {"prep": self.prep_})
+        return features
+
+    def transform(self, X):
+        if self.cache_dir is None:
+            return self.prep_.transform(X)
+
+        cache = FeatureCache(self.cache_dir)
+        key = cache.key(self.fit_key_, "transform", rows_key(X))
+        hit = cache.load(key)
+        if hit is not None:
+            return hit[1]["features"]
+
+        features = self.prep_.transform(X)
+        cache.save(key, {"features": features})
+        return features
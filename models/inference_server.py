@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""Local HTTP inference service for the popularity models
+
+Keeps song_popularity_model.py's current registered model (and, when it has
+been trained, the Keras model from simple_popularity_model.py) loaded, and serves
+
+    POST /predict/songs    {"track_ids": [...]}  -> {"predictions": [...]}
+    POST /predict/ratings  {"rows": [{...}, ...]} -> {"predictions": [...]}
+    GET  /metrics          latency percentiles, batch sizes and cache hit rates
+
+Concurrent requests are grouped into micro-batches: a batch is sent to the
+model once it holds max_batch items or max_wait_ms after its first request
+arrived, whichever comes first. Featurized songs are kept in an LRU, so a
+repeated track id skips the database read and the TF-IDF transform.
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from aiohttp import web
+
+import song_popularity_model as spm
+from tree_export import CROSSOVER_ROWS, TreeEnsemble
+
+MAX_BATCH = 64
+MAX_WAIT_MS = 5
+CACHE_SIZE = 10000
+# Latencies kept for the percentiles in /metrics
+LATENCY_WINDOW = 10000
+
+KERAS_MODEL_FILENAME = "simple_popularity_model.keras"
+PREPROCESSOR_FILENAME = "simple_popularity_preprocessor.pkl"
+
+
+class LRUCache:
+    """A bounded mapping that evicts the least recently used entry"""
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class MicroBatcher:
+    """Collects items from concurrent requests and predicts them together
+
+    predict_batch takes a list of items and returns one prediction per item.
+    It runs on a single worker thread, so it never runs twice at once. If it
+    raises for a batch of several requests, each request is predicted on its
+    own, so an error only reaches the request that caused it.
+    """
+    def __init__(self, predict_batch, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.predict_batch = predict_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def predict(self, items):
+        """Queues one request's items and returns their predictions"""
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((list(items), future))
+        result = await future
+        self.requests += 1
+        self.latencies.append(time.perf_counter() - start)
+        return result
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            size = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                size += len(request[0])
+
+            items = [item for request_items, _ in requests for item in request_items]
+            self.batch_sizes.append(len(items))
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict_batch, items)
+            except Exception as e:
+                if len(requests) == 1:
+                    self.settle(requests[0][1], exception=e)
+                else:
+                    await self.predict_each(requests)
+                continue
+            start = 0
+            for request_items, future in requests:
+                self.settle(future, predictions[start:start + len(request_items)])
+                start += len(request_items)
+
+    async def predict_each(self, requests):
+        """Predicts each request of a failed batch on its own"""
+        loop = asyncio.get_running_loop()
+        for request_items, future in requests:
+            try:
+                predictions = await loop.run_in_executor(self.executor, self.predict_batch, request_items)
+            except Exception as e:
+                self.settle(future, exception=e)
+            else:
+                self.settle(future, predictions)
+
+    @staticmethod
+    def settle(future, result=None, exception=None):
+        # The caller may have gone away (and cancelled its future) meanwhile
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        sizes = np.array(self.batch_sizes)
+        return {
+            "requests": self.requests,
+            "batches": len(sizes),
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            "mean_batch_size": float(sizes.mean()) if len(sizes) else None,
+            "max_batch_size": int(sizes.max()) if len(sizes) else None,
+        }
+
+
+class SongModel:
+    """song_popularity_model.py's pipeline, with featurized songs cached by track id
+
+    With trees_path (from tree_export.py), batches of up to trees_max_rows
+    rows are scored with the exported trees, which are faster than the
+    pipeline's GradientBoostingRegressor there; larger ones stay with sklearn.
+    Their predictions are identical either way.
+    A track matching several training_set rows is cached with all of them and
+    gets the mean of their predictions, like spm.predict and batch_score.py.
+    """
+    def __init__(self, model_path, database, cache_size=CACHE_SIZE, trees_path=None,
+                 trees_max_rows=CROSSOVER_ROWS):
+        self.model = spm.load_model(model_path)
+        self.trees = TreeEnsemble.load(trees_path) if trees_path else None
+        self.trees_max_rows = trees_max_rows
+        self.con = sqlite3.connect(f"file:{database}?mode=ro", uri=True, check_same_thread=False)
+        self.cache = LRUCache(cache_size)
+
+    @staticmethod
+    def validate(track_ids):
+        """Raises ValueError unless every item is a track id string"""
+        for track_id in track_ids:
+            if not isinstance(track_id, str):
+                raise ValueError(f"Track ids must be strings, got {track_id!r}")
+
+    def predict_batch(self, track_ids):
+        """Returns a prediction per track id, or None for ids not in training_set"""
+        features = {}
+        missing = []
+        for track_id in dict.fromkeys(track_ids):
+            rows = self.cache.get(track_id)
+            if rows is None:
+                missing.append(track_id)
+            else:
+                features[track_id] = rows
+
+        if missing:
+            rows = spm.featurize(spm.load(self.con, missing))
+            if len(rows):
+                # Every step but the regressor transforms rows independently,
+                # so cached rows stack into exactly what predict would compute
+                transformed = self.model[:-1].transform(rows[spm.feature_columns])
+                positions = pd.Series(np.arange(len(rows)), index=rows.index)
+                for track_id, at in positions.groupby(level=0, sort=False):
+                    track_rows = transformed[at.to_numpy()]
+                    self.cache.put(track_id, track_rows)
+                    features[track_id] = track_rows
+
+        found = list(features)
+        if not found:
+            return [None] * len(track_ids)
+        blocks = [features[track_id] for track_id in found]
+        stacked = sp.vstack(blocks, format="csr") if sp.issparse(blocks[0]) else np.vstack(blocks)
+        if self.trees is not None and stacked.shape[0] <= self.trees_max_rows:
+            row_predictions = self.trees.predict(stacked)
+        else:
+            row_predictions = self.model[-1].predict(stacked)
+        ends = np.cumsum([block.shape[0] for block in blocks])
+        predictions = {
+            track_id: float(row_predictions[end - block.shape[0]:end].mean())
+            for track_id, block, end in zip(found, blocks, ends)
+        }
+        return [predictions.get(track_id) for track_id in track_ids]
+
+
+class RatingsModel:
+    """The Keras model from simple_popularity_model.py and its fitted scaler"""
+    def __init__(self, model_path, preprocessor_path, cache_size=CACHE_SIZE):
+        import joblib
+        import tensorflow as tf
+        self.model = tf.keras.models.load_model(model_path)
+        self.preprocessor = joblib.load(preprocessor_path)
+        self.columns = list(self.preprocessor.feature_names_in_)
+        self.cache = LRUCache(cache_size)
+
+    def validate(self, rows):
+        """Raises ValueError unless every row is an object with a number for each feature"""
+        for row in rows:
+            if not isinstance(row, dict):
+                raise ValueError(f"Rows must be objects, got {row!r}")
+            missing = [column for column in self.columns if column not in row]
+            if missing:
+                raise ValueError(f"Missing feature {', '.join(missing)}")
+            for column in self.columns:
+                value = row[column]
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    raise ValueError(f"Feature {column} must be a number, got {value!r}")
+
+    def predict_batch(self, rows):
+        keys = [tuple(row[column] for column in self.columns) for row in rows]
+        scaled = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                scaled[key] = cached
+        if missing:
+            X = self.preprocessor.transform(pd.DataFrame(missing, columns=self.columns))
+            for key, row in zip(missing, X.astype(np.float32)):
+                self.cache.put(key, row)
+                scaled[key] = row
+        X = np.vstack([scaled[key] for key in keys])
+        return self.model.predict_on_batch(X).ravel().tolist()
+
+
+def make_app(songs=None, ratings=None, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+    """Builds the aiohttp application for whichever models are given"""
+    app = web.Application()
+    models = {name: model for name, model in [("songs", songs), ("ratings", ratings)] if model is not None}
+    batchers = {name: MicroBatcher(model.predict_batch, max_batch, max_wait_ms) for name, model in models.items()}
+
+    async def on_startup(app):
+        for batcher in batchers.values():
+            batcher.start()
+
+    async def on_cleanup(app):
+        for batcher in batchers.values():
+            await batcher.stop()
+
+    def endpoint(name, field):
+        async def handler(request):
+            if name not in batchers:
+                raise web.HTTPNotFound(text=f"The {name} model isn't loaded")
+            try:
+                items = (await request.json())[field]
+            except (ValueError, KeyError, TypeError):
+                raise web.HTTPBadRequest(text=f'Expected a JSON body with a "{field}" list')
+            if not isinstance(items, list):
+                raise web.HTTPBadRequest(text=f'"{field}" must be a list')
+            # Checked before queueing, so a bad request never joins a batch
+            try:
+                models[name].validate(items)
+            except ValueError as e:
+                raise web.HTTPBadRequest(text=str(e))
+            predictions = await batchers[name].predict(items)
+            return web.json_response({"predictions": predictions})
+        return handler
+
+    async def metrics(request):
+        body = {}
+        for name, batcher in batchers.items():
+            body[name] = batcher.metrics()
+            body[name]["cache_hits"] = models[name].cache.hits
+            body[name]["cache_misses"] = models[name].cache.misses
+        return web.json_response(body)
+
+    app.router.add_post("/predict/songs", endpoint("songs", "track_ids"))
+    app.router.add_post("/predict/ratings", endpoint("ratings", "rows"))
+    app.router.add_get("/metrics", metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--database", default=spm.DATABASE_FILENAME)
+    parser.add_argument("--registry", default=spm.REGISTRY_DIR)
+    parser.add_argument("--version", type=int, default=None, help="serve this registered version")
+    parser.add_argument("--model", default=None, help="serve this pipeline file instead of the registry")
+    parser.add_argument("--trees", default=None,
+                        help="score small batches with trees exported by tree_export.py")
+    parser.add_argument("--trees-max-rows", type=int, default=CROSSOVER_ROWS,
+                        help="largest batch scored with --trees (see tree_export.py --check)")
+    parser.add_argument("--keras-model", default=KERAS_MODEL_FILENAME)
+    parser.add_argument("--keras-preprocessor", default=PREPROCESSOR_FILENAME)
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    args = parser.parse_args()
+
+    songs = ratings = None
+    model_path = args.model
+    if model_path is None:
+        try:
+            _, model_path = spm.resolve_model(spm.ModelRegistry(args.registry), args.database, args.version)
+        except LookupError as e:
+            print(f"Not serving songs: {e}")
+    if model_path is not None:
+        songs = SongModel(model_path, args.database, args.cache_size, args.trees, args.trees_max_rows)
+        print(f"Loaded '{model_path}'")
+    if os.path.exists(args.keras_model) and os.path.exists(args.keras_preprocessor):
+        ratings = RatingsModel(args.keras_model, args.keras_preprocessor, args.cache_size)
+        print(f"Loaded '{args.keras_model}'")
+    if songs is None and ratings is None:
+        parser.error("no trained model found, run song_popularity_model.py or simple_popularity_model.py first")
+
+    web.run_app(make_app(songs, ratings, args.max_batch, args.max_wait_ms),
+                host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""TF-IDF lyric features built straight from the mxm (track_id, word, count) rows"""
+import re
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+from sklearn.preprocessing import normalize
+
+# TfidfVectorizer's default token_pattern
+TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+EMPTY_BAG = np.zeros((2, 0), dtype=np.int32)
+
+
+def load_vocabulary(con):
+    """Returns the mxm words in rowid order, so word ids stay stable between runs"""
+    return [r[0] for r in con.execute("SELECT word FROM words ORDER BY rowid")]
+
+
+def lyrics_bags(lyrics_raw):
+    """Returns a Series of (2, k) [word id; count] arrays indexed by track_id
+
+    lyrics_raw needs track_id, word_id and count columns, sorted by track_id.
+    """
+    track_ids = lyrics_raw["track_id"]
+    # Category codes compare much faster than the id strings
+    keys = (track_ids.cat.codes if isinstance(track_ids.dtype, pd.CategoricalDtype) else track_ids).to_numpy()
+    pairs = np.vstack([
+        lyrics_raw["word_id"].to_numpy(dtype=np.int32),
+        lyrics_raw["count"].to_numpy(dtype=np.int32),
+    ])
+    starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    tracks = np.asarray(track_ids.iloc[np.concatenate([[0], starts])]) if len(keys) else keys
+    return pd.Series(np.split(pairs, starts, axis=1) if len(keys) else [], index=tracks, dtype=object)
+
+
+def attach_bags(track_ids, bags):
+    """Returns the bag for each track id, with an empty bag where there are no lyrics"""
+    found = bags.reindex(track_ids).to_numpy()
+    return [bag if isinstance(bag, np.ndarray) else EMPTY_BAG for bag in found]
+
+
+def flatten_bags(bags):
+    """Returns each bag as one 1-D array (word ids, then counts) for storing as a list column"""
+    return [bag.ravel() for bag in bags]
+
+
+def unflatten_bags(cells):
+    """Turns cells from flatten_bags() back into (2, k) bags without copying"""
+    return [cell.reshape(2, -1) for cell in cells]
+
+
+def bags_to_csr(bags, n_words):
+    """Stacks a column of bags into a (rows x words) CSR term-count matrix"""
+    bags = list(bags)
+    lengths = np.fromiter((bag.shape[1] for bag in bags), dtype=np.int64, count=len(bags))
+    indptr = np.concatenate([[0], np.cumsum(lengths)])
+    pairs = np.concatenate(bags, axis=1) if bags else EMPTY_BAG
+    matrix = sp.csr_matrix(
+        (pairs[1].astype(np.float64), pairs[0], indptr), shape=(len(bags), n_words)
+    )
+    matrix.sum_duplicates()
+    return matrix
+
+
+def word_terms(vocabulary, token_pattern=TOKEN_PATTERN):
+    """Returns (terms, matrix): the sorted tokens TfidfVectorizer would split the words into,
+    and a (words x terms) CSR matrix of how many of each term every word yields
+
+    Most mxm words are a single token. Words with punctuation split the way
+    the vectorizer would have split them in the rebuilt text ("don't" gives
+    "don", "rock'n'roll" gives "rock" and "roll"), and their counts go to
+    each of their terms.
+    """
+    pattern = re.compile(token_pattern)
+    tokens = [pattern.findall(word.lower()) for word in vocabulary]
+    terms = np.array(sorted({t for word_tokens in tokens for t in word_tokens}), dtype=str)
+    index = {term: i for i, term in enumerate(terms)}
+    rows = np.repeat(np.arange(len(tokens)), [len(word_tokens) for word_tokens in tokens])
+    columns = np.fromiter((index[t] for word_tokens in tokens for t in word_tokens), dtype=np.int64, count=len(rows))
+    matrix = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(tokens), len(terms)))
+    matrix.sum_duplicates()
+    return terms, matrix
+
+
+def allowed_terms(terms, stop_words="english"):
+    """Marks the terms TfidfVectorizer's stop word list would keep"""
+    terms = np.asarray(terms, dtype=str)
+    if stop_words == "english":
+        return ~np.isin(terms, list(ENGLISH_STOP_WORDS))
+    return np.ones(len(terms), dtype=bool)
+
+
+def select_columns(counts, names, allowed=None, max_features=None):
+    """Returns the columns of a count matrix TfidfVectorizer would keep as features
+
+    Columns are ordered alphabetically by name and, past max_features, the
+    most frequent are picked the same way TfidfVectorizer breaks ties.
+    """
+    term_freq = np.asarray(counts.sum(axis=0)).ravel()
+    present = term_freq > 0
+    if allowed is not None:
+        present &= allowed
+    candidates = np.flatnonzero(present)
+    candidates = candidates[np.argsort(names[candidates], kind="stable")]
+    if max_features is not None and len(candidates) > max_features:
+        keep = (-term_freq[candidates]).argsort()[:max_features]
+        candidates = candidates[np.sort(keep)]
+    return candidates
+
+
+def smooth_idf(counts):
+    """TfidfVectorizer's default (smoothed) idf for each column of a count matrix"""
+    counts = sp.csr_matrix(counts)
+    doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+    return np.log((1 + counts.shape[0]) / (1 + doc_freq)) + 1
+
+
+def tfidf_weight(counts, idf):
+    """Applies idf and l2-normalizes each row, as TfidfVectorizer does"""
+    return normalize(counts @ sp.diags(idf), norm="l2", copy=False).tocsr()
+
+
+class LyricBagTfidf(TransformerMixin, BaseEstimator):
+    """TfidfVectorizer for lyrics that are already bags of words
+
+    Takes a column of bags from lyrics_bags() and produces the same output as
+    TfidfVectorizer(stop_words='english', max_features=...) over the rebuilt
+    lyric text, without ever building that text: only the vocabulary is
+    tokenized, once.
+    """
+
+    def __init__(self, vocabulary=(), stop_words="english", max_features=None, token_pattern=TOKEN_PATTERN):
+        self.vocabulary = vocabulary
+        self.stop_words = stop_words
+        self.max_features = max_features
+        self.token_pattern = token_pattern
+
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
+
+    def fit_transform(self, X, y=None):
+        terms, to_terms = word_terms(self.vocabulary, self.token_pattern)
+        counts = bags_to_csr(X, len(self.vocabulary)) @ to_terms
+
+        allowed = allowed_terms(terms, self.stop_words)
+        self.columns_ = select_columns(counts, terms, allowed, self.max_features)
+        self.feature_names_ = terms[self.columns_]
+        # Sends word counts straight to the selected term columns
+        self.word_columns_ = to_terms[:, self.columns_].tocsr()
+
+        selected = counts[:, self.columns_]
+        self.idf_ = smooth_idf(selected)
+        return tfidf_weight(selected, self.idf_)
+
+    def transform(self, X):
+        counts = bags_to_csr(X, len(self.vocabulary)) @ self.word_columns_
+        return tfidf_weight(counts, self.idf_)
+
+    def get_feature_names_out(self, input_features=None):
+        return self.feature_names_.copy()
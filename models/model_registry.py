@@ -0,0 +1,149 @@
+"""Versioned store of fitted song_popularity_model.py pipelines
+
+Every trained pipeline gets its own numbered directory holding model.pkl and
+meta.json. The metadata records what the model was trained on - the source
+tables' fingerprint, the feature setup and the search's param_dist - hashed
+together into one fingerprint, plus its test metrics and top features.
+Training is only needed when no version has the current fingerprint.
+
+A version can be pinned, so scoring keeps using it while newer ones are
+trained, and old versions can be pruned.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timezone
+
+REGISTRY_DIR = "model_registry"
+MODEL_FILE = "model.pkl"
+META_FILE = "meta.json"
+PIN_FILE = "PINNED"
+KEEP_VERSIONS = 3
+
+
+def fingerprint(components):
+    """Returns a short hash of the JSON-serializable description of a training run"""
+    return hashlib.sha256(json.dumps(components, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def changed_parts(meta, components):
+    """Returns which top-level components differ between a version and the current ones"""
+    return sorted(name for name in set(meta["components"]) | set(components)
+                  if meta["components"].get(name) != components.get(name))
+
+
+class ModelRegistry:
+    """A directory of model versions, numbered in the order they were registered"""
+
+    def __init__(self, root=REGISTRY_DIR):
+        self.root = root
+
+    def path(self, version, name=None):
+        entry = os.path.join(self.root, f"{int(version):04d}")
+        return os.path.join(entry, name) if name else entry
+
+    def versions(self):
+        """Returns the metadata of every version, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for entry in os.listdir(self.root):
+            if entry.isdigit() and os.path.exists(os.path.join(self.root, entry, META_FILE)):
+                found.append(self.meta(int(entry)))
+        return sorted(found, key=lambda meta: meta["version"])
+
+    def meta(self, version):
+        with open(self.path(version, META_FILE)) as f:
+            return json.load(f)
+
+    def load(self, version):
+        """Returns a version's pipeline, memory-mapping its arrays instead of copying them"""
+        import joblib
+        return joblib.load(self.path(version, MODEL_FILE), mmap_mode="r")
+
+    def find(self, key):
+        """Returns the newest version trained with the given fingerprint, or None"""
+        matches = [meta for meta in self.versions() if meta["fingerprint"] == key]
+        return matches[-1] if matches else None
+
+    def register(self, model, components, metrics=None, importances=None):
+        """Stores a fitted pipeline with its metadata and returns that metadata
+
+        The entry is written to a staging directory first and renamed into
+        place, so a concurrent reader never sees half of one.
+        """
+        import joblib
+
+        os.makedirs(self.root, exist_ok=True)
+        meta = {
+            "fingerprint": fingerprint(components),
+            "components": components,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "metrics": metrics or {},
+            "feature_importances": importances or [],
+        }
+        staging = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            joblib.dump(model, os.path.join(staging, MODEL_FILE))
+            while True:
+                versions = self.versions()
+                meta["version"] = versions[-1]["version"] + 1 if versions else 1
+                with open(os.path.join(staging, META_FILE), "w") as f:
+                    json.dump(meta, f, indent=1)
+                try:
+                    os.rename(staging, self.path(meta["version"]))
+                    return meta
+                except OSError:
+                    # Another run registered this number first
+                    if not os.path.exists(self.path(meta["version"])):
+                        raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def pinned(self):
+        """Returns the pinned version number, or None"""
+        try:
+            with open(os.path.join(self.root, PIN_FILE)) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return None
+
+    def pin(self, version):
+        """Makes scoring use this version until it is unpinned"""
+        if not os.path.exists(self.path(version, META_FILE)):
+            raise LookupError(f"no version {version} in '{self.root}'")
+        with open(os.path.join(self.root, PIN_FILE), "w") as f:
+            f.write(f"{int(version)}\n")
+
+    def unpin(self):
+        if os.path.exists(os.path.join(self.root, PIN_FILE)):
+            os.remove(os.path.join(self.root, PIN_FILE))
+
+    def resolve(self, version=None, key=None):
+        """Returns the metadata of the version to score with
+
+        An explicit version wins, then the pinned one, then the newest one
+        trained with fingerprint key. Raises LookupError if there is none,
+        rather than falling back to a model trained on something else.
+        """
+        version = version if version is not None else self.pinned()
+        if version is not None:
+            if not os.path.exists(self.path(version, META_FILE)):
+                raise LookupError(f"no version {version} in '{self.root}'")
+            return self.meta(version)
+        meta = self.find(key) if key is not None else None
+        if meta is None:
+            raise LookupError(f"no version in '{self.root}' was trained on the current data and "
+                              f"settings (fingerprint {key}), train one or pin a version")
+        return meta
+
+    def prune(self, keep=KEEP_VERSIONS):
+        """Deletes all but the newest keep versions (and the pinned one); returns the deleted numbers"""
+        versions = [meta["version"] for meta in self.versions()]
+        kept = set(versions[-keep:] if keep > 0 else []) | {self.pinned()}
+        removed = [version for version in versions if version not in kept]
+        for version in removed:
+            shutil.rmtree(self.path(version))
+        return removed
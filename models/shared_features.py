@@ -0,0 +1,144 @@
+"""Training features shared by every CV worker through memory-mapped buffers
+
+The chord n-gram counts, lyric word counts and numeric columns of the training
+frame are written once to a FeatureCache entry. The search is then fitted on
+row positions only, so each worker receives a handful of integers per task and
+maps the same buffers instead of unpickling its own copy of the text columns.
+Per fold, SharedTfidf slices the rows it needs and applies the same feature
+selection and weighting ChordNgramTfidf and LyricBagTfidf would. The result
+is cached per fold and max_features setting, so the many candidates of a
+search that share both reuse one fit.
+"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+
+from chord_features import NGRAM_RANGE, ChordTerms, chord_counts
+from feature_cache import FeatureCache, rows_key
+from lyrics_features import TOKEN_PATTERN, allowed_terms, bags_to_csr, select_columns, smooth_idf, tfidf_weight, word_terms
+
+NUMERIC_COLUMNS = ["duration", "year"]
+
+# Buffers already mapped by this process, keyed by (cache_dir, key)
+_BUFFERS = {}
+
+
+def materialize(X, vocabulary, chord_vocabulary, cache_dir, data_key, ngram_range=NGRAM_RANGE,
+                token_pattern=TOKEN_PATTERN):
+    """Writes the count matrices and numeric columns of X to the cache, once
+
+    Returns the cache key to hand to SharedTfidf. Row i of every buffer is
+    row i of X.
+    """
+    cache = FeatureCache(cache_dir)
+    key = cache.key(data_key, "shared", rows_key(X), ngram_range, token_pattern)
+    if cache.load(key) is None:
+        chords, chord_terms, _ = chord_counts(X["chord_tokens"], ChordTerms(chord_vocabulary), ngram_range)
+        lyric_terms, to_terms = word_terms(vocabulary, token_pattern)
+        cache.save(key, {
+            "chords": chords,
+            "chord_terms": chord_terms,
+            "lyrics": (bags_to_csr(X["lyrics_bag"], len(vocabulary)) @ to_terms).tocsr(),
+            "lyric_terms": lyric_terms,
+            "numeric": X[NUMERIC_COLUMNS].to_numpy(dtype=np.float64),
+        })
+    return key
+
+
+def shared_buffers(cache_dir, key):
+    """Returns the memory-mapped buffers for a key, mapping them once per process"""
+    entry = (cache_dir, key)
+    if entry not in _BUFFERS:
+        hit = FeatureCache(cache_dir).load(key)
+        if hit is None:
+            raise FileNotFoundError(f"No shared features at {FeatureCache(cache_dir).path(key)}")
+        _BUFFERS[entry] = hit[1]
+    return _BUFFERS[entry]
+
+
+class SharedTfidf(TransformerMixin, BaseEstimator):
+    """The model's ColumnTransformer, computed from the shared count buffers
+
+    X is a column of row positions into the buffers written by materialize().
+    The output matches ColumnTransformer([ChordNgramTfidf on the chords,
+    LyricBagTfidf on the lyrics, the numeric columns passed through]) fitted
+    on the same rows.
+    """
+
+    def __init__(self, cache_dir=None, key=None, chords_max_features=1000,
+                 lyrics_max_features=1000, stop_words="english"):
+        self.cache_dir = cache_dir
+        self.key = key
+        self.chords_max_features = chords_max_features
+        self.lyrics_max_features = lyrics_max_features
+        self.stop_words = stop_words
+
+    def fit(self, X, y=None):
+        self.fit_transform(X)
+        return self
+
+    def fit_transform(self, X, y=None):
+        cache = FeatureCache(self.cache_dir)
+        rows = np.asarray(X).ravel()
+        self.fit_key_ = cache.key(self.key, "tfidf", rows, self.chords_max_features,
+                                  self.lyrics_max_features, self.stop_words)
+        hit = cache.load(self.fit_key_)
+        if hit is not None:
+            fitted = hit[1]
+            for name in ("chord_columns", "lyric_columns", "chord_idf", "lyric_idf"):
+                setattr(self, f"{name}_", np.array(fitted[name]))
+            return fitted["features"]
+
+        buffers = shared_buffers(self.cache_dir, self.key)
+        chords = buffers["chords"][rows]
+        lyrics = buffers["lyrics"][rows]
+
+        self.chord_columns_ = select_columns(chords, buffers["chord_terms"], None, self.chords_max_features)
+        allowed = allowed_terms(buffers["lyric_terms"], self.stop_words)
+        self.lyric_columns_ = select_columns(lyrics, buffers["lyric_terms"], allowed, self.lyrics_max_features)
+
+        chords = chords[:, self.chord_columns_]
+        lyrics = lyrics[:, self.lyric_columns_]
+        self.chord_idf_ = smooth_idf(chords)
+        self.lyric_idf_ = smooth_idf(lyrics)
+        features = self._stack(chords, lyrics, buffers["numeric"][rows])
+        cache.save(self.fit_key_, {
+            "features": features,
+            "chord_columns": self.chord_columns_,
+            "lyric_columns": self.lyric_columns_,
+            "chord_idf": self.chord_idf_,
+            "lyric_idf": self.lyric_idf_,
+        })
+        return features
+
+    def transform(self, X):
+        cache = FeatureCache(self.cache_dir)
+        rows = np.asarray(X).ravel()
+        key = cache.key(self.fit_key_, "transform", rows)
+        hit = cache.load(key)
+        if hit is not None:
+            return hit[1]["features"]
+
+        buffers = shared_buffers(self.cache_dir, self.key)
+        features = self._stack(
+            buffers["chords"][rows][:, self.chord_columns_],
+            buffers["lyrics"][rows][:, self.lyric_columns_],
+            buffers["numeric"][rows],
+        )
+        cache.save(key, {"features": features})
+        return features
+
+    def _stack(self, chords, lyrics, numeric):
+        return sp.hstack([
+            tfidf_weight(chords, self.chord_idf_),
+            tfidf_weight(lyrics, self.lyric_idf_),
+            sp.csr_matrix(numeric),
+        ], format="csr")
+
+    def get_feature_names_out(self, input_features=None):
+        buffers = shared_buffers(self.cache_dir, self.key)
+        return np.concatenate([
+            buffers["chord_terms"][self.chord_columns_],
+            buffers["lyric_terms"][self.lyric_columns_],
+            NUMERIC_COLUMNS,
+        ])
@@ -1,77 +1,188 @@
-import sqlite3
-import pandas as pd
+import os
+import sys
 import numpy as np
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
-from sklearn.compose import ColumnTransformer
-import tensorflow as tf
-from tensorflow.keras import layers, models
 
+# db/instrument.py times the stages below when STAGE_TRACE is set
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+import instrument
+from song_popularity_model import rowid_ranges
 
-# Load the SQLite database
-con = sqlite3.connect("SongPop.db")
-df = pd.read_sql_query("SELECT * FROM ratings", con)
-con.close()
 
-# Drop unimportant columns
-df = df.drop(columns=["song_name", "key", "audio_mode", "time_signature"])
+DATABASE_FILENAME = "SongPop.db"
+# The trained network and the fitted scaler, loaded by inference_server.py
+KERAS_MODEL_FILENAME = "simple_popularity_model.keras"
+PREPROCESSOR_FILENAME = "simple_popularity_preprocessor.pkl"
+# Best weights so far, rewritten whenever validation loss improves
+CHECKPOINT_FILENAME = "simple_popularity_checkpoint.keras"
 
-# Split the target and features
-y = df["song_popularity"].astype(float)
-X = df.drop(columns=["song_popularity"])
+# Ratings rows read from SQLite at a time
+CHUNK_SIZE = 8192
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "256"))
+# Adam's step size at batch size 32, scaled linearly with the batch size
+BASE_LEARNING_RATE = 0.001
+LEARNING_RATE = BASE_LEARNING_RATE * BATCH_SIZE / 32
+MAX_EPOCHS = 50
+PATIENCE = 5
+# Rows with rowid % VALIDATION_BUCKETS == 0 are the validation set
+VALIDATION_BUCKETS = 5
 
+# Only the useful columns are read (song_name, key, audio_mode and time_signature are skipped)
+ratings_columns = [
+    "song_popularity", "song_duration_ms", "acousticness", "danceability", "energy",
+    "instrumentalness", "liveness", "loudness", "speechiness", "tempo", "audio_valence",
+]
 # Now contains only numberic features
-numeric_cols = list(X.columns)
-
-# Preprocess
-preprocessor = ColumnTransformer(
-    transformers=[
-        ("num", StandardScaler(), numeric_cols),
-    ],
-    remainder="drop"
-)
-
-X_processed = preprocessor.fit_transform(X)
-X_processed = X_processed.astype(np.float32)
-y = y.astype(np.float32)
-
-X_train, X_val, y_train, y_val = train_test_split(
-    X_processed, y, test_size=0.2, random_state=42
-)
-
-# Create the model
-input_dim = X_train.shape[1]
-
-model = models.Sequential([
-    layers.Dense(64, activation="relu", input_shape=(input_dim,)),
-    layers.Dropout(0.2),
-    layers.Dense(64, activation="relu"),
-    layers.Dropout(0.2),
-    layers.Dense(1)
-])
-
-model.compile(
-    optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
-    loss="mse",
-    metrics=["mae"]
-)
-
-model.summary()
-
-# Train the model
-history = model.fit(
-    X_train, y_train,
-    validation_data=(X_val, y_val),
-    epochs=50,
-    batch_size=32,
-    verbose=1
-)
-
-# Evaluate the model
-loss, mae = model.evaluate(X_val, y_val, verbose=0)
-print(f"Validation MAE: {mae}")
-
-# Prediction
-pred = model.predict(X_val[:5])
-print("Predictions (first 5 validation samples):")
-print(pred)
+numeric_cols = ratings_columns[1:]
+
+
+def read_chunk(first, last, validation, database=DATABASE_FILENAME):
+    """Returns the ratings rows of one rowid range and one side of the split as float32, target first"""
+    from sql_arrays import read_matrix
+
+    con = instrument.connect(f"file:{database}?mode=ro", uri=True)
+    where = f"WHERE rowid BETWEEN ? AND ? AND (rowid % {VALIDATION_BUCKETS} = 0) = ?"
+    params = (first, last, validation)
+    # Counted first so the rows are copied straight into an array of the right size
+    rows = con.execute(f"SELECT count(*) FROM ratings {where}", params).fetchone()[0]
+    chunk = read_matrix(con, f"SELECT {', '.join(ratings_columns)} FROM ratings {where}",
+                        params, len(ratings_columns), np.float32, rows)
+    con.close()
+    return chunk
+
+
+def load_ranges(database=DATABASE_FILENAME):
+    """Returns the (first, last) rowid ranges the ratings table is read in"""
+    con = instrument.connect(database)
+    ranges = np.array(list(rowid_ranges(con, CHUNK_SIZE, table="ratings")), dtype=np.int64)
+    con.close()
+    return ranges.reshape(-1, 2)
+
+
+def fit_preprocessor(ranges, database=DATABASE_FILENAME):
+    """One streaming pass for the scaling statistics of the training rows"""
+    import pandas as pd
+    from sklearn.preprocessing import StandardScaler
+
+    preprocessor = StandardScaler()
+    for first, last in ranges:
+        chunk = read_chunk(int(first), int(last), False, database)
+        if len(chunk):
+            preprocessor.partial_fit(pd.DataFrame(chunk[:, 1:], columns=numeric_cols))
+    return preprocessor
+
+
+def batches(preprocessor, first, last, validation, database=DATABASE_FILENAME):
+    """Yields scaled (X, y) batches from one rowid range, shuffled unless validating"""
+    import pandas as pd
+
+    chunk = read_chunk(int(first), int(last), bool(validation), database)
+    if not validation:
+        np.random.shuffle(chunk)
+    X = preprocessor.transform(pd.DataFrame(chunk[:, 1:], columns=numeric_cols)).astype(np.float32, copy=False)
+    y = chunk[:, 0]
+    for start in range(0, len(chunk), BATCH_SIZE):
+        yield X[start:start + BATCH_SIZE], y[start:start + BATCH_SIZE]
+
+
+def make_dataset(ranges, preprocessor, validation, database=DATABASE_FILENAME):
+    """Reads several chunks in parallel, interleaving their batches, with prefetching"""
+    import tensorflow as tf
+
+    signature = (
+        tf.TensorSpec(shape=(None, len(numeric_cols)), dtype=tf.float32),
+        tf.TensorSpec(shape=(None,), dtype=tf.float32),
+    )
+    dataset = tf.data.Dataset.from_tensor_slices(ranges)
+    if not validation:
+        dataset = dataset.shuffle(len(ranges), reshuffle_each_iteration=True)
+    dataset = dataset.interleave(
+        lambda r: tf.data.Dataset.from_generator(
+            lambda first, last: batches(preprocessor, first, last, validation, database),
+            args=(r[0], r[1]), output_signature=signature
+        ),
+        cycle_length=4,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=validation,
+    )
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def build_model():
+    """Returns the compiled network"""
+    import tensorflow as tf
+    from tensorflow.keras import layers, models
+
+    input_dim = len(numeric_cols)
+    model = models.Sequential([
+        layers.Dense(64, activation="relu", input_shape=(input_dim,)),
+        layers.Dropout(0.2),
+        layers.Dense(64, activation="relu"),
+        layers.Dropout(0.2),
+        layers.Dense(1)
+    ])
+
+    model.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE),
+        loss="mse",
+        metrics=["mae"]
+    )
+    return model
+
+
+def fit(model, train_ds, val_ds, epochs=MAX_EPOCHS):
+    """Trains the model, stopping once validation loss stops improving"""
+    import tensorflow as tf
+
+    return model.fit(
+        train_ds,
+        validation_data=val_ds,
+        epochs=epochs,
+        callbacks=[
+            tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=PATIENCE, restore_best_weights=True),
+            tf.keras.callbacks.ModelCheckpoint(CHECKPOINT_FILENAME, monitor="val_loss", save_best_only=True),
+        ],
+        verbose=1
+    )
+
+
+def main():
+    import joblib
+
+    with instrument.stage("load_ranges") as s:
+        ranges = load_ranges()
+        s.rows_out = len(ranges)
+    with instrument.stage("fit_preprocessor") as s:
+        preprocessor = fit_preprocessor(ranges)
+        s.rows_in = int(np.max(preprocessor.n_samples_seen_))
+    train_ds = make_dataset(ranges, preprocessor, False)
+    val_ds = make_dataset(ranges, preprocessor, True)
+
+    # Create the model
+    model = build_model()
+    model.summary()
+
+    # Train the model (tf.data reads and scales the batches on its own threads,
+    # so their SQLite time and CPU time are counted here too)
+    with instrument.stage("fit", rows_in=int(np.max(preprocessor.n_samples_seen_))):
+        fit(model, train_ds, val_ds)
+
+    # Evaluate the model
+    with instrument.stage("evaluate"):
+        loss, mae = model.evaluate(val_ds, verbose=0)
+    print(f"Validation MAE: {mae}")
+
+    # Save the model and the scaler it was trained with
+    with instrument.stage("save"):
+        model.save(KERAS_MODEL_FILENAME)
+        joblib.dump(preprocessor, PREPROCESSOR_FILENAME)
+    print(f"Model saved to '{KERAS_MODEL_FILENAME}', preprocessor to '{PREPROCESSOR_FILENAME}'")
+
+    # Prediction
+    X_val, _ = next(iter(val_ds))
+    pred = model.predict(X_val[:5])
+    print("Predictions (first 5 validation samples):")
+    print(pred)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Columnar, memory-mappable snapshots of the frames the models train on
+
+Snapshots are Arrow IPC files written in fixed-size record batches ("row
+groups"). Each batch's min/max per numeric column is kept in the file
+metadata, so filtered reads can skip whole batches, and reads only touch the
+projected columns of the batches they keep.
+"""
+import json
+import os
+import operator
+import pyarrow as pa
+import pyarrow.compute as pc
+
+ROW_GROUP_SIZE = 65536
+INDEX_COLUMN = "__index__"
+
+OPERATORS = {
+    "==": (operator.eq, pc.equal),
+    "<": (operator.lt, pc.less),
+    "<=": (operator.le, pc.less_equal),
+    ">": (operator.gt, pc.greater),
+    ">=": (operator.ge, pc.greater_equal),
+}
+
+
+def _batch_stats(batch):
+    stats = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+            bounds = pc.min_max(column)
+            if bounds["min"].is_valid:
+                stats[name] = [bounds["min"].as_py(), bounds["max"].as_py()]
+    return stats
+
+
+def export_snapshot(df, path, data_key, row_group_size=ROW_GROUP_SIZE, list_columns=()):
+    """Writes a DataFrame to an Arrow IPC snapshot tagged with the data it came from
+
+    list_columns holds object columns whose cells are 1-D int32 arrays. The
+    frame's index is stored too, so a reopened snapshot lines up row for row.
+    Categorical columns are stored as dictionary columns and reopen as categoricals.
+    """
+    arrays = {INDEX_COLUMN: pa.array(df.index.to_numpy())}
+    for name in df.columns:
+        if name in list_columns:
+            arrays[name] = pa.array(list(df[name]), type=pa.list_(pa.int32()))
+        elif df[name].dtype == "category":
+            arrays[name] = pa.array(df[name], from_pandas=True)
+        else:
+            arrays[name] = pa.array(df[name].to_numpy(), from_pandas=True)
+    table = pa.table(arrays)
+
+    batches = table.to_batches(max_chunksize=row_group_size)
+    metadata = {
+        "data_key": data_key,
+        "row_groups": [_batch_stats(batch) for batch in batches],
+    }
+    schema = table.schema.with_metadata({"snapshot": json.dumps(metadata)})
+
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+    os.replace(tmp_path, path)
+
+
+def _keep_batch(stats, filters):
+    for column, op, value in filters:
+        if column not in stats:
+            continue
+        low, high = stats[column]
+        if op == "==" and not low <= value <= high:
+            return False
+        if op in ("<", "<=") and not OPERATORS[op][0](low, value):
+            return False
+        if op in (">", ">=") and not OPERATORS[op][0](high, value):
+            return False
+    return True
+
+
+def snapshot_key(path):
+    """Returns the data_key a snapshot was written with, or None if there is no snapshot"""
+    if not os.path.exists(path):
+        return None
+    schema = pa.ipc.open_file(pa.memory_map(path, "r")).schema
+    return json.loads(schema.metadata[b"snapshot"])["data_key"]
+
+
+def open_snapshot(path, data_key=None, columns=None, filters=()):
+    """Memory-maps a snapshot and returns it as a DataFrame, or None if it is missing or stale
+
+    columns projects the read onto a subset of columns, and filters is a list of
+    (column, op, value) tuples with op one of ==, <, <=, >, >=.
+    """
+    if not os.path.exists(path):
+        return None
+    source = pa.memory_map(path, "r")
+    reader = pa.ipc.open_file(source)
+    metadata = json.loads(reader.schema.metadata[b"snapshot"])
+    if data_key is not None and metadata["data_key"] != data_key:
+        return None
+
+    filter_columns = [f[0] for f in filters]
+    names = [n for n in reader.schema.names if n != INDEX_COLUMN]
+    wanted = [INDEX_COLUMN] + (list(columns) if columns is not None else names)
+    read_columns = wanted + [c for c in filter_columns if c not in wanted]
+
+    batches = []
+    for i, stats in enumerate(metadata["row_groups"]):
+        if not _keep_batch(stats, filters):
+            continue
+        batch = reader.get_batch(i).select(read_columns)
+        if filters:
+            mask = None
+            for column, op, value in filters:
+                condition = OPERATORS[op][1](batch.column(column), value)
+                condition = pc.fill_null(condition, False)
+                mask = condition if mask is None else pc.and_(mask, condition)
+            batch = batch.filter(mask)
+        batches.append(batch.select(wanted))
+
+    if batches:
+        table = pa.Table.from_batches(batches)
+    else:
+        table = reader.schema.empty_table().select(wanted)
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    return df.set_index(INDEX_COLUMN).rename_axis(None)
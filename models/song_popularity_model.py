@@ -1,195 +1,353 @@
 #!/usr/bin/env python3
-
-import sqlite3
-import re
+"""Predicts synthetic song popularity from chords, lyrics, duration and year
+
+    song_popularity_model.py                 train unless a registered model matches, then evaluate
+    song_popularity_model.py train           the same, with --force to retrain anyway
+    song_popularity_model.py evaluate        score the current model on the test split
+    song_popularity_model.py predict ID...   score only the given track ids
+    song_popularity_model.py train-streaming out-of-core training on hashed features
+    song_popularity_model.py models          list the registered versions
+    song_popularity_model.py pin VERSION     score with VERSION until unpin
+    song_popularity_model.py prune           delete all but the newest versions
+
+Fitted pipelines are kept in model_registry.py's registry, keyed by a
+fingerprint of the source tables, the feature setup and the search's
+param_dist, so a model is only retrained when one of those changed and a
+model trained on different data is never picked up silently.
+
+Heavy modules are imported inside the functions that need them, so predict
+only pays for pandas, sklearn and the model itself.
+"""
+import argparse
 import os
-import joblib
-import pandas as pd
-import numpy as np
-
-# Sklearn imports
-from sklearn.model_selection import train_test_split, RandomizedSearchCV
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.ensemble import GradientBoostingRegressor
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import mean_absolute_error
-
-MODEL_FILENAME = "song_popularity_model.pkl"
-DATABASE_FILENAME = "SongPop.db"
+import sys
 
-# 1. Load in dataset from database
-print("Loading data from database...")
-con = sqlite3.connect(DATABASE_FILENAME)
-
-chords = pd.read_sql_query("""
-    SELECT * FROM chords
-    WHERE spotify_song_id IS NOT NULL;
-""", con)
-
-songs = pd.read_sql_query("""
-    SELECT track_id, title, artist_name, artist_hotttnesss, artist_familiarity, duration, year
-    FROM songs
-    WHERE title IS NOT NULL;
-""", con)
-
-id_translations = pd.read_sql_query("""
-    SELECT * FROM id_translations
-    WHERE track_id IS NOT NULL;
-""", con)
-
-lyrics_raw = pd.read_sql_query("""
-    SELECT track_id, word, count
-    FROM lyrics
-    WHERE is_test = 0
-    AND track_id IN (SELECT track_id FROM songs)
-""", con)
-con.close()
-
-# Processing lyrics
-def create_lyric_string(group):
-    return " ".join((group['word'] + " ") * group['count'])
-
-print("Processing lyrics...")
-lyrics_grouped = lyrics_raw.groupby('track_id')[['word', 'count']].apply(
-    lambda x: " ".join((x['word'] + " ") * x['count'])
-).reset_index(name='lyrics_text')
-
-# 2. Join Tables
-print("Merging data...")
-
-# Normalize text for merging
-songs['title_norm'] = songs['title'].str.lower().str.strip()
-songs['artist_norm'] = songs['artist_name'].str.lower().str.strip()
-id_translations['title_norm'] = id_translations['track_name'].str.lower().str.strip()
-id_translations['artist_norm'] = id_translations['artist_name'].str.lower().str.strip()
-
-# Merge chords to id_translations
-merged1 = chords.merge(
-    id_translations,
-    left_on=['spotify_song_id', 'spotify_artist_id'],
-    right_on=['track_id', 'artist_id'],
-    how='inner'
-)
-
-# Merge songs (using suffixes to handle duplicate artist_name columns)
-merged2 = merged1.merge(
-    songs,
-    left_on=['title_norm', 'artist_norm'],
-    right_on=['title_norm', 'artist_norm'],
-    how='inner',
-    suffixes=('_remove', '')
-)
-
-# Merge lyrics
-merged = merged2.merge(
-    lyrics_grouped,
-    left_on='track_id',
-    right_on='track_id',
-    how='left'
-)
-
-# Fill missing lyrics
-merged['lyrics_text'] = merged['lyrics_text'].fillna("")
-
-# 3. Feature Engineering
-
-# A. Calculate Target
-merged["synthetic_popularity"] = (
-      0.6 * merged["artist_hotttnesss"].fillna(0)
-    + 0.4 * merged["artist_familiarity"].fillna(0)
-) * 100
-
-# B. Clean Chords
-def clean_chord_string(text):
-    if text is None or not isinstance(text, str):
-        return ""
-    text = re.sub(r'<[^>]+>', ' ', text)
-    return text.strip()
-
-merged['chords_clean'] = merged['chords'].apply(clean_chord_string)
-
-# C. Define Feature Set
-feature_columns = ["duration", "year", "chords_clean", "lyrics_text"]
+# db/instrument.py times the stages below when STAGE_TRACE is set
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+import instrument
+from model_registry import REGISTRY_DIR, MODEL_FILE, ModelRegistry, changed_parts, fingerprint
 
+STREAMING_MODEL_FILENAME = "song_popularity_streaming.pkl"
+DATABASE_FILENAME = "SongPop.db"
+FEATURE_CACHE_DIR = "feature_cache"
+SNAPSHOT_FILENAME = "training_frame.arrow"
+# training_set rows read at a time by batch scoring and streaming training
+CHUNK_SIZE = 20000
+# Threads reading training_set in parallel when the training frame is built
+READ_THREADS = int(os.getenv("READ_THREADS", "1"))
+
+# "halving" (successive halving over a larger space) or "random" (the original search)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "halving")
+# "gbr" (GradientBoostingRegressor) or "hist" (HistGradientBoostingRegressor)
+REGRESSOR = os.getenv("REGRESSOR", "gbr")
+
+# Feature set - chord_tokens holds the packed chord ids db/add_chords.py
+# parsed out of each progression at ingest
+feature_columns = ["duration", "year", "chord_tokens", "lyrics_bag"]
 cols_to_keep = ["title", "artist_name"] + feature_columns + ["synthetic_popularity"]
-df = merged[cols_to_keep].dropna()
-
-df_train, df_test = train_test_split(df, test_size=0.20, random_state=42)
 
-X_train = df_train[feature_columns]
-y_train = df_train["synthetic_popularity"]
+# Types the columns are read as (see sql_arrays.py). Nullable numbers stay
+# floats so featurize() can still drop them, and artists repeat enough to be
+# worth storing as category codes
+training_dtypes = {
+    "track_id": "object",
+    "title": "object",
+    "artist_name": "category",
+    "artist_hotttnesss": "float32",
+    "artist_familiarity": "float32",
+    "duration": "float32",
+    "year": "float32",
+    "chord_tokens": "object",
+}
+# Both ids end up as int32 in the bags anyway
+lyrics_dtypes = {"track_id": "category", "word_id": "int32", "count": "int32"}
+
+
+def read_training(con, where="", params=(), workers=1):
+    """Reads training_set rows (optionally filtered by a WHERE condition) into a frame"""
+    from sql_arrays import read_table
+    # training_set is the chords -> id_translations -> songs join, materialized
+    # and indexed by db/add_training_set.py
+    return read_table(con, "training_set", training_dtypes, where, params, workers=workers)
+
+
+def read_lyrics(con, where="", params=()):
+    """Reads the (track_id, word_id, count) lyric rows of the training_set rows a WHERE condition picks"""
+    from sql_arrays import read_query
+    # Lyrics stay a bag of words - word ids come from the words table's rowid
+    return read_query(con, f"""
+        SELECT l.track_id, w.rowid - 1 AS word_id, l.count
+        FROM lyrics l
+        JOIN words w ON w.word = l.word
+        WHERE l.is_test = 0
+        AND l.track_id IN (SELECT track_id FROM training_set {f"WHERE {where}" if where else ""})
+        ORDER BY l.track_id
+    """, params, lyrics_dtypes)
+
+
+def load(con, track_ids=None, rowids=None, workers=1):
+    """Loads training_set rows with their lyric bags attached
+
+    With track_ids, only those tracks (and their lyrics) are read. rowids is
+    an inclusive (first, last) range of training_set rowids to read instead.
+    With workers > 1, training_set is read on that many threads.
+    """
+    from lyrics_features import attach_bags, lyrics_bags
+
+    if rowids is not None:
+        where, params = "rowid BETWEEN ? AND ?", list(rowids)
+    elif track_ids is None:
+        where, params = "", []
+    else:
+        track_ids = list(track_ids)
+        where, params = f"track_id IN ({','.join('?' * len(track_ids))})", track_ids
+
+    with instrument.stage("read_training") as s:
+        training = read_training(con, where, params, workers)
+        s.rows_out = len(training)
+    with instrument.stage("read_lyrics") as s:
+        lyrics = read_lyrics(con, where, params)
+        s.rows_out = len(lyrics)
+    # Attach lyrics (songs without any get an empty bag)
+    with instrument.stage("lyric_bags", rows_in=len(lyrics)):
+        training['lyrics_bag'] = attach_bags(training['track_id'], lyrics_bags(lyrics))
+    return training
+
+
+def rowid_ranges(con, chunk_size=CHUNK_SIZE, table="training_set"):
+    """Yields inclusive (first, last) rowid ranges of about chunk_size rows of a table"""
+    first = 0
+    while True:
+        row = con.execute(
+            f"SELECT min(rowid), max(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?)",
+            (first, chunk_size),
+        ).fetchone()
+        if row[0] is None:
+            return
+        yield row
+        first = row[1]
+
+
+def synthetic_popularity(rows):
+    """Returns the target: a 0-100 blend of the artist's hotttnesss and familiarity"""
+    return (
+          0.6 * rows["artist_hotttnesss"].fillna(0)
+        + 0.4 * rows["artist_familiarity"].fillna(0)
+    ) * 100
+
+
+def featurize(merged):
+    """Adds the target and keeps only the feature set"""
+    # A. Calculate Target
+    merged["synthetic_popularity"] = synthetic_popularity(merged)
+
+    # B. Songs without chords get an empty sequence
+    merged['chord_tokens'] = merged['chord_tokens'].fillna(b"")
+
+    # C. Keep only the feature set
+    return merged[["track_id"] + cols_to_keep].dropna().set_index("track_id")
+
+
+def training_frame(database=DATABASE_FILENAME):
+    """Returns (frame, vocabulary, chord_vocabulary, data_key), from the snapshot if it is current"""
+    from chord_features import load_chord_vocabulary
+    from feature_cache import source_fingerprint
+    from lyrics_features import flatten_bags, load_vocabulary, unflatten_bags
+    from snapshot import export_snapshot, open_snapshot
+
+    with instrument.stage("training_frame") as s:
+        con = instrument.connect(database)
+        vocabulary = load_vocabulary(con)
+        chord_vocabulary = load_chord_vocabulary(con)
+        data_key = source_fingerprint(con)
+
+        with instrument.stage("open_snapshot"):
+            df = open_snapshot(SNAPSHOT_FILENAME, data_key, columns=cols_to_keep)
+        if df is not None:
+            print(f"Loaded training frame from snapshot '{SNAPSHOT_FILENAME}'")
+            df['lyrics_bag'] = unflatten_bags(df['lyrics_bag'])
+        else:
+            print("Loading data from database...")
+            merged = load(con, workers=READ_THREADS)
+            with instrument.stage("featurize", rows_in=len(merged)):
+                df = featurize(merged)
+            print(f"Writing snapshot '{SNAPSHOT_FILENAME}'")
+            with instrument.stage("write_snapshot"):
+                export_snapshot(
+                    df.assign(lyrics_bag=flatten_bags(df['lyrics_bag'])),
+                    SNAPSHOT_FILENAME, data_key, list_columns=("lyrics_bag",)
+                )
+        con.close()
+        s.rows_out = len(df)
+    return df, vocabulary, chord_vocabulary, data_key
+
+
+def split(df):
+    """Returns the (train, test) split every subcommand agrees on"""
+    from sklearn.model_selection import train_test_split
+    return train_test_split(df, test_size=0.20, random_state=42)
+
+
+def make_preprocess(vocabulary, chord_vocabulary):
+    """Returns the (unfitted) prep step: chord and lyric TF-IDF plus the numeric columns"""
+    from sklearn.compose import ColumnTransformer
+    from chord_features import ChordNgramTfidf
+    from lyrics_features import LyricBagTfidf
+
+    return ColumnTransformer(
+        transformers=[
+            ("chords", ChordNgramTfidf(vocabulary=chord_vocabulary, ngram_range=(1, 3), max_features=1000), "chord_tokens"),
+            ("lyrics", LyricBagTfidf(vocabulary=vocabulary, stop_words='english', max_features=1000), "lyrics_bag"),
+            ("num", "passthrough", ["duration", "year"])
+        ]
+    )
 
-X_test = df_test[feature_columns]
-y_test = df_test["synthetic_popularity"]
 
-# 4 & 5. Model Loading OR Training
+def model_components(vocabulary, chord_vocabulary, data_key):
+    """Returns what a trained model depends on, for its registry fingerprint"""
+    import joblib
+    from tuning import HALVING_CANDIDATES, HALVING_FACTOR, MAX_ROUNDS, MIN_ROUNDS, search_space
+
+    return {
+        "data": data_key,
+        "features": {
+            "columns": feature_columns,
+            # Covers the vocabularies, n-gram ranges and max_features defaults
+            "preprocess": joblib.hash(make_preprocess(vocabulary, chord_vocabulary)),
+        },
+        "search": {
+            "mode": SEARCH_MODE,
+            "regressor": REGRESSOR,
+            "param_dist": search_space(REGRESSOR, SEARCH_MODE),
+            "schedule": [HALVING_CANDIDATES, HALVING_FACTOR, MIN_ROUNDS, MAX_ROUNDS],
+        },
+    }
 
-if os.path.exists(MODEL_FILENAME):
-    print(f"\nFound existing model '{MODEL_FILENAME}'. Loading...")
-    best_model = joblib.load(MODEL_FILENAME)
 
-else:
-    print(f"\nNo model found at '{MODEL_FILENAME}'. Starting training...")
+def current_components(database=DATABASE_FILENAME):
+    """Returns model_components for the database as it is now, without loading training_set"""
+    from chord_features import load_chord_vocabulary
+    from feature_cache import source_fingerprint
+    from lyrics_features import load_vocabulary
+
+    con = instrument.connect(database)
+    try:
+        return model_components(load_vocabulary(con), load_chord_vocabulary(con), source_fingerprint(con))
+    finally:
+        con.close()
+
+
+def resolve_model(registry, database=DATABASE_FILENAME, version=None, components=None):
+    """Returns (metadata, model path) of the version to score with
+
+    That is version if given, else the pinned version, else the newest one
+    trained on the current data and settings; raises LookupError otherwise.
+    The current components are only computed (which builds the preprocessing
+    and fingerprints the sources) for that last case; an explicit or pinned
+    version is checked against components only when the caller has them.
+    """
+    if components is None and version is None and registry.pinned() is None:
+        components = current_components(database)
+    key = fingerprint(components) if components is not None else None
+    meta = registry.resolve(version, key)
+    if key is not None and meta["fingerprint"] != key:
+        print(f"Note: version {meta['version']} was trained with different "
+              f"{', '.join(changed_parts(meta, components))}")
+    return meta, registry.path(meta["version"], MODEL_FILE)
+
+
+def train(df_train, vocabulary, chord_vocabulary, data_key, model_path=None):
+    """Tunes and fits the pipeline on df_train, saving it to model_path if one is given"""
+    import joblib
+    import numpy as np
+    from sklearn.pipeline import Pipeline
+    from feature_cache import CachedPreprocessor
+    from shared_features import SharedTfidf, materialize
+    from tuning import make_regressor, make_search, saved_params
+
+    X_train = df_train[feature_columns]
+    y_train = df_train["synthetic_popularity"]
 
     # A. Pipeline Setup
-    preprocess = ColumnTransformer(
-        transformers=[
-            ("chords", TfidfVectorizer(token_pattern=r"\S+", ngram_range=(1, 3), max_features=1000), "chords_clean"),
-            ("lyrics", TfidfVectorizer(stop_words='english', max_features=1000), "lyrics_text"),
-            ("num", "passthrough", ["duration", "year"])
-        ]
-    )
+    preprocess = make_preprocess(vocabulary, chord_vocabulary)
 
+    # B. Hyperparameter Tuning
+    # The count matrices are written once to memory-mapped buffers and the
+    # search only sees row positions, so parallel workers share one copy
+    with instrument.stage("materialize", rows_in=len(X_train)):
+        shared_key = materialize(X_train, vocabulary, chord_vocabulary, FEATURE_CACHE_DIR, data_key)
+    train_rows = np.arange(len(X_train)).reshape(-1, 1)
+    search_pipeline = Pipeline(steps=[
+        ("prep", SharedTfidf(cache_dir=FEATURE_CACHE_DIR, key=shared_key)),
+    ] + make_regressor(REGRESSOR))
+
+    print(f"Starting Hyperparameter Tuning ({SEARCH_MODE} search, {REGRESSOR} regressor)...")
+    random_search = make_search(search_pipeline, REGRESSOR, SEARCH_MODE, refit=False)
+    # Candidates are fitted in worker processes, so cpu_s only covers this one
+    with instrument.stage("search", rows_in=len(X_train)):
+        random_search.fit(train_rows, y_train.to_numpy())
+    print(f"Best parameters: {random_search.best_params_}")
+
+    # The saved model is refitted on the text columns with the best parameters,
+    # so it doesn't depend on the buffers. The fitted vectorizers and their
+    # TF-IDF matrices are cached on disk, so repeat runs only refit the regressor
     pipeline = Pipeline(steps=[
-        ("prep", preprocess),
-        ("reg", GradientBoostingRegressor(random_state=42))
-    ])
+        ("prep", CachedPreprocessor(preprocess, cache_dir=FEATURE_CACHE_DIR, data_key=data_key)),
+    ] + make_regressor(REGRESSOR))
+    best_model = pipeline.set_params(**saved_params(random_search.best_params_))
+    with instrument.stage("refit", rows_in=len(X_train)):
+        best_model.fit(X_train, y_train)
 
-    # B. Hyperparameter Tuning
-    print("Starting Hyperparameter Tuning...")
-
-    param_dist = {
-        'reg__n_estimators': [200, 300],
-        'reg__learning_rate': [0.1, 0.2],
-        'reg__max_depth': [4, 5],
-        'prep__chords__max_features': [500, 1000],
-        'prep__lyrics__max_features': [500, 1000]
-    }
+    # The saved model keeps the plain fitted ColumnTransformer, not the cache wrapper
+    best_model.steps[0] = ("prep", best_model.named_steps['prep'].prep_)
 
-    random_search = RandomizedSearchCV(
-        pipeline,
-        param_distributions=param_dist,
-        n_iter=10,
-        cv=5,
-        n_jobs=-1,
-        verbose=1,
-        scoring='neg_mean_absolute_error',
-        random_state=42
-    )
+    # C. Save
+    if model_path is not None:
+        with instrument.stage("save"):
+            joblib.dump(best_model, model_path)
+        print(f"Training complete. Model saved to '{model_path}'.")
+    return best_model
 
-    random_search.fit(X_train, y_train)
-    best_model = random_search.best_estimator_
 
-    # C. Save
-    joblib.dump(best_model, MODEL_FILENAME)
-    print(f"Training complete. Model saved to '{MODEL_FILENAME}'.")
+def load_model(model_path):
+    """Loads the saved pipeline, memory-mapping its arrays instead of copying them"""
+    import joblib
+    return joblib.load(model_path, mmap_mode="r")
+
 
+def evaluate(best_model, df_test):
+    """Prints R^2, MAE and the top features on the test set, and returns (r2, mae)"""
+    from sklearn.metrics import mean_absolute_error
 
-# 6. Evaluation
+    X_test = df_test[feature_columns]
+    y_test = df_test["synthetic_popularity"]
 
-print("\nEvaluating model on Test Set...")
-predictions = best_model.predict(X_test)
-mae = mean_absolute_error(y_test, predictions)
-r2 = best_model.score(X_test, y_test)
+    print("\nEvaluating model on Test Set...")
+    with instrument.stage("evaluate", rows_in=len(X_test)) as s:
+        predictions = best_model.predict(X_test)
+        mae = mean_absolute_error(y_test, predictions)
+        r2 = best_model.score(X_test, y_test)
+        s.rows_out = len(predictions)
 
-print("\n--- Model Performance ---")
-print(f"R^2 Score: {r2:.4f}")
-print(f"Mean Absolute Error (MAE): {mae:.2f}")
+    print("\n--- Model Performance ---")
+    print(f"R^2 Score: {r2:.4f}")
+    print(f"Mean Absolute Error (MAE): {mae:.2f}")
 
-# Only try to print feature importance if the model supports it
-if hasattr(best_model.named_steps['reg'], 'feature_importances_'):
-    print("\n--- Top Features ---")
+    # Only try to print feature importance if the model supports it
+    top = feature_importances(best_model)
+    if top:
+        print("\n--- Top Features ---")
+        for i, (name, importance) in enumerate(top):
+            print(f"{i+1}. {name} ({importance:.4f})")
+    return r2, mae
+
+
+def feature_importances(best_model, n=50):
+    """Returns the n most important [feature name, importance] pairs, or [] if the regressor has none"""
+    import numpy as np
+
+    if not hasattr(best_model.named_steps['reg'], 'feature_importances_'):
+        return []
     prep = best_model.named_steps['prep']
     reg = best_model.named_steps['reg']
 
@@ -204,40 +362,187 @@ if hasattr(best_model.named_steps['reg'], 'feature_importances_'):
 
     all_names = np.concatenate([chord_names, lyric_names, num_names])
     importances = reg.feature_importances_
-    indices = np.argsort(importances)[::-1]
-
-    for i in range(50):
-        idx = indices[i]
-        print(f"{i+1}. {all_names[idx]} ({importances[idx]:.4f})")
-
-# Test 30 Random Songs and Display Results
-print("\n" + "="*80)
-print("PREDICTING 30 RANDOM SONGS FROM TEST SET")
-print("="*80)
-
-# 1. Sample 30 random songs from the test dataframe
-sample_df = df_test.sample(30, random_state=101)
-
-# 2. Isolate X and y for this sample
-X_sample = sample_df[feature_columns]
-y_actual = sample_df["synthetic_popularity"].values
-
-# 3. Predict
-y_pred = best_model.predict(X_sample)
-
-# 4. Print Table
-print(f"{'Title':<35} | {'Artist':<25} | {'Actual':<6} | {'Pred':<6} | {'Diff':<6}")
-print("-" * 90)
-
-for i in range(len(sample_df)):
-    title = sample_df.iloc[i]['title']
-    artist = sample_df.iloc[i]['artist_name']
-    actual = y_actual[i]
-    pred = y_pred[i]
-    diff = abs(actual - pred)
-
-    # Truncate long titles so the table doesn't break
-    title_fmt = (title[:32] + '..') if len(title) > 32 else title
-    artist_fmt = (artist[:22] + '..') if len(artist) > 22 else artist
-
-    print(f"{title_fmt:<35} | {artist_fmt:<25} | {actual:.1f}   | {pred:.1f}   | {diff:.1f}")
\ No newline at end of file
+    indices = np.argsort(importances)[::-1][:n]
+    return [[str(all_names[idx]), float(importances[idx])] for idx in indices]
+
+
+def print_table(rows, y_pred, y_actual=None):
+    """Prints title, artist and prediction (plus actual and difference when known)"""
+    if y_actual is None:
+        print(f"{'Title':<35} | {'Artist':<25} | {'Pred':<6}")
+        print("-" * 72)
+    else:
+        print(f"{'Title':<35} | {'Artist':<25} | {'Actual':<6} | {'Pred':<6} | {'Diff':<6}")
+        print("-" * 90)
+
+    for i in range(len(rows)):
+        title = rows.iloc[i]['title']
+        artist = rows.iloc[i]['artist_name']
+        pred = y_pred[i]
+
+        # Truncate long titles so the table doesn't break
+        title_fmt = (title[:32] + '..') if len(title) > 32 else title
+        artist_fmt = (artist[:22] + '..') if len(artist) > 22 else artist
+
+        if y_actual is None:
+            print(f"{title_fmt:<35} | {artist_fmt:<25} | {pred:.1f}")
+        else:
+            actual = y_actual[i]
+            diff = abs(actual - pred)
+            print(f"{title_fmt:<35} | {artist_fmt:<25} | {actual:.1f}   | {pred:.1f}   | {diff:.1f}")
+
+
+def show_sample(best_model, df_test, n=30):
+    """Predicts n random songs from the test set and prints them next to the actual values"""
+    print("\n" + "="*80)
+    print(f"PREDICTING {n} RANDOM SONGS FROM TEST SET")
+    print("="*80)
+
+    sample_df = df_test.sample(n, random_state=101)
+    y_pred = best_model.predict(sample_df[feature_columns])
+    print_table(sample_df, y_pred, sample_df["synthetic_popularity"].values)
+
+
+def predict(best_model, track_ids, database=DATABASE_FILENAME):
+    """Scores only the given tracks; returns one row per track (indexed by track_id) with a prediction column
+
+    A track matching several training_set rows (one per chord progression)
+    gets the mean of their predictions, as batch_score.py and the inference
+    server give it; matches says how many rows that was.
+    """
+    con = instrument.connect(database)
+    try:
+        rows = featurize(load(con, track_ids))
+    finally:
+        con.close()
+    with instrument.stage("predict", rows_in=len(rows)) as s:
+        rows["prediction"] = best_model.predict(rows[feature_columns]) if len(rows) else []
+        per_track = rows.groupby(level=0, sort=False)["prediction"]
+        rows["matches"] = per_track.transform("size")
+        rows["prediction"] = per_track.transform("mean")
+        rows = rows[~rows.index.duplicated()]
+        s.rows_out = len(rows)
+    return rows
+
+
+def list_versions(registry, components):
+    """Prints every registered version, marking the pinned one and those matching the current data"""
+    current, pinned = fingerprint(components), registry.pinned()
+    print(f"{'Version':>7} | {'Created':<25} | {'Fingerprint':<16} | {'R^2':>7} | {'MAE':>6} | Notes")
+    print("-" * 96)
+    for meta in registry.versions():
+        metrics = meta["metrics"]
+        notes = ["pinned"] if meta["version"] == pinned else []
+        if meta["fingerprint"] == current:
+            notes.append("current")
+        else:
+            notes.append(f"stale {', '.join(changed_parts(meta, components))}")
+        print(f"{meta['version']:>7} | {meta['created_at']:<25} | {meta['fingerprint']:<16} | "
+              f"{metrics.get('r2', float('nan')):>7.4f} | {metrics.get('mae', float('nan')):>6.2f} | "
+              f"{', '.join(notes)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=DATABASE_FILENAME)
+    parser.add_argument("--registry", default=REGISTRY_DIR)
+    parser.add_argument("--version", type=int, default=None,
+                        help="evaluate or predict with this registered version")
+    commands = parser.add_subparsers(dest="command")
+    train_parser = commands.add_parser("train", help="tune, fit and register the model, unless a version matches")
+    train_parser.add_argument("--force", action="store_true", help="retrain even if a version matches")
+    commands.add_parser("evaluate", help="score the current (or pinned, or --version) model on the test split")
+    predict_parser = commands.add_parser("predict", help="score the given track ids")
+    predict_parser.add_argument("track_ids", nargs="+")
+    streaming_parser = commands.add_parser(
+        "train-streaming", help="fit an SGD model on hashed features, reading training_set in chunks")
+    streaming_parser.add_argument("--passes", type=int, default=5)
+    streaming_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    streaming_parser.add_argument("--output", default=STREAMING_MODEL_FILENAME)
+    commands.add_parser("models", help="list the registered versions")
+    pin_parser = commands.add_parser("pin", help="score with this version until unpin")
+    pin_parser.add_argument("pin_version", type=int)
+    commands.add_parser("unpin", help="go back to scoring with the current version")
+    prune_parser = commands.add_parser("prune", help="delete all but the newest versions (and the pinned one)")
+    prune_parser.add_argument("--keep", type=int, default=3)
+    args = parser.parse_args(argv)
+    registry = ModelRegistry(args.registry)
+
+    if args.command == "train-streaming":
+        from streaming_model import train_streaming
+        with instrument.stage("train_streaming"):
+            train_streaming(args.database, args.passes, args.chunk_size, args.output)
+        return
+
+    if args.command == "models":
+        list_versions(registry, current_components(args.database))
+        return
+    if args.command == "pin":
+        try:
+            registry.pin(args.pin_version)
+        except LookupError as e:
+            parser.error(str(e))
+        print(f"Pinned version {args.pin_version}")
+        return
+    if args.command == "unpin":
+        registry.unpin()
+        return
+    if args.command == "prune":
+        removed = registry.prune(args.keep)
+        print(f"Deleted {len(removed)} versions: {', '.join(map(str, removed))}" if removed else "Nothing to delete")
+        return
+
+    if args.command == "predict":
+        try:
+            meta, model_path = resolve_model(registry, args.database, args.version)
+        except LookupError as e:
+            parser.error(str(e))
+        best_model = load_model(model_path)
+        rows = predict(best_model, args.track_ids, args.database)
+        missing = set(args.track_ids) - set(rows.index)
+        if missing:
+            print(f"Not in training_set: {', '.join(sorted(missing))}")
+        print_table(rows, rows["prediction"].to_numpy())
+        return
+
+    df, vocabulary, chord_vocabulary, data_key = training_frame(args.database)
+    df_train, df_test = split(df)
+    components = model_components(vocabulary, chord_vocabulary, data_key)
+
+    if args.command == "evaluate":
+        try:
+            meta, _ = resolve_model(registry, args.database, args.version, components)
+        except LookupError as e:
+            parser.error(str(e))
+    elif getattr(args, "force", False):
+        meta = None
+    else:
+        meta = registry.find(fingerprint(components))
+
+    if meta is not None:
+        print(f"\nUsing registered version {meta['version']} (fingerprint {meta['fingerprint']}). Loading...")
+        with instrument.stage("load_model"):
+            best_model = registry.load(meta["version"])
+        evaluate(best_model, df_test)
+    else:
+        versions = registry.versions()
+        if versions and not getattr(args, "force", False):
+            print(f"\nNo version matches: {', '.join(changed_parts(versions[-1], components))} changed "
+                  f"since version {versions[-1]['version']}. Starting training...")
+        else:
+            print("\nStarting training...")
+        best_model = train(df_train, vocabulary, chord_vocabulary, data_key)
+        r2, mae = evaluate(best_model, df_test)
+        with instrument.stage("register"):
+            meta = registry.register(
+                best_model, components,
+                {"r2": r2, "mae": mae, "train_rows": len(df_train), "test_rows": len(df_test)},
+                feature_importances(best_model),
+            )
+        print(f"\nRegistered version {meta['version']} (fingerprint {meta['fingerprint']}) in '{args.registry}'")
+
+    show_sample(best_model, df_test)
+
+
+if __name__ == "__main__":
+    main()
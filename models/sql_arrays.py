@@ -0,0 +1,193 @@
+"""Reads SQLite query results straight into typed NumPy arrays, a chunk at a time
+
+pd.read_sql_query builds every column as float64 or Python objects from the
+full list of rows. Here each column gets the dtype it is declared with:
+float32 or a small integer type for numbers (NULLs become NaN in floats, and
+turn an integer column into pandas' nullable integer type), "category" for
+repeated strings (stored as codes into a list of distinct values, like
+pd.Categorical), or object for the rest. Rows are fetched FETCH_SIZE at a
+time and copied into preallocated arrays, so only one chunk of Python tuples
+exists at once.
+"""
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+CATEGORY = "category"
+FETCH_SIZE = 10000
+
+
+class TypedColumns:
+    """Growable typed arrays for the columns of one query result"""
+
+    def __init__(self, dtypes, capacity=FETCH_SIZE):
+        self.dtypes = dict(dtypes)
+        self.size = 0
+        self.arrays = {name: self._empty(dtype, max(capacity, 1)) for name, dtype in self.dtypes.items()}
+        # Distinct values of each category column, in order of first appearance
+        self.categories = {name: {} for name, dtype in self.dtypes.items() if dtype == CATEGORY}
+        # NULL flags of integer columns, made once a column has its first NULL
+        self.masks = {}
+
+    @staticmethod
+    def _empty(dtype, n):
+        return np.empty(n, dtype=np.int32 if dtype == CATEGORY else dtype)
+
+    def _reserve(self, n):
+        capacity = len(next(iter(self.arrays.values())))
+        if self.size + n <= capacity:
+            return
+        # Doubling keeps the copies amortized when the row count isn't known up front
+        capacity = max(self.size + n, 2 * capacity)
+        for name, array in self.arrays.items():
+            grown = self._empty(self.dtypes[name], capacity)
+            grown[:self.size] = array[:self.size]
+            self.arrays[name] = grown
+        for name, mask in self.masks.items():
+            grown = np.zeros(capacity, dtype=bool)
+            grown[:self.size] = mask[:self.size]
+            self.masks[name] = grown
+
+    def append(self, rows):
+        """Copies a list of row tuples (in dtypes' column order) into the arrays"""
+        if not rows:
+            return
+        self._reserve(len(rows))
+        start, end = self.size, self.size + len(rows)
+        for (name, dtype), values in zip(self.dtypes.items(), zip(*rows)):
+            if dtype == CATEGORY:
+                lookup = self.categories[name]
+                values = [-1 if v is None else lookup.setdefault(v, len(lookup)) for v in values]
+            try:
+                try:
+                    self.arrays[name][start:end] = values
+                except TypeError:
+                    if dtype == CATEGORY or self.arrays[name].dtype.kind not in "iu" or None not in values:
+                        raise
+                    self._null_ints(name, values, start, end)
+            except (TypeError, ValueError, OverflowError):
+                raise ValueError(f"Column {name} has values {dtype} can't hold") from None
+        self.size = end
+
+    def _null_ints(self, name, values, start, end):
+        if name not in self.masks:
+            self.masks[name] = np.zeros(len(self.arrays[name]), dtype=bool)
+        self.masks[name][start:end] = np.fromiter((v is None for v in values), dtype=bool, count=end - start)
+        self.arrays[name][start:end] = [0 if v is None else v for v in values]
+
+    def frame(self):
+        """Returns the columns as a DataFrame, trimmed to the rows read"""
+        columns = {}
+        for name, dtype in self.dtypes.items():
+            array = trimmed(self.arrays[name], self.size)
+            if dtype == CATEGORY:
+                categories = list(self.categories[name])
+                codes = array.astype(smallest_int(len(categories)), copy=False)
+                array = pd.Categorical.from_codes(codes, categories=categories)
+            elif name in self.masks:
+                array = pd.arrays.IntegerArray(array, trimmed(self.masks[name], self.size))
+            columns[name] = array
+        return pd.DataFrame(columns, copy=False)
+
+
+def trimmed(array, size):
+    """Returns the first size items, copied if the rest of the buffer would be mostly wasted"""
+    if len(array) > size + size // 4:
+        return array[:size].copy()
+    return array[:size]
+
+
+def smallest_int(n):
+    """Returns the smallest signed integer dtype holding -1 to n"""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def select(dtypes):
+    """Returns the SELECT list for a {column or "expression AS name": dtype} mapping"""
+    return ", ".join(dtypes)
+
+
+def names(dtypes):
+    """Returns {result column name: dtype} for a mapping passed to select()"""
+    return {column.rsplit(" AS ", 1)[-1].split(".")[-1]: dtype for column, dtype in dtypes.items()}
+
+
+def read_query(con, sql, params, dtypes, rows=None, fetch_size=FETCH_SIZE):
+    """Runs sql and returns its result as a DataFrame typed by dtypes ({name: dtype}, in column order)
+
+    rows, if known (from a cheap count), sizes the arrays exactly up front.
+    """
+    columns = TypedColumns(dtypes, rows or fetch_size)
+    cur = con.execute(sql, list(params))
+    while True:
+        chunk = cur.fetchmany(fetch_size)
+        if not chunk:
+            break
+        columns.append(chunk)
+    return columns.frame()
+
+
+def read_matrix(con, sql, params, width, dtype=np.float32, rows=None, fetch_size=FETCH_SIZE):
+    """Runs sql and returns its result as one (rows, width) array of a single dtype"""
+    out = np.empty((rows or 0, width), dtype=dtype)
+    size = 0
+    cur = con.execute(sql, list(params))
+    while True:
+        chunk = cur.fetchmany(fetch_size)
+        if not chunk:
+            break
+        if size + len(chunk) > len(out):
+            out = np.resize(out, (max(size + len(chunk), 2 * len(out)), width))
+        out[size:size + len(chunk)] = chunk
+        size += len(chunk)
+    return trimmed(out, size)
+
+
+def read_table(con, table, dtypes, where="", params=(), fetch_size=FETCH_SIZE, workers=1):
+    """Reads the given columns of a table, optionally filtered, into a typed DataFrame
+
+    dtypes maps column names (or "expression AS name") to dtypes. With
+    workers > 1, rowid ranges of the table are read on that many threads,
+    each with its own read-only connection and exactly sized arrays; SQLite
+    releases the GIL while it steps through rows, so the reads overlap.
+    """
+    where_sql = f"WHERE {where}" if where else ""
+    count = con.execute(f"SELECT count(*) FROM {table} {where_sql}", list(params)).fetchone()[0]
+    sql = f"SELECT {select(dtypes)} FROM {table}"
+    if workers <= 1 or count <= fetch_size:
+        return read_query(con, f"{sql} {where_sql}", params, names(dtypes), count, fetch_size)
+
+    path = con.execute("PRAGMA database_list").fetchone()[2]
+    bounds = con.execute(f"SELECT min(rowid), max(rowid) FROM {table}").fetchone()
+    edges = np.linspace(bounds[0], bounds[1] + 1, workers + 1).astype(np.int64)
+    in_range = f"{where_sql} {'AND' if where else 'WHERE'} rowid >= ? AND rowid < ?"
+
+    def read_range(first, last):
+        part = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        range_params = list(params) + [int(first), int(last)]
+        try:
+            rows = part.execute(f"SELECT count(*) FROM {table} {in_range}", range_params).fetchone()[0]
+            return read_query(part, f"{sql} {in_range} ORDER BY rowid", range_params, names(dtypes), rows, fetch_size)
+        finally:
+            part.close()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(read_range, edges[:-1], edges[1:]))
+    return concat(parts)
+
+
+def concat(parts):
+    """Concatenates frames from read_query, merging the categories of category columns"""
+    columns = {}
+    for name in parts[0].columns:
+        if isinstance(parts[0][name].dtype, pd.CategoricalDtype):
+            columns[name] = pd.api.types.union_categoricals([part[name] for part in parts])
+        else:
+            # Integer columns with NULLs in only some parts come out as the nullable type
+            columns[name] = pd.concat([part[name] for part in parts], ignore_index=True)
+    return pd.DataFrame(columns, copy=False)
@@ -0,0 +1,195 @@
+"""Out-of-core training for the song popularity model
+
+Reads training_set in rowid-range chunks (as batch_score.py does), featurizes
+each chunk with fixed-width hashed features, and fits an SGDRegressor with
+partial_fit over several passes. Nothing needs the full table at once: the
+chord n-grams and lyric words are hashed into fixed columns instead of
+learning a vocabulary, and the numeric and target scalers are fitted
+incrementally, so memory depends on the chunk size only.
+
+Songs whose track_id hashes into one bucket in five are held out for
+evaluation, so the split is stable without a pass over the data.
+"""
+import sqlite3
+import time
+import zlib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.linear_model import SGDRegressor
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler, normalize
+
+import song_popularity_model as spm
+from chord_features import ChordTerms, decode_tokens, load_chord_vocabulary
+from lyrics_features import TOKEN_PATTERN, allowed_terms, bags_to_csr, load_vocabulary, word_terms
+
+PASSES = 5
+NUMERIC_COLUMNS = ["duration", "year"]
+HOLDOUT_BUCKETS = 5
+# Fibonacci hashing spreads the n-gram codes over the hashed columns
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+def is_holdout(track_ids):
+    """Marks the tracks kept out of training, by a stable hash of their id"""
+    return np.array([zlib.crc32(t.encode("utf-8")) % HOLDOUT_BUCKETS == 0 for t in track_ids], dtype=bool)
+
+
+class HashedFeatures(TransformerMixin, BaseEstimator):
+    """Hashed chord n-grams, hashed lyric words and standardized duration and year
+
+    The text features need no fitting. Only the numeric scaler learns
+    anything, and it can be fitted a chunk at a time with partial_fit.
+    """
+
+    def __init__(self, vocabulary=(), chord_vocabulary=(), n_chord_features=2 ** 18,
+                 n_lyric_features=2 ** 12, stop_words="english", token_pattern=TOKEN_PATTERN):
+        self.vocabulary = vocabulary
+        self.chord_vocabulary = chord_vocabulary
+        self.n_chord_features = n_chord_features
+        self.n_lyric_features = n_lyric_features
+        self.stop_words = stop_words
+        self.token_pattern = token_pattern
+
+    def fit(self, X, y=None):
+        for name in ("scaler_", "word_columns_", "chord_terms_"):
+            self.__dict__.pop(name, None)
+        return self.partial_fit(X, y)
+
+    def partial_fit(self, X, y=None):
+        if not hasattr(self, "scaler_"):
+            self.scaler_ = StandardScaler()
+            self.word_columns_ = self._word_columns()
+            self.chord_terms_ = ChordTerms(self.chord_vocabulary)
+        self.scaler_.partial_fit(X[NUMERIC_COLUMNS].to_numpy(dtype=np.float64))
+        return self
+
+    def _word_columns(self):
+        """A (words x hashed columns) matrix sending each word's kept terms to their columns"""
+        terms, to_terms = word_terms(self.vocabulary, self.token_pattern)
+        hashed = FeatureHasher(n_features=self.n_lyric_features, input_type="string",
+                               alternate_sign=False).transform([[t] for t in terms])
+        kept = sp.diags(allowed_terms(terms, self.stop_words).astype(np.float64))
+        return (to_terms @ kept @ hashed).tocsr()
+
+    def _hashed_chords(self, blobs):
+        """Chord 1-3 gram counts hashed into n_chord_features columns"""
+        ids, lengths = decode_tokens(blobs)
+        rows, codes = self.chord_terms_.ngram_codes(ids, lengths)
+        columns = ((codes.astype(np.uint64) * GOLDEN) >> np.uint64(32)) % np.uint64(self.n_chord_features)
+        chords = sp.csr_matrix((np.ones(len(codes)), (rows, columns.astype(np.int64))),
+                               shape=(len(lengths), self.n_chord_features))
+        chords.sum_duplicates()
+        return chords
+
+    def transform(self, X):
+        chords = self._hashed_chords(X["chord_tokens"])
+        lyrics = bags_to_csr(X["lyrics_bag"], len(self.vocabulary)) @ self.word_columns_
+        numeric = self.scaler_.transform(X[NUMERIC_COLUMNS].to_numpy(dtype=np.float64))
+        return sp.hstack([normalize(chords), normalize(lyrics), sp.csr_matrix(numeric)], format="csr")
+
+
+def fit_scalers(con, prep, target, ranges):
+    """The statistics pass: reads only duration, year and the target's inputs of the training rows
+
+    Fits prep's numeric scaler and the target scaler, a StandardScaler for
+    synthetic_popularity.
+    """
+    for first, last in ranges:
+        numeric = pd.read_sql_query("""
+            SELECT track_id, duration, year, artist_hotttnesss, artist_familiarity
+            FROM training_set
+            WHERE rowid BETWEEN ? AND ?
+            AND title IS NOT NULL AND artist_name IS NOT NULL
+            AND duration IS NOT NULL AND year IS NOT NULL
+        """, con, params=(first, last))
+        numeric = numeric[~is_holdout(numeric["track_id"])]
+        if len(numeric):
+            prep.partial_fit(numeric)
+            target.partial_fit(spm.synthetic_popularity(numeric).to_numpy()[:, None])
+
+
+def train_streaming(database=spm.DATABASE_FILENAME, passes=PASSES, chunk_size=spm.CHUNK_SIZE,
+                    model_path=spm.STREAMING_MODEL_FILENAME):
+    """Fits the hashed-feature SGD model a chunk at a time and saves it to model_path"""
+    import joblib
+
+    con = sqlite3.connect(database)
+    ranges = list(spm.rowid_ranges(con, chunk_size))
+    prep = HashedFeatures(vocabulary=load_vocabulary(con), chord_vocabulary=load_chord_vocabulary(con))
+    reg = SGDRegressor(alpha=1e-5, eta0=0.01, average=True, random_state=42)
+    rng = np.random.default_rng(42)
+
+    # SGD starts from zero weights and a zero intercept, so it learns the
+    # standardized target; on the raw 0-100 scale most of the passes went to
+    # moving the intercept up to the mean
+    target = StandardScaler()
+    print(f"Fitting the scalers over {len(ranges)} chunks...")
+    fit_scalers(con, prep, target, ranges)
+    if not hasattr(target, "mean_"):
+        con.close()
+        raise ValueError(f"No training rows in '{database}' (every song is held out or incomplete)")
+    mean, scale = target.mean_[0], target.scale_[0]
+
+    for epoch in range(passes):
+        start = time.perf_counter()
+        rows = 0
+        abs_error = 0.0
+        for i in rng.permutation(len(ranges)):
+            chunk = spm.featurize(spm.load(con, rowids=ranges[i]))
+            chunk = chunk[~is_holdout(chunk.index)]
+            if not len(chunk):
+                continue
+            chunk = chunk.iloc[rng.permutation(len(chunk))]
+            X = prep.transform(chunk[spm.feature_columns])
+            y = chunk["synthetic_popularity"].to_numpy()
+            # Progressive validation: each chunk is scored before it is learned
+            if hasattr(reg, "coef_"):
+                abs_error += np.abs(reg.predict(X) * scale + mean - y).sum()
+            reg.partial_fit(X, (y - mean) / scale)
+            rows += len(chunk)
+        progress = f", progressive MAE {abs_error / rows:.2f}" if epoch and rows else ""
+        print(f"Pass {epoch + 1}/{passes}: {rows:,} rows in {time.perf_counter() - start:.1f}s{progress}")
+
+    if not hasattr(reg, "coef_"):
+        con.close()
+        raise ValueError(f"No training rows in '{database}' (every song is held out or incomplete)")
+
+    # Folds the target scaling into the weights, so the saved model predicts
+    # popularity itself
+    reg.coef_ *= scale
+    reg.intercept_ = reg.intercept_ * scale + mean
+    model = Pipeline(steps=[("prep", prep), ("reg", reg)])
+    r2, mae = evaluate_streaming(con, model, ranges)
+    con.close()
+    print("\n--- Model Performance (held-out songs) ---")
+    print(f"R^2 Score: {r2:.4f}")
+    print(f"Mean Absolute Error (MAE): {mae:.2f}")
+
+    joblib.dump(model, model_path)
+    print(f"Training complete. Model saved to '{model_path}'.")
+    return model
+
+
+def evaluate_streaming(con, model, ranges):
+    """Returns (r2, mae) over the held-out songs, accumulated a chunk at a time"""
+    n = 0
+    abs_error = squared_error = total = total_squares = 0.0
+    for rowids in ranges:
+        chunk = spm.featurize(spm.load(con, rowids=rowids))
+        chunk = chunk[is_holdout(chunk.index)]
+        if not len(chunk):
+            continue
+        y = chunk["synthetic_popularity"].to_numpy()
+        error = model.predict(chunk[spm.feature_columns]) - y
+        n += len(y)
+        abs_error += np.abs(error).sum()
+        squared_error += (error ** 2).sum()
+        total += y.sum()
+        total_squares += (y ** 2).sum()
+    if not n:
+        return float("nan"), float("nan")
+    return 1 - squared_error / (total_squares - total ** 2 / n), abs_error / n
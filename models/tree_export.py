@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Flat-array export of the fitted GradientBoostingRegressor, with a NumPy evaluator
+
+export_trees() turns the reg step of the saved pipeline into a few
+contiguous arrays and writes them to an .npz file. Every tree is padded to a
+complete binary tree of the ensemble's depth and stored in heap order, so
+children are found by arithmetic (2i+1, 2i+2) instead of lookups: per tree
+there is a row of split features, a row of thresholds and a row of leaf
+values. TreeEnsemble scores whole batches of the prep step's (sparse) output
+with them, walking all trees one level at a time for every row at once. It
+compares and sums in the same order and precision as sklearn, so its
+predictions equal best_model.predict bit for bit.
+
+On the few rows of a real-time request that beats sklearn's predict, whose
+fixed per-call overhead dominates there. sklearn's compiled walk wins on
+larger batches, so callers should only use it up to CROSSOVER_ROWS rows;
+--check times both to find the crossover for a given model.
+"""
+import argparse
+import time
+import numpy as np
+import scipy.sparse as sp
+
+TREES_FILENAME = "song_popularity_trees.npz"
+# Rows densified at a time while predicting
+BATCH_ROWS = 4096
+# A complete tree of this depth has 2**depth leaves
+MAX_DEPTH = 12
+# Largest batch to score with TreeEnsemble rather than sklearn. For 297
+# depth-5 trees the two break even at 40-48 rows (1 row: 0.2 vs 1.0ms,
+# 32 rows: 1.0 vs 1.2ms, 64 rows: 1.7 vs 1.2ms)
+CROSSOVER_ROWS = 32
+
+
+def _complete_tree(tree, depth):
+    """Returns (features, thresholds, leaf values) of a tree padded to a complete one
+
+    A leaf above the bottom level becomes a split that always goes left
+    (threshold +inf), so every path is exactly depth splits long.
+    """
+    n_splits = 2 ** depth - 1
+    features = np.zeros(n_splits, dtype=np.int64)
+    thresholds = np.full(n_splits, np.inf)
+    values = np.zeros(n_splits + 1)
+    stack = [(0, 0, 0)]
+    while stack:
+        node, position, level = stack.pop()
+        if level == depth:
+            values[position - n_splits] = tree.value[node, 0, 0]
+            continue
+        left, right = tree.children_left[node], tree.children_right[node]
+        if left == -1:
+            left = right = node
+        else:
+            features[position] = tree.feature[node]
+            thresholds[position] = tree.threshold[node]
+        stack.append((left, 2 * position + 1, level + 1))
+        stack.append((right, 2 * position + 2, level + 1))
+    return features, thresholds, values
+
+
+def export_trees(model, path=TREES_FILENAME):
+    """Writes the trees of a fitted pipeline's (or a bare) GradientBoostingRegressor to path"""
+    from sklearn.ensemble import GradientBoostingRegressor
+
+    reg = model[-1] if hasattr(model, "steps") else model
+    if not isinstance(reg, GradientBoostingRegressor):
+        raise ValueError(f"Can only export a GradientBoostingRegressor, not {type(reg).__name__}")
+
+    trees = [estimator.tree_ for estimator in reg.estimators_[:, 0]]
+    depth = max(tree.max_depth for tree in trees)
+    if depth > MAX_DEPTH:
+        raise ValueError(f"Trees {depth} deep are too deep to store as complete trees")
+    features, thresholds, values = map(np.vstack, zip(*(_complete_tree(tree, depth) for tree in trees)))
+
+    # Only the features some split uses get densified, renumbered in column order
+    splits = np.isfinite(thresholds)
+    columns = np.unique(features[splits])
+    features = np.where(splits, np.searchsorted(columns, features), 0)
+
+    if reg.init_ == "zero":
+        init = 0.0
+    else:
+        init = float(reg.init_.predict(np.zeros((1, reg.n_features_in_)))[0])
+
+    np.savez_compressed(
+        path,
+        columns=columns.astype(np.int32),
+        features=features.astype(np.int32),
+        thresholds=thresholds,
+        # sklearn adds learning_rate * leaf value per stage; the product is the same either way
+        values=reg.learning_rate * values,
+        init=np.float64(init),
+        n_features=np.int32(reg.n_features_in_),
+    )
+
+
+class TreeEnsemble:
+    """Predicts with trees exported by export_trees()"""
+
+    def __init__(self, columns, features, thresholds, values, init, n_features):
+        self.columns = columns
+        self.features = features
+        self.thresholds = thresholds
+        self.values = values
+        self.init = float(init)
+        self.n_features = int(n_features)
+        self.depth = int(np.log2(values.shape[1]))
+        # Maps an input column to its row in the densified batch, -1 if no split uses it
+        self.column_map = np.full(self.n_features, -1, dtype=np.int64)
+        self.column_map[columns] = np.arange(len(columns))
+
+    @classmethod
+    def load(cls, path=TREES_FILENAME):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def predict(self, X, batch_rows=BATCH_ROWS):
+        if X.shape[1] != self.n_features:
+            raise ValueError(f"X has {X.shape[1]} features, the trees expect {self.n_features}")
+        X = sp.csr_matrix(X) if sp.issparse(X) else np.asarray(X)
+        if not X.shape[0]:
+            return np.zeros(0)
+        return np.concatenate([
+            self._predict_batch(X[start:start + batch_rows])
+            for start in range(0, X.shape[0], batch_rows)
+        ])
+
+    def _dense_columns(self, X):
+        """The used columns of X as a (columns x rows) float32 array
+
+        sklearn's trees also split on float32 copies of the input.
+        """
+        if not sp.issparse(X):
+            return np.ascontiguousarray(X[:, self.columns].T, dtype=np.float32)
+        dense = np.zeros((len(self.columns), X.shape[0]), dtype=np.float32)
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        columns = self.column_map[X.indices]
+        used = columns >= 0
+        dense[columns[used], rows[used]] = X.data[used]
+        return dense
+
+    def _predict_batch(self, X):
+        dense = self._dense_columns(X).ravel()
+        n_rows = X.shape[0]
+        n_trees, n_splits = self.features.shape
+        rows = np.arange(n_rows)
+        tree_splits = (np.arange(n_trees) * n_splits)[:, None]
+        features = self.features.ravel()
+        thresholds = self.thresholds.ravel()
+
+        position = np.zeros((n_trees, n_rows), dtype=np.intp)
+        for _ in range(self.depth):
+            split = tree_splits + position
+            go_right = dense[features[split] * n_rows + rows] > thresholds[split]
+            position = 2 * position + 1 + go_right
+
+        leaf_values = np.take_along_axis(self.values, position - n_splits, axis=1)
+        # Summed stage by stage from the initial prediction, like sklearn, so
+        # rounding matches exactly
+        stages = np.vstack([np.full((1, n_rows), self.init), leaf_values])
+        return np.add.accumulate(stages, axis=0)[-1]
+
+
+def main():
+    import os
+    import song_popularity_model as spm
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=spm.DATABASE_FILENAME)
+    parser.add_argument("--registry", default=spm.REGISTRY_DIR)
+    parser.add_argument("--version", type=int, default=None, help="export this registered version")
+    parser.add_argument("--model", default=None, help="export this pipeline file instead")
+    parser.add_argument("--output", default=TREES_FILENAME)
+    parser.add_argument("--check", action="store_true",
+                        help="compare against the pipeline on the test split and time both")
+    args = parser.parse_args()
+
+    model_path = args.model
+    if model_path is None:
+        try:
+            _, model_path = spm.resolve_model(spm.ModelRegistry(args.registry), args.database, args.version)
+        except LookupError as e:
+            parser.error(str(e))
+    best_model = spm.load_model(model_path)
+    export_trees(best_model, args.output)
+    print(f"Exported {len(best_model[-1].estimators_)} trees to '{args.output}' "
+          f"({os.path.getsize(args.output):,} bytes, model file {os.path.getsize(model_path):,} bytes)")
+
+    if args.check:
+        df, _, _, _ = spm.training_frame(args.database)
+        _, df_test = spm.split(df)
+        features = best_model[:-1].transform(df_test[spm.feature_columns])
+        trees = TreeEnsemble.load(args.output)
+        expected = best_model[-1].predict(features)
+        predicted = trees.predict(features)
+        print(f"Identical to predict: {np.array_equal(expected, predicted)} "
+              f"(max difference {np.abs(expected - predicted).max():.3g})")
+
+        faster = []
+        for n_rows in (1, 8, 16, 32, 48, 64, 256, features.shape[0]):
+            batch = features[:n_rows]
+            timings = []
+            for predict in (best_model[-1].predict, trees.predict):
+                start = time.perf_counter()
+                for _ in range(20):
+                    predict(batch)
+                timings.append((time.perf_counter() - start) / 20 * 1000)
+            print(f"{n_rows:>6,} rows: sklearn {timings[0]:.2f}ms, exported trees {timings[1]:.2f}ms")
+            if timings[1] < timings[0]:
+                faster.append(n_rows)
+        if faster:
+            print(f"Exported trees are faster up to {max(faster)} rows "
+                  f"(inference_server.py --trees-max-rows, default {CROSSOVER_ROWS})")
+        else:
+            print("Exported trees are not faster than sklearn for any batch size")
+
+
+if __name__ == "__main__":
+    main()
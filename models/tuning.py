@@ -0,0 +1,121 @@
+"""Hyperparameter search setups for song_popularity_model.py"""
+import numpy as np
+import scipy.sparse as sp
+from sklearn.experimental import enable_halving_search_cv  # noqa: F401
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
+from sklearn.model_selection import HalvingRandomSearchCV, RandomizedSearchCV
+from sklearn.preprocessing import FunctionTransformer
+
+# The original search: 10 random candidates, each fully fitted on every fold
+RANDOM_PARAMS = {
+    'reg__n_estimators': [200, 300],
+    'reg__learning_rate': [0.1, 0.2],
+    'reg__max_depth': [4, 5],
+    'prep__chords_max_features': [500, 1000],
+    'prep__lyrics_max_features': [500, 1000]
+}
+
+# Successive halving uses the number of boosting rounds as its budget, so the
+# rows in each fold (and so the preprocessing) never change between rounds
+HALVING_PARAMS = {
+    "gbr": {
+        'reg__learning_rate': [0.05, 0.1, 0.2],
+        'reg__max_depth': [3, 4, 5, 6],
+        'reg__subsample': [0.8, 1.0],
+        'reg__min_samples_leaf': [1, 5, 20],
+    },
+    "hist": {
+        'reg__learning_rate': [0.05, 0.1, 0.2],
+        'reg__max_leaf_nodes': [15, 31, 63],
+        'reg__min_samples_leaf': [5, 20, 50],
+        'reg__l2_regularization': [0.0, 0.1, 1.0],
+    },
+}
+TEXT_PARAMS = {
+    'prep__chords_max_features': [250, 500, 1000, 2000],
+    'prep__lyrics_max_features': [250, 500, 1000, 2000],
+}
+# The search tunes a SharedTfidf step; the saved model is refitted with the
+# CachedPreprocessor-wrapped ColumnTransformer, whose parameters are named these
+SAVED_PARAM_NAMES = {
+    'prep__chords_max_features': 'prep__prep__chords__max_features',
+    'prep__lyrics_max_features': 'prep__prep__lyrics__max_features',
+}
+BUDGET_PARAM = {"gbr": "reg__n_estimators", "hist": "reg__max_iter"}
+MAX_ROUNDS = 300
+HALVING_FACTOR = 3
+HALVING_CANDIDATES = 81
+# Four rounds of 81, 27, 9 and 3 candidates, given 11, 33, 99 and 297 boosting
+# rounds, so the winner (and the refitted model) gets nearly MAX_ROUNDS
+MIN_ROUNDS = MAX_ROUNDS // HALVING_FACTOR ** 3
+
+
+def to_dense_float32(X):
+    """Densifies the TF-IDF output for HistGradientBoostingRegressor, which can't take sparse input"""
+    if sp.issparse(X):
+        X = X.toarray()
+    return np.asarray(X, dtype=np.float32)
+
+
+def make_regressor(backend):
+    """Returns the regression steps for a backend: "gbr" or "hist" (histogram-based boosting)"""
+    if backend == "hist":
+        return [
+            ("dense", FunctionTransformer(to_dense_float32, accept_sparse=True)),
+            ("reg", HistGradientBoostingRegressor(early_stopping=False, random_state=42)),
+        ]
+    return [("reg", GradientBoostingRegressor(random_state=42))]
+
+
+def saved_params(best_params):
+    """Renames a search's best_params_ for the pipeline that gets saved"""
+    return {SAVED_PARAM_NAMES.get(name, name): value for name, value in best_params.items()}
+
+
+def search_space(backend="gbr", mode="halving"):
+    """Returns the param_dist a search samples from"""
+    if mode == "random":
+        params = dict(RANDOM_PARAMS)
+        if backend == "hist":
+            params['reg__max_iter'] = params.pop('reg__n_estimators')
+        return params
+    return dict(HALVING_PARAMS[backend], **TEXT_PARAMS)
+
+
+def make_search(pipeline, backend="gbr", mode="halving", refit=True):
+    """Returns the hyperparameter search for a pipeline
+
+    mode "random" is the original RandomizedSearchCV. mode "halving"
+    samples a larger space and drops the weaker two thirds of the candidates
+    at each round, tripling the boosting rounds given to the survivors, from
+    MIN_ROUNDS up to just under MAX_ROUNDS in the last round.
+    """
+    params = search_space(backend, mode)
+    if mode == "random":
+        return RandomizedSearchCV(
+            pipeline,
+            param_distributions=params,
+            n_iter=10,
+            cv=5,
+            n_jobs=-1,
+            verbose=1,
+            scoring='neg_mean_absolute_error',
+            refit=refit,
+            random_state=42
+        )
+
+    return HalvingRandomSearchCV(
+        pipeline,
+        param_distributions=params,
+        n_candidates=HALVING_CANDIDATES,
+        resource=BUDGET_PARAM[backend],
+        min_resources=MIN_ROUNDS,
+        max_resources=MAX_ROUNDS,
+        factor=HALVING_FACTOR,
+        cv=5,
+        n_jobs=-1,
+        verbose=1,
+        scoring='neg_mean_absolute_error',
+        refit=refit,
+        random_state=42
+    )
@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for package in ("models", "db", "bench"):
+    sys.path.insert(0, os.path.join(ROOT, package))
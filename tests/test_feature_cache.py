@@ -0,0 +1,28 @@
+import errno
+import os
+
+import numpy as np
+import pytest
+
+import feature_cache
+from feature_cache import FeatureCache
+
+
+def test_losing_the_race_for_an_entry_is_fine(tmp_path):
+    cache = FeatureCache(str(tmp_path))
+    cache.save("key", {"a": np.arange(3)})
+    cache.save("key", {"a": np.arange(3)})
+    np.testing.assert_array_equal(cache.load("key")[1]["a"], np.arange(3))
+    assert os.listdir(tmp_path) == ["key"]
+
+
+def test_other_write_errors_propagate(tmp_path, monkeypatch):
+    def full_disk(*args, **kwargs):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    monkeypatch.setattr(feature_cache.np, "save", full_disk)
+
+    cache = FeatureCache(str(tmp_path))
+    with pytest.raises(OSError, match="No space"):
+        cache.save("key", {"a": np.arange(3)})
+    assert cache.load("key") is None
+    assert os.listdir(tmp_path) == []
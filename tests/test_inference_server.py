@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiohttp")
+from inference_server import MicroBatcher  # noqa: E402
+
+
+def double(items):
+    if "bad" in items:
+        raise RuntimeError("bad item")
+    return [2 * len(item) for item in items]
+
+
+def test_failing_request_does_not_fail_its_batch():
+    async def run():
+        batcher = MicroBatcher(double, max_batch=64, max_wait_ms=50)
+        batcher.start()
+        try:
+            return await asyncio.gather(
+                batcher.predict(["a", "bb"]),
+                batcher.predict(["bad"]),
+                batcher.predict(["ccc"]),
+                return_exceptions=True,
+            )
+        finally:
+            await batcher.stop()
+
+    good, bad, other = asyncio.run(run())
+    assert good == [2, 4]
+    assert isinstance(bad, RuntimeError)
+    assert other == [6]
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from lyrics_features import LyricBagTfidf, word_terms
+
+# mxm-style vocabulary, with words the vectorizer splits or drops
+VOCABULARY = ["love", "night", "don't", "rock'n'roll", "rock", "the", "i", "o'clock", "x", "café", "baby", "roll"]
+
+
+def random_bags(n, seed=0):
+    rng = np.random.default_rng(seed)
+    bags = []
+    for _ in range(n):
+        words = rng.choice(len(VOCABULARY), size=rng.integers(0, 6), replace=False)
+        bags.append(np.vstack([words, rng.integers(1, 5, len(words))]).astype(np.int32))
+    return bags
+
+
+def as_text(bag):
+    return " ".join(" ".join([VOCABULARY[w]] * c) for w, c in bag.T)
+
+
+def test_word_terms_split_like_the_vectorizer():
+    terms, matrix = word_terms(["rock'n'roll", "don't", "x"])
+    assert list(terms) == ["don", "rock", "roll"]
+    assert matrix.toarray().tolist() == [[0, 1, 1], [1, 0, 0], [0, 0, 0]]
+
+
+@pytest.mark.parametrize("max_features", [None, 4])
+def test_matches_tfidf_vectorizer_on_rebuilt_text(max_features):
+    bags = random_bags(40)
+    expected = TfidfVectorizer(stop_words="english", max_features=max_features)
+    expected_matrix = expected.fit_transform([as_text(bag) for bag in bags])
+
+    ours = LyricBagTfidf(VOCABULARY, max_features=max_features)
+    matrix = ours.fit_transform(bags)
+
+    assert list(ours.get_feature_names_out()) == list(expected.get_feature_names_out())
+    np.testing.assert_allclose(matrix.toarray(), expected_matrix.toarray())
+    new_bags = random_bags(10, seed=1)
+    np.testing.assert_allclose(ours.transform(new_bags).toarray(),
+                               expected.transform([as_text(bag) for bag in new_bags]).toarray())
@@ -0,0 +1,16 @@
+import sqlite3
+
+import match_songs
+
+
+def test_minhash_of_no_texts():
+    assert match_songs.minhash([]).shape == (0, match_songs.NUM_PERM)
+
+
+def test_match_with_no_translations_yet():
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE songs (track_id TEXT, title TEXT, artist_name TEXT)")
+    con.execute("CREATE TABLE id_translations (track_id TEXT, track_name TEXT, artist_name TEXT)")
+    con.execute("INSERT INTO songs VALUES ('TR1', 'Memory Free', 'Anna Wright')")
+    assert match_songs.match(con) == []
+
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+import shared_features
+from chord_features import TOKEN_DTYPE
+from shared_features import SharedTfidf, materialize
+
+VOCABULARY = ["love", "night", "rock", "the", "baby", "roll"]
+CHORDS = ["C", "G", "Am", "F", "D"]
+
+
+def frame(n, seed=0):
+    rng = np.random.default_rng(seed)
+    bags = []
+    for _ in range(n):
+        words = rng.choice(len(VOCABULARY), size=rng.integers(1, 4), replace=False)
+        bags.append(np.vstack([words, rng.integers(1, 5, len(words))]).astype(np.int32))
+    return pd.DataFrame({
+        "chord_tokens": [rng.integers(0, len(CHORDS), rng.integers(2, 8)).astype(TOKEN_DTYPE).tobytes()
+                         for _ in range(n)],
+        "lyrics_bag": bags,
+        "duration": rng.uniform(100, 300, n),
+        "year": rng.integers(1960, 2010, n).astype(float),
+    })
+
+
+def test_fit_is_reused_per_rows_and_max_features(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    key = materialize(frame(30), VOCABULARY, CHORDS, cache_dir, "data")
+    train, test = np.arange(0, 30, 2)[:, None], np.arange(1, 30, 2)[:, None]
+
+    first = SharedTfidf(cache_dir, key, chords_max_features=5, lyrics_max_features=3)
+    fitted = first.fit_transform(train).toarray()
+    transformed = first.transform(test).toarray()
+
+    # A second candidate with the same fold and settings never recomputes
+    def fail(*args, **kwargs):
+        raise AssertionError("recomputed a cached fit")
+    monkeypatch.setattr(shared_features, "select_columns", fail)
+    monkeypatch.setattr(shared_features, "tfidf_weight", fail)
+    second = SharedTfidf(cache_dir, key, chords_max_features=5, lyrics_max_features=3)
+    np.testing.assert_array_equal(second.fit_transform(train).toarray(), fitted)
+    np.testing.assert_array_equal(second.transform(test).toarray(), transformed)
+    assert list(second.get_feature_names_out()) == list(first.get_feature_names_out())
@@ -0,0 +1,45 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import song_popularity_model as spm
+from generate_data import generate
+from streaming_model import is_holdout, train_streaming
+
+
+def test_streaming_model_beats_the_mean(tmp_path):
+    generate(tmp_path, 1500, words=500, words_per_song=50)
+    database = str(tmp_path / "SongPop.db")
+    # Make popularity follow duration, so there is something to learn
+    con = sqlite3.connect(database)
+    con.execute("UPDATE training_set SET artist_hotttnesss = duration / (SELECT max(duration) FROM training_set), "
+                "artist_familiarity = NULL")
+    con.commit()
+
+    model = train_streaming(database, passes=5, chunk_size=200, model_path=str(tmp_path / "streaming.pkl"))
+
+    df = spm.featurize(spm.load(con))
+    con.close()
+    holdout = is_holdout(df.index)
+    y_train = df["synthetic_popularity"][~holdout]
+    y_test = df["synthetic_popularity"][holdout].to_numpy()
+    mae = np.abs(model.predict(df[holdout][spm.feature_columns]) - y_test).mean()
+    baseline = np.abs(y_train.mean() - y_test).mean()
+    assert mae < 0.5 * baseline
+
+
+def test_refuses_to_save_an_unfitted_model(tmp_path):
+    generate(tmp_path, 300, words=100, words_per_song=20)
+    database = str(tmp_path / "SongPop.db")
+    con = sqlite3.connect(database)
+    training = [track_id for track_id, in con.execute("SELECT track_id FROM training_set")
+                if not is_holdout([track_id])[0]]
+    con.executemany("DELETE FROM training_set WHERE track_id = ?", [(t,) for t in training])
+    con.commit()
+    con.close()
+
+    model_path = tmp_path / "streaming.pkl"
+    with pytest.raises(ValueError, match="No training rows"):
+        train_streaming(database, passes=2, chunk_size=50, model_path=str(model_path))
+    assert not model_path.exists()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from sklearn.base import BaseEstimator, RegressorMixin, TransformerMixin
+from sklearn.pipeline import Pipeline
+
+from tuning import BUDGET_PARAM, MAX_ROUNDS, make_search
+
+
+class StubPrep(TransformerMixin, BaseEstimator):
+    def __init__(self, chords_max_features=None, lyrics_max_features=None):
+        self.chords_max_features = chords_max_features
+        self.lyrics_max_features = lyrics_max_features
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X):
+        return X
+
+
+class StubBoosting(RegressorMixin, BaseEstimator):
+    """Takes every parameter either backend is tuned on, and predicts the mean"""
+
+    def __init__(self, n_estimators=100, max_iter=100, learning_rate=0.1, max_depth=3, subsample=1.0,
+                 min_samples_leaf=1, max_leaf_nodes=31, l2_regularization=0.0):
+        self.n_estimators = n_estimators
+        self.max_iter = max_iter
+        self.learning_rate = learning_rate
+        self.max_depth = max_depth
+        self.subsample = subsample
+        self.min_samples_leaf = min_samples_leaf
+        self.max_leaf_nodes = max_leaf_nodes
+        self.l2_regularization = l2_regularization
+
+    def fit(self, X, y):
+        self.mean_ = float(np.mean(y))
+        return self
+
+    def predict(self, X):
+        return np.full(len(X), self.mean_)
+
+
+@pytest.mark.parametrize("backend", ["gbr", "hist"])
+def test_halving_ends_near_max_rounds(backend):
+    rng = np.random.default_rng(0)
+    X, y = rng.normal(size=(100, 3)), rng.normal(size=100)
+    search = make_search(Pipeline([("prep", StubPrep()), ("reg", StubBoosting())]), backend)
+    search.set_params(n_jobs=1, verbose=0)
+    search.fit(X, y)
+
+    assert list(search.n_resources_) == [11, 33, 99, 297]
+    assert search.n_resources_[-1] > MAX_ROUNDS * 0.9
+    assert search.best_params_[BUDGET_PARAM[backend]] == search.n_resources_[-1]